@@ -0,0 +1,11 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "shared"))
+from orchestrator import main
+
+# Deploy or destroy every infra stack of an environment in dependency order.
+# Stacks run in processes that import this module again, hence the guard.
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,9 +4,10 @@ import pulumi
 import pulumi_aws as aws
 
 sys.path.append("../../shared")
-from bootstrap import manage, args
+from bootstrap import manage, args, webhook_trigger
+from iam_policy import policy, statement
 
-project_name = os.path.basename(os.getcwd())
+project_name = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
 
 # Deploy CloudTrail Trail to track S3 events
 
@@ -29,35 +30,27 @@ def pulumi_program():
     current = aws.get_caller_identity()
     aws.s3.BucketPolicy("s3_trail_bucket_policy",
         bucket=pipeline_s3_trail_bucket,
-        policy=pulumi.Output.all(pipeline_s3_trail_bucket=pipeline_s3_trail_bucket).apply(lambda args: f"""{{
-            "Version": "2012-10-17",
-            "Statement": [
-                {{
-                    "Sid": "AWSCloudTrailAclCheck20150319",
-                    "Effect": "Allow",
-                    "Principal": {{
-                        "Service": "cloudtrail.amazonaws.com"
-                    }},
-                    "Action": "s3:GetBucketAcl",
-                    "Resource": "arn:aws:s3:::{args['pipeline_s3_trail_bucket']}"
-                }},
-                {{
-                    "Sid": "AWSCloudTrailWrite20150319",
-                    "Effect": "Allow",
-                    "Principal": {{
-                        "Service": "cloudtrail.amazonaws.com"
-                    }},
-                    "Action": "s3:PutObject",
-                    "Resource": "arn:aws:s3:::{args['pipeline_s3_trail_bucket']}/AWSLogs/{current.account_id}/*",
-                    "Condition": {{
-                        "StringEquals": {{
-                            "s3:x-amz-acl": "bucket-owner-full-control"
-                        }}
-                    }}
-                }}
-            ]
-            }}
-    """))
+        policy=policy(lambda bucket: [
+                statement("s3:GetBucketAcl", f"arn:aws:s3:::{bucket}",
+                          principal={"Service": "cloudtrail.amazonaws.com"}),
+                statement("s3:PutObject",
+                          f"arn:aws:s3:::{bucket}/AWSLogs/{current.account_id}/*",
+                          principal={"Service": "cloudtrail.amazonaws.com"},
+                          condition={"StringEquals": {
+                              "s3:x-amz-acl": "bucket-owner-full-control"}}),
+            ],
+            bucket=pipeline_s3_trail_bucket))
+    # The source bucket always starts CodePipeline. The webhook buckets only start
+    # CodeBuild through CloudTrail when the webhook doesn't call StartBuild itself
+    data_resources = [
+        codepipeline_source_bucket.apply(lambda id: f"arn:aws:s3:::{id}/pulumi-bootstrap.zip")
+    ]
+    if webhook_trigger(environment) == 'legacy':
+        data_resources += [
+            # Per pull request buildspecs: prs/<number>/<sha>/buildspec.yml
+            codebuild_functional_bucket.apply(lambda id: f"arn:aws:s3:::{id}/prs/"),
+            codebuild_main_bucket.apply(lambda id: f"arn:aws:s3:::{id}/buildspec.yml"),
+        ]
     aws.cloudtrail.Trail("pipeline_s3_trail",
         s3_bucket_name=pipeline_s3_trail_bucket,
         event_selectors=[aws.cloudtrail.TrailEventSelectorArgs(
@@ -65,14 +58,10 @@ def pulumi_program():
             include_management_events=True,
             data_resources=[aws.cloudtrail.TrailEventSelectorDataResourceArgs(
                 type="AWS::S3::Object",
-                values=[
-                    codebuild_functional_bucket.apply(lambda id: f"arn:aws:s3:::{id}/buildspec.yml"),
-                    codebuild_main_bucket.apply(lambda id: f"arn:aws:s3:::{id}/buildspec.yml"),
-                    codepipeline_source_bucket.apply(lambda id: f"arn:aws:s3:::{id}/pulumi-bootstrap.zip")
-
-                ]
+                values=data_resources
             )],
         )],
         tags=ptags)
 
-stack = manage(args(), os.path.basename(os.getcwd()), pulumi_program)
+if __name__ == "__main__":
+    stack = manage(args(), os.path.basename(os.getcwd()), pulumi_program)
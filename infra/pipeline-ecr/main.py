@@ -1,17 +1,52 @@
 import sys
 import os
 import base64
-from shutil import copyfile
+import hashlib
 import pulumi
 import pulumi_aws as aws
 import pulumi_docker as docker
 
 sys.path.append("../..//shared")
 from bootstrap import manage, args
+from plugins import PLUGIN_VERSIONS
 
-# Copy requirements.txt from the root of the repo first - for the Docker image build
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
 CUSTOM_IMAGE = "pulumi-bootstrap"
-copyfile('../../requirements.txt', f"{CUSTOM_IMAGE}/requirements.txt")
+IMAGE_CONTEXT = os.path.join(PROJECT_DIR, CUSTOM_IMAGE)
+REQUIREMENTS = os.path.join(PROJECT_DIR, '../../requirements.txt')
+# Dockerfile stages pushed to ECR and reused as build cache
+CACHE_STAGES = ["base", "pulumi", "python-deps"]
+
+def sync_requirements():
+    """Copy requirements.txt from the root of the repo into the image context
+    unless it is already there, so the copy's mtime doesn't invalidate the build cache
+    """
+    target = os.path.join(IMAGE_CONTEXT, 'requirements.txt')
+    with open(REQUIREMENTS, 'rb') as source:
+        content = source.read()
+    if os.path.exists(target):
+        with open(target, 'rb') as existing:
+            if existing.read() == content:
+                return
+    with open(target, 'wb') as copy:
+        copy.write(content)
+
+def build_args():
+    """Docker build arguments: the plugin versions manage() installs"""
+    return {f"{name.upper()}_PLUGIN_VERSION": version
+            for name, version in PLUGIN_VERSIONS.items()}
+
+def image_hash():
+    """Hash everything the image is built from. The image is tagged with it, so the
+    tag only changes when the Dockerfile, requirements.txt or plugin versions do
+    """
+    digest = hashlib.sha256()
+    for name in ('Dockerfile', 'requirements.txt'):
+        with open(os.path.join(IMAGE_CONTEXT, name), 'rb') as source:
+            digest.update(hashlib.sha256(source.read()).digest())
+    for name, value in sorted(build_args().items()):
+        digest.update(f"{name}={value}".encode('utf-8'))
+    return digest.hexdigest()[:16]
 
 def get_registry_info(rid):
     """Get registry info (creds and endpoint) so we can build/publish to it."""
@@ -26,6 +61,9 @@ def pulumi_program():
     """Pulumi Program"""
     config = pulumi.Config()
     environment = config.require('environment')
+    # Copy requirements.txt from the root of the repo first - for the Docker image build
+    sync_requirements()
+    tag = image_hash()
     codebuild_image_repo = aws.ecr.Repository(f"codebuild-image-{environment}",
         image_scanning_configuration=aws.ecr.RepositoryImageScanningConfigurationArgs(
             scan_on_push=False,
@@ -67,12 +105,17 @@ def pulumi_program():
     registry = codebuild_image_repo.registry_id.apply(get_registry_info)
 
     ## Docker Image Build and Publish
+    # Every stage is pulled back from ECR as cache, so an unchanged stage isn't rebuilt
     codebuild_image = docker.Image(f"{CUSTOM_IMAGE}-{environment}",
-                    image_name=codebuild_image_repo.repository_url,
-                    build=docker.DockerBuild(context=f'./{CUSTOM_IMAGE}'),
+                    image_name=codebuild_image_repo.repository_url.apply(lambda url: f"{url}:{tag}"),
+                    build=docker.DockerBuild(context=IMAGE_CONTEXT,
+                                             args=build_args(),
+                                             cache_from=docker.CacheFrom(stages=CACHE_STAGES)),
                     registry=registry
                     )
     pulumi.export("codebuild_image", codebuild_image.base_image_name)
+    pulumi.export("codebuild_image_hash", tag)
 
 # Deploy ECR Repo with Docker Image
-stack = manage(args(), os.path.basename(os.getcwd()), pulumi_program)
+if __name__ == "__main__":
+    stack = manage(args(), os.path.basename(os.getcwd()), pulumi_program)
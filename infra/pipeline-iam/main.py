@@ -1,14 +1,24 @@
 import sys
 import os
-import json
 import pulumi
 import pulumi_aws as aws
 
 sys.path.append("../../shared")
-from bootstrap import manage, args, get_config
+from bootstrap import manage, args, get_config, attach_bucket_policies
+from iam_policy import (BUCKET_NAME_MAX, INLINE_POLICY_LIMIT, KMS_KEY_ARN_MAX, bucket_statement,
+                        document, max_size, policy, statement, trust_policy)
 
 # Deploy IAM roles and policies for CodePipeline and CodeBuild projects for each piece of infra
 
+def codepipeline_statements(codepipeline_source_bucket, kms_key_arn):
+    """Permissions of CodePipeline besides the buckets"""
+    return [
+        statement(["codebuild:BatchGetBuilds", "codebuild:BatchGetProjects",
+                   "codebuild:StartBuild"], "*"),
+        statement("kms:*", kms_key_arn),
+        bucket_statement([codepipeline_source_bucket]),
+    ]
+
 def pulumi_program():
     """Pulumi Program"""
     config = pulumi.Config()
@@ -30,187 +40,103 @@ def pulumi_program():
     buckets["pipeline_s3_trail_bucket"] = s3_reference.get_output("pipeline_s3_trail_bucket")
 
     # Create the IAM Assume Roles
-    codepipeline_role = aws.iam.Role(f"codepipelineRole-{environment}", assume_role_policy="""{
-        "Version": "2012-10-17",
-        "Statement": [
-            {
-            "Effect": "Allow",
-            "Principal": {
-                "Service": "codepipeline.amazonaws.com"
-            },
-            "Action": "sts:AssumeRole"
-            }
-        ]
-        }
-    """)
+    codepipeline_role = aws.iam.Role(f"codepipelineRole-{environment}",
+        assume_role_policy=trust_policy("codepipeline.amazonaws.com"))
 
     aws.iam.RolePolicy("codepipelinePolicy",
         role=codepipeline_role.id,
-        policy=pulumi.Output.all(codepipeline_source_bucket=codepipeline_source_bucket,
-                                 kms_key_arn=secrets.get_output("kms_arn"),
-                                ).apply(lambda args: f"""{{
-            "Version": "2012-10-17",
-            "Statement": [
-                {{
-                    "Effect": "Allow",
-                    "Action": [
-                        "codebuild:BatchGetBuilds",
-                        "codebuild:BatchGetProjects",
-                        "codebuild:StartBuild"
-                    ],
-                    "Resource": "*"
-                }},
-                {{
-                    "Effect": "Allow",
-                    "Action": ["kms:*"],
-                    "Resource": "{args['kms_key_arn']}"
-                }},
-                {{
-                    "Effect": "Allow",
-                    "Action": ["s3:*"],
-                    "Resource": [
-                        "arn:aws:s3:::{args['codepipeline_source_bucket']}",
-                        "arn:aws:s3:::{args['codepipeline_source_bucket']}/*"
-                    ]
-                }}
-            ]
-        }}
-    """))
+        policy=policy(codepipeline_statements,
+            codepipeline_source_bucket=codepipeline_source_bucket,
+            kms_key_arn=secrets.get_output("kms_arn")))
+
+    # Grant access to every bucket for CodePipeline, inline in the room codepipelinePolicy leaves
+    attach_bucket_policies(f"codepipelineBucketPolicy-{environment}",
+        {f"codepipelineBucketPolicy-{environment}": codepipeline_role},
+        buckets,
+        INLINE_POLICY_LIMIT - max_size(codepipeline_statements,
+                                       codepipeline_source_bucket=BUCKET_NAME_MAX,
+                                       kms_key_arn=KMS_KEY_ARN_MAX))
 
-    # Grant access to every bucket for CodePipeline
-    for key, value in buckets.items():
-        aws.iam.RolePolicy(f"codepipelinebucketpolicy-{key}",
-            role=codepipeline_role.name,
-            policy=pulumi.Output.all(bucket=value).apply(lambda args: f"""{{
-                "Version": "2012-10-17",
-                "Statement": [
-                {{
-                    "Effect": "Allow",
-                    "Action": ["s3:*"],
-                    "Resource": [
-                        "arn:aws:s3:::{args['bucket']}",
-                        "arn:aws:s3:::{args['bucket']}/*"
-                    ]
-                }}
-                ]
-            }}
-            """))
+    # Permissions every CodeBuild role has besides the buckets
+    codebuild_policy = document(
+        statement(["logs:CreateLogGroup", "logs:CreateLogStream", "logs:PutLogEvents"], "*"),
+        statement([
+            "ec2:CreateNetworkInterface",
+            "ec2:CreateNetworkInterfacePermission",
+            "ec2:DescribeDhcpOptions",
+            "ec2:DescribeNetworkInterfaces",
+            "ec2:DeleteNetworkInterface",
+            "ec2:DescribeSubnets",
+            "ec2:DescribeSecurityGroups",
+            "ec2:DescribeVpcs"
+        ], "*"),
+        bucket_statement(["my-pulumi-state"]),
+        statement("kms:*",
+            "arn:aws:kms:us-east-1:161101091064:key/4ed7e926-9130-4259-a8b4-d2e033d31b5f"),
+        statement([
+            "iam:ListRolePolicies",
+            "iam:GetRole",
+            "iam:GetRolePolicy",
+            "iam:ListAttachedRolePolicies",
+            "iam:CreateRole",
+            "iam:UpdateRole",
+            "iam:DeleteRole",
+            "iam:PutRolePolicy",
+            "iam:DeleteRolePolicy",
+            "iam:PassRole",
+            # Bucket access that doesn't fit inline goes to managed policies
+            "iam:CreatePolicy",
+            "iam:DeletePolicy",
+            "iam:GetPolicy",
+            "iam:GetPolicyVersion",
+            "iam:ListPolicyVersions",
+            "iam:CreatePolicyVersion",
+            "iam:DeletePolicyVersion",
+            "iam:AttachRolePolicy",
+            "iam:DetachRolePolicy"
+        ], "*"),
+        statement("codebuild:BatchGetProjects", "*"),
+        statement([
+            "events:*",
+            "secretsmanager:*",
+            "codepipeline:*",
+            "lambda:*",
+            "apigateway:*",
+            "sqs:*",
+            "ec2:*",
+            "cloudtrail:*"
+        ], "*"))
     # Grant access to codebuild projects
+    codebuild_roles = {}
     for project_name in infra_projects:
-        codebuild_role = aws.iam.Role(f"codebuildRole-{project_name}-{environment}", assume_role_policy="""{
-                "Version": "2012-10-17",
-                "Statement": [
-                    {
-                    "Effect": "Allow",
-                    "Principal": {
-                        "Service": "codebuild.amazonaws.com"
-                    },
-                    "Action": "sts:AssumeRole"
-                    }
-                ]
-                }
-            """)
+        codebuild_role = aws.iam.Role(f"codebuildRole-{project_name}-{environment}",
+            assume_role_policy=trust_policy("codebuild.amazonaws.com"))
         pulumi.export(f"codebuild_role_{project_name}_arn", codebuild_role.arn)
         pulumi.export(f"codebuild_role_{project_name}_id", codebuild_role.id)
 
-        for key, value in buckets.items():
-            aws.iam.RolePolicy(f"codeBuildBucketRolePolicy-{project_name}-{key}-{environment}",
-                role=codebuild_role.name,
-                policy=pulumi.Output.all(bucket=value).apply(lambda args: f"""{{
-                    "Version": "2012-10-17",
-                    "Statement": [
-                    {{
-                        "Effect": "Allow",
-                        "Action": ["s3:*"],
-                        "Resource": [
-                            "arn:aws:s3:::{args['bucket']}",
-                            "arn:aws:s3:::{args['bucket']}/*"
-                        ]
-                    }}
-                    ]
-                }}
-                """))
+        codebuild_roles[f"codeBuildBucketRolePolicy-{project_name}-{environment}"] = codebuild_role
         aws.iam.RolePolicy(f"codeBuildRolePolicy-{project_name}-{environment}",
             role=codebuild_role.name,
-            policy=json.dumps({
-                "Version": "2012-10-17",
-                "Statement": [{
-                    "Effect": "Allow",
-                    "Resource": ["*"],
-                    "Action": [
-                        "logs:CreateLogGroup",
-                        "logs:CreateLogStream",
-                        "logs:PutLogEvents"
-                    ]
-                },
-                {
-                    "Effect": "Allow",
-                    "Resource": "*",
-                    "Action": [
-                        "ec2:CreateNetworkInterface",
-                        "ec2:CreateNetworkInterfacePermission",
-                        "ec2:DescribeDhcpOptions",
-                        "ec2:DescribeNetworkInterfaces",
-                        "ec2:DeleteNetworkInterface",
-                        "ec2:DescribeSubnets",
-                        "ec2:DescribeSecurityGroups",
-                        "ec2:DescribeVpcs"
-                    ]
-                },
-                {
-                    "Effect": "Allow",
-                    "Action": ["s3:*"],
-                    "Resource": [
-                    "arn:aws:s3:::my-pulumi-state",
-                    "arn:aws:s3:::my-pulumi-state/*"
-                    ]
-                },
-                {
-                    "Effect": "Allow",
-                    "Action": ["kms:*"],
-                    "Resource": [
-                    "arn:aws:kms:us-east-1:161101091064:key/4ed7e926-9130-4259-a8b4-d2e033d31b5f"
-                    ]
-                },
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "iam:ListRolePolicies",
-                        "iam:GetRole",
-                        "iam:GetRolePolicy",
-                        "iam:ListAttachedRolePolicies",
-                        "iam:CreateRole",
-                        "iam:UpdateRole",
-                        "iam:DeleteRole",
-                        "iam:PutRolePolicy",
-                        "iam:PassRole"
-                    ],
-                    "Resource": "*"
-                },
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "codebuild:BatchGetProjects"
-                    ],
-                    "Resource": "*"
-                },
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "events:*",
-                        "secretsmanager:*",
-                        "codepipeline:*",
-                        "lambda:*",
-                        "apigateway:*",
-                        "ec2:*",
-                        "cloudtrail:*"
-                    ],
-                    "Resource": "*"
-                }
-                ]
-            }))
+            policy=codebuild_policy)
+    # The same bucket policies for every CodeBuild role, inline next to codebuild_policy
+    attach_bucket_policies(f"codeBuildBucketPolicy-{environment}", codebuild_roles, buckets,
+                           INLINE_POLICY_LIMIT - len(codebuild_policy))
+
+    # The Detect-Changes stage only reads the source and writes to the pipeline bucket
+    detect_changes_role = aws.iam.Role(f"codebuildRole-detect-changes-{environment}",
+        assume_role_policy=trust_policy("codebuild.amazonaws.com"))
+    aws.iam.RolePolicy(f"codeBuildRolePolicy-detect-changes-{environment}",
+        role=detect_changes_role.name,
+        policy=policy(lambda bucket: [
+                statement(["logs:CreateLogGroup", "logs:CreateLogStream", "logs:PutLogEvents"],
+                          "*"),
+                bucket_statement([bucket], ["s3:GetObject", "s3:PutObject", "s3:ListBucket"]),
+            ],
+            bucket=buckets["codepipeline_bucket_id"]))
+    pulumi.export("codebuild_role_detect-changes_arn", detect_changes_role.arn)
 
     pulumi.export("codepipeline_role_arn", codepipeline_role.arn)
     pulumi.export("codepipeline_role_id", codepipeline_role.id)
 
-stack = manage(args(), os.path.basename(os.getcwd()), pulumi_program)
+if __name__ == "__main__":
+    stack = manage(args(), os.path.basename(os.getcwd()), pulumi_program)
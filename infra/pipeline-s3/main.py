@@ -68,4 +68,5 @@ def pulumi_program():
     pulumi.export('codepipeline_source_bucket',codepipeline_source_bucket.id)
     pulumi.export('pipeline_s3_trail_bucket',pipeline_s3_trail_bucket.id)
 
-stack = manage(args(), os.path.basename(os.getcwd()), pulumi_program)
+if __name__ == "__main__":
+    stack = manage(args(), os.path.basename(os.getcwd()), pulumi_program)
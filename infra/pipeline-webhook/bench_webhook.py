@@ -0,0 +1,154 @@
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+# Measure the cold start of the webhook Lambda locally:
+#    * import time of lambda/webhook.py in a fresh interpreter
+#    * latency of the first and following ingress invocations, with an in-process queue,
+#      and of the worker draining that queue, with S3 stubbed out
+#    * rendering a functional buildspec: cached template vs serializing per request
+#    * S3 client construction (the part of the first real invocation that is deferred)
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lambda")
+SECRET = b"bench"
+IMPORT_SNIPPET = ("import time; start = time.perf_counter(); import webhook; "
+                  "print(time.perf_counter() - start)")
+
+class StubS3:
+    """Stands in for the S3 client so invocations don't leave the machine"""
+
+    class exceptions: # pylint: disable=invalid-name,too-few-public-methods
+        """Mirrors client.exceptions"""
+        class ClientError(Exception):
+            """Raised for missing objects"""
+
+    def __init__(self):
+        self.puts = 0
+
+    def head_object(self, **kwargs):
+        """Every object is missing"""
+        raise self.exceptions.ClientError(kwargs['Key'])
+
+    def put_object(self, **kwargs):
+        """Record a put"""
+        self.puts += len(kwargs['Body'])
+
+def sample_event():
+    """An open pull_request event shaped like a signed GitHub delivery"""
+    body = {
+        "action": "synchronize",
+        "number": 1,
+        "pull_request": {
+            "updated_at": "2021-05-01T12:00:00Z",
+            "merged_at": None,
+            "head": {"label": "kjenney:feature", "sha": "0" * 40},
+            "base": {"label": "kjenney:main"},
+            "body": "x" * 20000,
+        },
+    }
+    payload = json.dumps(body)
+    signature = hmac.new(SECRET, payload.encode('utf-8'), hashlib.sha256).hexdigest()
+    return {"headers": {"x-hub-signature-256": f"sha256={signature}"}, "body": payload}
+
+def import_times(runs):
+    """Seconds taken to import the handler in fresh interpreters"""
+    times = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], cwd=LAMBDA_DIR,
+                                check=True, capture_output=True, text=True).stdout
+        times.append(float(output.strip().splitlines()[-1]))
+    return times
+
+def invocation_times(runs):
+    """Seconds taken by the first and following invocations of the ingress handler,
+    and by the worker for all of them
+    """
+    sys.path.insert(0, LAMBDA_DIR)
+    import webhook # pylint: disable=import-outside-toplevel
+    webhook._clients['s3'] = StubS3() # pylint: disable=protected-access
+    queue = webhook.LocalQueue()
+    webhook._clients['queue'] = queue.send # pylint: disable=protected-access
+    webhook._clients['webhook_secret'] = SECRET # pylint: disable=protected-access
+    context = SimpleNamespace(log_stream_name="bench")
+    event = sample_event()
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        webhook.ingress(event, context)
+        times.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    queue.drain(context)
+    return times, time.perf_counter() - start
+
+def client_times():
+    """Seconds taken to import boto3 and build an S3 client and, for comparison,
+    an S3 resource, each in a fresh interpreter
+    """
+    times = []
+    for factory in ("client", "resource"):
+        snippet = ("import time; start = time.perf_counter(); import boto3; "
+                   f"boto3.{factory}('s3', region_name='us-east-1'); "
+                   "print(time.perf_counter() - start)")
+        result = subprocess.run([sys.executable, "-c", snippet],
+                                check=False, capture_output=True, text=True)
+        if result.returncode != 0:
+            return None
+        times.append(float(result.stdout.strip().splitlines()[-1]))
+    return times
+
+def render_times(runs):
+    """Seconds per functional buildspec rendered from the cached template, by to_yaml
+    and by yaml.dump (the original per-request path, when PyYAML is installed)
+    """
+    sys.path.insert(0, LAMBDA_DIR)
+    import webhook # pylint: disable=import-outside-toplevel
+    paths = {
+        "template": lambda: webhook.FUNCTIONAL_TEMPLATE.render(pr_number=1, branch="feature",
+                                                               sha="0" * 40),
+        "to_yaml": lambda: webhook.to_yaml(
+            webhook.buildspec_functional("dev", "bucket", 1, "feature", "0" * 40)).encode('utf-8'),
+    }
+    try:
+        import yaml # pylint: disable=import-outside-toplevel
+        paths["yaml.dump"] = lambda: yaml.dump(
+            webhook.buildspec_functional("dev", "bucket", 1, "feature", "0" * 40),
+            indent=4, default_flow_style=False)
+    except ImportError:
+        pass
+    times = {}
+    for name, render in paths.items():
+        start = time.perf_counter()
+        for _ in range(runs):
+            render()
+        times[name] = (time.perf_counter() - start) / runs
+    return times
+
+def main():
+    """Print the benchmark results"""
+    parser = argparse.ArgumentParser(description='Benchmark the webhook Lambda cold start.')
+    parser.add_argument('-r', '--runs', type=int, required=False, default=5)
+    arguments = parser.parse_args()
+
+    imports = import_times(arguments.runs)
+    print(f"import: min {min(imports) * 1000:.2f}ms, max {max(imports) * 1000:.2f}ms")
+    invocations, drain = invocation_times(arguments.runs)
+    print(f"first ingress invocation: {invocations[0] * 1000:.2f}ms")
+    if len(invocations) > 1:
+        print(f"warm ingress invocation: {min(invocations[1:]) * 1000:.2f}ms")
+    print(f"worker for {len(invocations)} messages: {drain * 1000:.2f}ms")
+    for name, seconds in render_times(arguments.runs * 1000).items():
+        print(f"buildspec via {name}: {seconds * 1000000:.2f}us")
+    clients = client_times()
+    if clients:
+        print(f"boto3 s3 client: {clients[0] * 1000:.2f}ms, "
+              f"s3 resource: {clients[1] * 1000:.2f}ms")
+    else:
+        print("boto3 isn't installed, skipping S3 client construction")
+
+main()
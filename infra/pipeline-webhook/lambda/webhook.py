@@ -1,19 +1,259 @@
+import base64
+import functools
+import hashlib
+import hmac
 import json
 import os
+import re
+import time
+from contextlib import contextmanager
 from datetime import datetime
-import boto3
-import yaml
 
-s3 = boto3.resource(
-    's3',
-    region_name='us-east-1'
-)
+# Only the standard library is imported at module load. boto3 is imported the
+# first time a client is needed, and buildspecs are serialized by to_yaml, so
+# PyYAML isn't needed at all.
 
 environment = os.environ.get('environment')
-dt1 = datetime.now()
+# legacy: write the buildspec to S3, where CloudTrail and EventBridge pick it up
+# direct: call StartBuild with the buildspec inline
+trigger_mode = os.environ.get('trigger_mode', 'legacy')
+_clients = {}
 
-def buildspec_functional(environ, branch, sha):
-    """Create the CodeBuild Job that will be used for Functional Testing"""
+# Pull request actions that need a build. Everything else (labeled, edited,
+# assigned, review_requested, ...) is acknowledged and dropped.
+FUNCTIONAL_ACTIONS = {'opened', 'reopened', 'synchronize'}
+MERGE_ACTIONS = {'closed'}
+# Merges delivered more than this many seconds after merging are redeliveries and
+# aren't built. Checked on receipt, so time spent in the queue doesn't count
+MERGE_WINDOW = 30
+# Seconds a delivery ID, and a (branch, sha) build, are remembered for
+DELIVERY_TTL = 24 * 60 * 60
+DEDUP_WINDOW = int(os.environ.get('dedup_window_seconds', '600'))
+# Functional buildspecs are written to prs/<number>/<sha>/buildspec.yml, and the
+# newest sha of each pull request to heads/<number>, with the pull request's
+# updated_at as metadata. Only prs/ is logged by CloudTrail, so the markers
+# never start a build.
+PR_PREFIX = 'prs/'
+HEAD_PREFIX = 'heads/'
+
+# Deliveries larger than this are rejected before they are verified or parsed
+MAX_BODY_BYTES = int(os.environ.get('max_body_bytes', str(1024 * 1024)))
+# The pull_request fields a build needs. The rest of the payload is skipped, see scan_json
+PULL_REQUEST_FIELDS = {
+    'action': None,
+    'number': None,
+    'pull_request': {
+        'updated_at': None,
+        'merged_at': None,
+        'merge_commit_sha': None,
+        'head': {'label': None, 'sha': None},
+        'base': {'label': None},
+    },
+}
+_JSON_WHITESPACE = re.compile(r'\s*')
+_JSON_DECODER = json.JSONDecoder()
+
+# Strings that YAML reads back as plain strings when written unquoted
+PLAIN_SCALAR = re.compile(r'[A-Za-z_/][\w./-]*')
+YAML_KEYWORDS = {'y', 'n', 'yes', 'no', 'on', 'off', 'true', 'false', 'null'}
+
+def client(service):
+    """Return the low-level client for service, creating it on first use"""
+    if service not in _clients:
+        import boto3 # pylint: disable=import-outside-toplevel
+        _clients[service] = boto3.client(service,
+                                         region_name=os.environ.get('AWS_REGION', 'us-east-1'))
+    return _clients[service]
+
+def s3_client():
+    """Return the low-level S3 client, creating it on first use"""
+    return client('s3')
+
+def webhook_secret():
+    """Return the webhook signing secret, read once per container
+
+    The secret is read from Secrets Manager (webhook_secret_id), or from the
+    webhook_secret environment variable for local runs
+    """
+    if 'webhook_secret' not in _clients:
+        secret_id = os.environ.get('webhook_secret_id')
+        if secret_id:
+            secret = client('secretsmanager').get_secret_value(SecretId=secret_id)['SecretString']
+        else:
+            secret = os.environ.get('webhook_secret', '')
+        _clients['webhook_secret'] = secret.encode('utf-8')
+    return _clients['webhook_secret']
+
+def verify_signature(payload, signature):
+    """Check an X-Hub-Signature-256 header against the payload bytes"""
+    secret = webhook_secret()
+    if not secret or not signature or not signature.startswith('sha256='):
+        return False
+    expected = 'sha256=' + hmac.new(secret, payload, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+def scan_json(text, fields, start=0, top=True):
+    """Read the fields of a JSON object without walking the rest of it
+
+    fields maps keys to None (decode the value) or to the fields of a nested
+    object. Other values are skipped by the C decoder and thrown away. Returns
+    the values found and the index after the object. The top-level object isn't
+    read past the last field it needs, so repository and sender are never decoded.
+    """
+    values = {}
+    pos = _JSON_WHITESPACE.match(text, start).end()
+    if not text.startswith('{', pos):
+        raise ValueError(f'Expected a JSON object at position {pos}')
+    pos = _JSON_WHITESPACE.match(text, pos + 1).end()
+    while not text.startswith('}', pos):
+        if top and len(values) == len(fields):
+            return values, pos
+        if not text.startswith('"', pos):
+            raise ValueError(f'Expected a key at position {pos}')
+        key, pos = json.decoder.scanstring(text, pos + 1)
+        pos = _JSON_WHITESPACE.match(text, pos).end()
+        if not text.startswith(':', pos):
+            raise ValueError(f'Expected ":" at position {pos}')
+        pos = _JSON_WHITESPACE.match(text, pos + 1).end()
+        if isinstance(fields.get(key), dict) and text.startswith('{', pos):
+            values[key], pos = scan_json(text, fields[key], pos, top=False)
+        else:
+            value, pos = _JSON_DECODER.raw_decode(text, pos)
+            if key in fields:
+                values[key] = value
+        pos = _JSON_WHITESPACE.match(text, pos).end()
+        if text.startswith(',', pos):
+            pos = _JSON_WHITESPACE.match(text, pos + 1).end()
+        elif not text.startswith('}', pos):
+            raise ValueError(f'Expected "," or "}}" at position {pos}')
+    return values, pos + 1
+
+class MemoryDedupStore:
+    """Remembers claimed keys for the lifetime of the container"""
+
+    def __init__(self):
+        self.claims = {}
+
+    def claim(self, key, ttl):
+        """Claim key for ttl seconds. Returns False if it is already claimed"""
+        now = time.time()
+        expires = self.claims.get(key)
+        if expires is not None and expires > now:
+            return False
+        self.claims[key] = now + ttl
+        return True
+
+    def release(self, key):
+        """Give up a claim, so a retry of the same work isn't dropped"""
+        self.claims.pop(key, None)
+
+class FileDedupStore(MemoryDedupStore):
+    """Keeps claims in a JSON file, for local runs and tests"""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        if os.path.exists(path):
+            with open(path, mode='r', encoding='utf-8') as claims_file:
+                self.claims = json.load(claims_file)
+
+    def _save(self):
+        now = time.time()
+        self.claims = {key: expires for key, expires in self.claims.items() if expires > now}
+        with open(self.path, mode='w', encoding='utf-8') as claims_file:
+            json.dump(self.claims, claims_file)
+
+    def claim(self, key, ttl):
+        claimed = super().claim(key, ttl)
+        if claimed:
+            self._save()
+        return claimed
+
+    def release(self, key):
+        super().release(key)
+        self._save()
+
+class S3DedupStore:
+    """Keeps claims as marker objects under dedup/ in a bucket, shared by every container
+
+    Best effort: two containers handling the same key at the same instant can
+    both claim it.
+    """
+
+    def __init__(self, bucket, prefix='dedup/'):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _key(self, key):
+        return self.prefix + hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def claim(self, key, ttl):
+        """Claim key for ttl seconds. Returns False if it is already claimed"""
+        try:
+            marker = s3_client().head_object(Bucket=self.bucket, Key=self._key(key))
+            if time.time() - marker['LastModified'].timestamp() < ttl:
+                return False
+        except s3_client().exceptions.ClientError:
+            pass
+        s3_client().put_object(Bucket=self.bucket, Key=self._key(key), Body=key.encode('utf-8'))
+        return True
+
+    def release(self, key):
+        """Give up a claim, so a retry of the same work isn't dropped"""
+        s3_client().delete_object(Bucket=self.bucket, Key=self._key(key))
+
+def dedup_store():
+    """Return the store selected by the dedup_store environment variable:
+    memory (default), file:<path> or s3 (markers in the dedup_bucket bucket)
+    """
+    if 'dedup' not in _clients:
+        kind = os.environ.get('dedup_store', 'memory')
+        if kind.startswith('file:'):
+            _clients['dedup'] = FileDedupStore(kind[len('file:'):])
+        elif kind == 's3':
+            _clients['dedup'] = S3DedupStore(os.environ.get('dedup_bucket'))
+        else:
+            _clients['dedup'] = MemoryDedupStore()
+    return _clients['dedup']
+
+def _yaml_scalar(value):
+    """Write a scalar as plain YAML when that is unambiguous, otherwise double quoted"""
+    if isinstance(value, str):
+        if PLAIN_SCALAR.fullmatch(value) and value.lower() not in YAML_KEYWORDS:
+            return value
+        # JSON strings are valid YAML double-quoted scalars
+        return json.dumps(value)
+    return json.dumps(value)
+
+def to_yaml(data, indent=4, level=0):
+    """Serialize nested dicts, lists and scalars to block-style YAML"""
+    pad = ' ' * (indent * level)
+    lines = []
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if isinstance(value, (dict, list)) and value:
+                lines.append(f"{pad}{_yaml_scalar(key)}:")
+                lines.append(to_yaml(value, indent, level + 1))
+            else:
+                lines.append(f"{pad}{_yaml_scalar(key)}: {_yaml_scalar(value)}")
+    else:
+        for value in data:
+            if isinstance(value, (dict, list)) and value:
+                lines.append(f"{pad}-")
+                lines.append(to_yaml(value, indent, level + 1))
+            else:
+                lines.append(f"{pad}- {_yaml_scalar(value)}")
+    return '\n'.join(lines)
+
+def buildspec_functional(environ, bucket, pr_number, branch, sha):
+    """Create the CodeBuild Job that will be used for Functional Testing
+
+    The build reads heads/<number> first and does nothing when a newer commit
+    was pushed to the pull request while it was queued.
+    """
+    head = (f"python -c \"import boto3; print(boto3.client('s3').get_object("
+            f"Bucket='{bucket}', Key='{HEAD_PREFIX}{pr_number}')['Body'].read().decode())\"")
+    latest = f'[ "$HEAD_SHA" = "{sha}" ]'
     return {'version': '0.2',
             'env': {
                 'secrets-manager': {
@@ -23,13 +263,14 @@ def buildspec_functional(environ, branch, sha):
             'phases': {
                 'pre_build': {
                     'commands': [
-                        f"git clone --branch {branch} https://$GITHUB_TOKEN@github.com/kjenney/pulumi-bootstrap.git"
+                        f"export HEAD_SHA=$({head} || echo {sha})",
+                        f"{latest} || echo Superseded by $HEAD_SHA. Skipping",
+                        f"if {latest}; then git clone --branch {branch} https://$GITHUB_TOKEN@github.com/kjenney/pulumi-bootstrap.git; fi"
                     ]
                 },
                 'build': {
                     'commands': [
-                        'cd pulumi-bootstrap',
-                        f"./github/check_status.sh $GITHUB_TOKEN {sha}"
+                        f"if {latest}; then cd pulumi-bootstrap && ./github/check_status.sh $GITHUB_TOKEN {sha}; fi"
                     ]
                 }
             }}
@@ -64,44 +305,292 @@ def buildspec_main(environ):
             }
         }
 
+class BuildspecTemplate: # pylint: disable=too-few-public-methods
+    """A buildspec serialized once, with per-request fields substituted as bytes
+
+    The buildspec is rendered with placeholder values, split around them and
+    kept as byte fragments. render() only joins the fragments with the
+    serialized request values.
+    """
+
+    def __init__(self, build, fields):
+        placeholders = {field: f"@@{field}@@" for field in fields}
+        text = to_yaml(build(**placeholders))
+        self.parts = []
+        self.fields = []
+        for piece in re.split(r'@@(\w+)@@', text):
+            if len(self.parts) == len(self.fields):
+                self.parts.append(piece.encode('utf-8'))
+            else:
+                self.fields.append(piece)
+        for field in self.fields:
+            if field not in fields:
+                raise ValueError(f"Unknown buildspec field {field}")
+
+    def render(self, **values):
+        """Return the buildspec as bytes with values substituted"""
+        # "@@" never appears in a plain scalar, so placeholders always sit inside
+        # double-quoted scalars and values are escaped the same way
+        escaped = {field: json.dumps(str(value))[1:-1].encode('utf-8')
+                   for field, value in values.items()}
+        output = [self.parts[0]]
+        for field, part in zip(self.fields, self.parts[1:]):
+            output.append(escaped[field])
+            output.append(part)
+        return b''.join(output)
+
 def compare_times(one_time, another_time):
     """Function to compare one time to another time and return the difference in seconds"""
     another_time_dt = datetime.strptime(another_time, "%Y-%m-%dT%H:%M:%SZ")
-    diff =  one_time - another_time_dt
-    return diff.seconds
+    diff = one_time - another_time_dt
+    return int(diff.total_seconds())
+
+# Rendered once per container
+FUNCTIONAL_TEMPLATE = BuildspecTemplate(
+    lambda pr_number, branch, sha: buildspec_functional(
+        environment, os.environ.get('s3_bucket_functional'), pr_number, branch, sha),
+    ('pr_number', 'branch', 'sha'))
+MAIN_BUILDSPEC = to_yaml(buildspec_main(environment)).encode('utf-8')
 
-def handler(event, context):
-    """Gets PR events
-    Check to see if the PR is open
-    Write an object to S3 which triggers one of two jobs
+def header(event, name):
+    """Read a request header whatever its case (API Gateway v2 lowercases them)"""
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+@contextmanager
+def build_claim(build_key):
+    """Claim build_key for DEDUP_WINDOW, yielding whether the claim succeeded
+
+    The claim is released if the block raises, so a retry isn't dropped
     """
-    print("CloudWatch log stream name:", context.log_stream_name)
-    body = event['body']
-    body = json.loads(body)
-    # If the Pull Request was merged within the last 30 seconds let's assume we want to build it
-    if body['pull_request']['merged_at']:
-        if compare_times(datetime.utcnow(), body['pull_request']['merged_at']) < 30:
-            if body['pull_request']['base']['label'] == 'kjenney:main':
-                print('Copy buildspec to S3 bucket to kick off CodeBuild for Main Clone')
-                s3_bucket_main = os.environ.get('s3_bucket_main')
-                buildspec = buildspec_main(environment)
-                content=yaml.dump(buildspec, indent=4, default_flow_style=False)
-                s3.Object(s3_bucket_main, 'buildspec.yml').put(Body=content)
-            else:
-                print('Pull Request was not merged into main. Aborting')
-        else:
-            print('Pull Request was merged more than 30 seoconds ago. Aborting')
+    store = dedup_store()
+    if not store.claim(build_key, DEDUP_WINDOW):
+        print(f"{build_key} already built within {DEDUP_WINDOW}s. Skipping")
+        yield False
+        return
+    try:
+        yield True
+    except Exception:
+        store.release(build_key)
+        raise
+
+def trigger_build(content, bucket, key, project):
+    """Start a build with content as its buildspec
+
+    In direct mode project is started with content as its buildspec. Otherwise
+    content is written to bucket/key and the S3 event starts the build.
+    """
+    if trigger_mode == 'direct':
+        print(f"Start CodeBuild project {project}")
+        # The buildspec clones the repository itself, at the branch and sha it was rendered for
+        client('codebuild').start_build(projectName=project,
+                                        sourceTypeOverride='NO_SOURCE',
+                                        buildspecOverride=content.decode('utf-8'))
     else:
-        print('Copy buildspec to S3 bucket to kick off CodeBuild for Functional Testing')
-        s3_bucket_functional = os.environ.get('s3_bucket_functional')
-        # Branch metadata includes origin and branch - splitting the string to only include the branch
-        branch = body['pull_request']['head']['label'].split(':')[1]
-        # Get the Commit SHA for reporting the status once the build has completed
-        sha = body['pull_request']['head']['sha']
-        buildspec = buildspec_functional(environment, branch, sha)
-        content=yaml.dump(buildspec, indent=4, default_flow_style=False)
-        s3.Object(s3_bucket_functional, 'buildspec.yml').put(Body=content)
+        print(f"Copy buildspec to S3 bucket {bucket} to kick off CodeBuild")
+        s3_client().put_object(Bucket=bucket, Key=key, Body=content)
+
+def start_build(build_key, content, bucket, key, project):
+    """Start a build unless the same build was started within DEDUP_WINDOW"""
+    with build_claim(build_key) as fresh:
+        if fresh:
+            trigger_build(content, bucket, key, project)
+
+def mark_head(bucket, pr_number, sha, updated_at):
+    """Record sha as the newest commit of a pull request, unless a newer one is recorded
+
+    Markers only move forward: deliveries handled out of order compare the pull
+    request's updated_at (ISO 8601, so it sorts as text). Returns False when a
+    newer commit is already recorded.
+    """
+    key = f"{HEAD_PREFIX}{pr_number}"
+    updated_at = updated_at or ''
+    try:
+        marker = s3_client().head_object(Bucket=bucket, Key=key)
+        if marker.get('Metadata', {}).get('updated-at', '') > updated_at:
+            return False
+    except s3_client().exceptions.ClientError:
+        pass
+    s3_client().put_object(Bucket=bucket, Key=key, Body=sha.encode('utf-8'),
+                           Metadata={'updated-at': updated_at})
+    return True
+
+def build_main(pull_request):
+    """Start the main build if the Pull Request was merged into main
+
+    accept only queues merges delivered within MERGE_WINDOW of merging, and the
+    main:<merge_commit_sha> claim drops redeliveries of the same merge
+    """
+    if pull_request['base'] != 'kjenney:main':
+        print('Pull Request was not merged into main. Aborting')
+        return
+    start_build(f"main:{pull_request['merge_commit_sha']}", MAIN_BUILDSPEC,
+                os.environ.get('s3_bucket_main'), 'buildspec.yml',
+                os.environ.get('codebuild_project_main'))
+
+def build_functional(pull_request):
+    """Start the functional testing build unless this commit was just built"""
+    # Branch metadata includes origin and branch - splitting the string to only include the branch
+    branch = pull_request['head'].split(':')[1]
+    # Get the Commit SHA for reporting the status once the build has completed
+    sha = pull_request['sha']
+    pr_number = pull_request['number']
+    bucket = os.environ.get('s3_bucket_functional')
+    with build_claim(f"build:{branch}:{sha}") as fresh:
+        if not fresh:
+            return
+        # Mark the newest commit before writing its buildspec, so builds queued for
+        # older pushes to the same pull request skip themselves
+        if not mark_head(bucket, pr_number, sha, pull_request.get('updated_at')):
+            print(f"A newer commit than {sha} was pushed to #{pr_number}. Skipping")
+            return
+        trigger_build(FUNCTIONAL_TEMPLATE.render(pr_number=pr_number, branch=branch, sha=sha),
+                      bucket, f"{PR_PREFIX}{pr_number}/{sha}/buildspec.yml",
+                      os.environ.get('codebuild_project_functional'))
+
+def sqs_send(url, message):
+    """Send a message to the SQS queue between the ingress and worker functions"""
+    client('sqs').send_message(QueueUrl=url, MessageBody=json.dumps(message))
+
+class LocalQueue:
+    """An in-process stand-in for the SQS queue, for local runs and tests"""
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, message):
+        """Enqueue a message"""
+        self.messages.append(json.dumps(message))
+
+    def drain(self, context, batch_size=10):
+        """Hand every queued message to worker in SQS-shaped batches
+
+        Returns the message IDs the worker reported as failed
+        """
+        failures = []
+        while self.messages:
+            batch, self.messages = self.messages[:batch_size], self.messages[batch_size:]
+            event = {'Records': [{'messageId': str(index), 'body': body}
+                                 for index, body in enumerate(batch)]}
+            failures += [failure['itemIdentifier']
+                         for failure in worker(event, context)['batchItemFailures']]
+        return failures
+
+def work_queue():
+    """Return the function that enqueues a message: sqs_send to the queue named by
+    the queue_url environment variable, or the send of a LocalQueue
+    """
+    if 'queue' not in _clients:
+        url = os.environ.get('queue_url')
+        _clients['queue'] = functools.partial(sqs_send, url) if url else LocalQueue().send
+    return _clients['queue']
+
+def summarize(body):
+    """Keep only the pull request fields the worker needs, so messages stay small"""
+    pull_request = body['pull_request']
+    return {'action': body.get('action'),
+            'number': body.get('number'),
+            'head': pull_request['head']['label'],
+            'sha': pull_request['head']['sha'],
+            'base': pull_request['base']['label'],
+            'updated_at': pull_request.get('updated_at'),
+            'merged_at': pull_request.get('merged_at'),
+            'merge_commit_sha': pull_request.get('merge_commit_sha')}
+
+def read_payload(event):
+    """Return the raw payload bytes, or None when it is larger than MAX_BODY_BYTES
+
+    The size is checked on the encoded body, before anything is decoded
+    """
+    body = event.get('body') or ''
+    encoded = event.get('isBase64Encoded', False)
+    if len(body) > (MAX_BODY_BYTES * 4 // 3 + 4 if encoded else MAX_BODY_BYTES):
+        return None
+    payload = base64.b64decode(body) if encoded else body.encode('utf-8')
+    return payload if len(payload) <= MAX_BODY_BYTES else None
+
+def accept(event):
+    """Authenticate, validate and filter a delivery, and enqueue it if it needs a build
+
+    Returns an HTTP status code and a short description of what was done
+    """
+    payload = read_payload(event)
+    if payload is None:
+        return 413, 'too large'
+    if not verify_signature(payload, header(event, 'x-hub-signature-256')):
+        return 401, 'bad signature'
+    if header(event, 'x-github-event') not in (None, 'pull_request'):
+        return 202, 'ignored event'
+    body, _ = scan_json(payload.decode('utf-8'), PULL_REQUEST_FIELDS)
+    pull_request = summarize(body)
+    action = pull_request['action']
+    merged = bool(pull_request['merged_at'])
+    if not (action in FUNCTIONAL_ACTIONS or (action in MERGE_ACTIONS and merged)):
+        print(f"Ignoring pull_request action {action}")
+        return 202, 'ignored action'
+    if merged and compare_times(datetime.utcnow(), pull_request['merged_at']) >= MERGE_WINDOW:
+        print(f"Pull Request was merged more than {MERGE_WINDOW} seconds ago. Ignoring")
+        return 202, 'stale merge'
+    send = work_queue()
+    send({'delivery': header(event, 'x-github-delivery'),
+                       'pull_request': pull_request})
+    return 202, 'queued'
+
+def process(message):
+    """Deduplicate a queued delivery, then start the build it asks for
+
+    Returns a short description of what was done
+    """
+    store = dedup_store()
+    delivery = message.get('delivery')
+    if delivery and not store.claim(f"delivery:{delivery}", DELIVERY_TTL):
+        print(f"Delivery {delivery} already processed")
+        return 'duplicate delivery'
+    pull_request = message['pull_request']
+    try:
+        if pull_request['merged_at']:
+            build_main(pull_request)
+        else:
+            build_functional(pull_request)
+    except Exception:
+        # Let the queue redeliver
+        if delivery:
+            store.release(f"delivery:{delivery}")
+        raise
+    return 'processed'
+
+def ingress(event, context):
+    """Gets PR events from API Gateway
+    Reject oversized and unsigned deliveries before parsing them
+    Drop irrelevant actions and queue the rest for the worker
+    Answer with a small body whatever the size of the payload
+    """
+    print("CloudWatch log stream name:", context.log_stream_name)
+    try:
+        status, result = accept(event)
+    except (KeyError, TypeError, ValueError) as exc:
+        print(f"Rejecting malformed delivery: {exc!r}")
+        status, result = 400, 'malformed'
+    print(result)
     return {
-        "statusCode": 200,
-        "body": json.dumps(event)
+        "statusCode": status,
+        "body": json.dumps({"status": result})
     }
+
+def worker(event, context):
+    """Gets batches of queued PR events from SQS
+    Drop duplicate deliveries
+    Start one of two jobs, directly or by writing an object to S3
+    Report the messages that failed so only they are retried
+    """
+    print("CloudWatch log stream name:", context.log_stream_name)
+    failures = []
+    for record in event['Records']:
+        try:
+            print(process(json.loads(record['body'])))
+        except Exception as exc: # pylint: disable=broad-except
+            print(f"Message {record['messageId']} failed: {exc!r}")
+            failures.append({'itemIdentifier': record['messageId']})
+    return {'batchItemFailures': failures}
@@ -7,50 +7,57 @@ import pulumi_aws as aws
 import pulumi_github as github
 
 sys.path.append("../../shared")
-from bootstrap import manage, args, get_config
+from bootstrap import (manage, args, get_config, webhook_trigger, build_profile, build_cache,
+                       attach_bucket_policies)
+from iam_policy import (INLINE_POLICY_LIMIT, bucket_statement, max_size, policy, statement,
+                        trust_policy)
 
-project_name = os.path.basename(os.getcwd())
+project_name = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
 
 ### Deploy Lambda to Trigger CodeBuild Projects for testing and triggered CodePipeline on merge
 
-def create_lambda(environment, buckets, label_tags, github_provider):
-    """Create the Webhook via API Gateway and the Lambda that is triggered by it"""
-    data = get_config(environment)
-    infra_projects = data['infra']
+# Seconds the worker may take on a batch. SQS hides a received batch for six times as long
+WORKER_TIMEOUT = 60
+
+def lambda_code():
+    """Ship only the handler - no tests, benchmarks or caches"""
+    return pulumi.AssetArchive({
+        "webhook.py": pulumi.FileAsset(f"{Path(__file__).resolve().parent}/lambda/webhook.py"),
+    })
+
+def create_worker(environment, buckets, label_tags, queue, webhook_settings):
+    """Create the Lambda that starts builds for the deliveries queued by the webhook
+
+    webhook_settings["direct_projects"] maps functional and main to the CodeBuild
+    projects the Lambda starts itself. Without it the Lambda writes buildspecs to
+    the buckets.
+    """
+    direct_projects = webhook_settings.get("direct_projects")
     # Create the role for the Lambda to assume
     lambda_role = aws.iam.Role("lambda-role",
-        assume_role_policy=json.dumps({
-            "Version": "2012-10-17",
-            "Statement": [{
-                    "Action": "sts:AssumeRole",
-                    "Principal": {
-                        "Service": "lambda.amazonaws.com",
-                    },
-                    "Effect": "Allow",
-                    "Sid": "",
-                }]
-        }),
+        assume_role_policy=trust_policy("lambda.amazonaws.com"),
         tags = label_tags,
     )
 
     aws.iam.RolePolicy("lambda-policy",
         role=lambda_role.id,
-        policy=pulumi.Output.all(codebuild_functional_bucket=buckets['codebuild_functional_bucket'],codebuild_main_bucket=buckets['codebuild_main_bucket']).apply(lambda args: f"""{{
-                    "Version": "2012-10-17",
-                    "Statement": [
-                    {{
-                        "Effect": "Allow",
-                        "Action": ["s3:*"],
-                        "Resource": [
-                            "arn:aws:s3:::{args['codebuild_functional_bucket']}",
-                            "arn:aws:s3:::{args['codebuild_functional_bucket']}/*",
-                            "arn:aws:s3:::{args['codebuild_main_bucket']}",
-                            "arn:aws:s3:::{args['codebuild_main_bucket']}/*"
-                        ]
-                    }}
-                    ]
-                }}
-                """))
+        policy=policy(lambda functional, main: [bucket_statement([functional, main])],
+            functional=buckets['codebuild_functional_bucket'],
+            main=buckets['codebuild_main_bucket']))
+
+    aws.iam.RolePolicy("lambda-queue-policy",
+        role=lambda_role.id,
+        policy=policy(lambda arn: [
+                statement(["sqs:ReceiveMessage", "sqs:DeleteMessage",
+                           "sqs:GetQueueAttributes"], arn),
+            ],
+            arn=queue.arn))
+
+    if direct_projects:
+        aws.iam.RolePolicy("lambda-codebuild-policy",
+            role=lambda_role.id,
+            policy=policy(lambda **arns: [statement("codebuild:StartBuild", arns.values())],
+                **{name: project.arn for name, project in direct_projects.items()}))
 
     # Attach the fullaccess policy to the Lambda role created above
     aws.iam.RolePolicyAttachment("lambdaRoleAttachment",
@@ -58,17 +65,98 @@ def create_lambda(environment, buckets, label_tags, github_provider):
         policy_arn=aws.iam.ManagedPolicy.AWS_LAMBDA_BASIC_EXECUTION_ROLE)
 
     # Create the lambda to execute
-    lambda_function = aws.lambda_.Function(f"lambda-function-{environment}",
-        code=pulumi.FileArchive(f"{Path.cwd()}/lambda"),
+    worker_function = aws.lambda_.Function(f"lambda-worker-{environment}",
+        code=lambda_code(),
         runtime="python3.8",
         role=lambda_role.arn,
-        handler="webhook.handler",
+        handler="webhook.worker",
+        timeout=WORKER_TIMEOUT,
         environment=aws.lambda_.FunctionEnvironmentArgs(
             variables={
                 "environment": environment,
-                "projects": ','.join(infra_projects),
+                "projects": ','.join(webhook_settings["infra_projects"]),
                 "s3_bucket_functional": buckets['codebuild_functional_bucket'],
                 "s3_bucket_main": buckets['codebuild_main_bucket'],
+                # Deduplicate deliveries and builds across containers
+                "dedup_store": "s3",
+                "dedup_bucket": buckets['codebuild_functional_bucket'],
+                "trigger_mode": "direct" if direct_projects else "legacy",
+                **{f"codebuild_project_{name}": project.name
+                   for name, project in (direct_projects or {}).items()},
+            },
+        ))
+
+    # Deliver queued deliveries in batches, retrying only the ones that failed
+    aws.lambda_.EventSourceMapping(f"lambda-worker-queue-{environment}",
+        event_source_arn=queue.arn,
+        function_name=worker_function.arn,
+        batch_size=10,
+        function_response_types=["ReportBatchItemFailures"])
+
+    pulumi.export('lambda_worker_arn', worker_function.arn)
+
+def create_lambda(environment, buckets, label_tags, webhook_settings):
+    """Create the Webhook via API Gateway and the Lambda that is triggered by it
+
+    The Lambda only authenticates and validates deliveries and queues them for
+    the worker, so GitHub gets its answer without waiting for S3 or CodeBuild.
+    webhook_settings holds the GitHub provider, the webhook signing secret, the
+    infra projects of the environment and, in direct mode, the CodeBuild projects.
+    """
+    dead_letter_queue = aws.sqs.Queue(f"webhook-dead-letter-{environment}",
+        message_retention_seconds=14 * 24 * 60 * 60,
+        tags=label_tags)
+    queue = aws.sqs.Queue(f"webhook-queue-{environment}",
+        visibility_timeout_seconds=6 * WORKER_TIMEOUT,
+        message_retention_seconds=24 * 60 * 60,
+        redrive_policy=dead_letter_queue.arn.apply(lambda arn: json.dumps({
+            "deadLetterTargetArn": arn,
+            "maxReceiveCount": 5,
+        })),
+        tags=label_tags)
+
+    create_worker(environment, buckets, label_tags, queue, webhook_settings)
+
+    # Deliveries are signed with this secret and checked by the Lambda
+    signing_secret = aws.secretsmanager.Secret("webhook-signing-secret",
+        name=f"webhook-signing-secret-{environment}",
+        description="The secret GitHub signs webhook deliveries with",
+        tags=label_tags
+    )
+
+    aws.secretsmanager.SecretVersion("webhook-signing-secret-value",
+        secret_id=signing_secret.id,
+        secret_string=webhook_settings['webhook_secret'])
+
+    ingress_role = aws.iam.Role("lambda-ingress-role",
+        assume_role_policy=trust_policy("lambda.amazonaws.com"),
+        tags = label_tags,
+    )
+
+    aws.iam.RolePolicy("lambda-ingress-policy",
+        role=ingress_role.id,
+        policy=policy(lambda queue_arn, secret_arn: [
+                statement("sqs:SendMessage", queue_arn),
+                statement("secretsmanager:GetSecretValue", secret_arn),
+            ],
+            queue_arn=queue.arn,
+            secret_arn=signing_secret.arn))
+
+    aws.iam.RolePolicyAttachment("lambdaIngressRoleAttachment",
+        role=ingress_role,
+        policy_arn=aws.iam.ManagedPolicy.AWS_LAMBDA_BASIC_EXECUTION_ROLE)
+
+    # Create the lambda to execute
+    lambda_function = aws.lambda_.Function(f"lambda-function-{environment}",
+        code=lambda_code(),
+        runtime="python3.8",
+        role=ingress_role.arn,
+        handler="webhook.ingress",
+        environment=aws.lambda_.FunctionEnvironmentArgs(
+            variables={
+                "environment": environment,
+                "queue_url": queue.url,
+                "webhook_secret_id": signing_secret.arn,
             },
         ))
 
@@ -86,6 +174,7 @@ def create_lambda(environment, buckets, label_tags, github_provider):
 
     pulumi.export('api_base_url', apigw.api_endpoint)
     pulumi.export('lambda_function_arn', lambda_function.arn)
+    pulumi.export('webhook_queue_url', queue.url)
 
     # Register webhook
     github.RepositoryWebhook(f"bootstrap-webhook-{environment}",
@@ -94,73 +183,67 @@ def create_lambda(environment, buckets, label_tags, github_provider):
             url=apigw.api_endpoint,
             content_type="json",
             insecure_ssl=False,
+            secret=webhook_settings['webhook_secret'],
         ),
         active=True,
         events=["pull_request"],
-        opts=pulumi.ResourceOptions(provider=github_provider))
+        opts=pulumi.ResourceOptions(provider=webhook_settings['provider']))
 
-def create_cloudwatch_events(resource_name, bucket, codebuildprojectarn):
+def create_cloudwatch_events(resource_name, bucket, codebuildprojectarn, key_prefix=None):
     """Create CloudWatch Event Rules with Targets
     Create the IAM Roles to allow Events to Trigger CodeBuild jobs
+
+    With a key_prefix only objects under it start a build, and the build runs the
+    buildspec object that was written instead of the whole bucket
     """
+    def event_pattern(bucket_name):
+        request_parameters = {"bucketName": [bucket_name]}
+        if key_prefix:
+            request_parameters["key"] = [{"prefix": key_prefix}]
+        return json.dumps({
+            "source": ["aws.s3"],
+            "detail-type": ["AWS API Call via CloudTrail"],
+            "detail": {
+                "eventSource": ["s3.amazonaws.com"],
+                "eventName": ["PutObject"],
+                "requestParameters": request_parameters,
+            },
+        })
     check_s3_rule = aws.cloudwatch.EventRule(f"check_s3_objects_in_{resource_name}_bucket",
         description=f"Capture when Lambda uploads buildspec in the {resource_name} bucket",
-        event_pattern=pulumi.Output.all(bucket=bucket).apply(lambda args: f"""{{
-            "source": [
-                "aws.s3"
-            ],
-            "detail-type": [
-                "AWS API Call via CloudTrail"
-            ],
-            "detail": {{
-                "eventSource": [
-                    "s3.amazonaws.com"
-                ],
-                "eventName": [
-                    "PutObject"
-                ],
-                "requestParameters": {{
-                "bucketName": [
-                    "{args['bucket']}"
-                ]
-                }}
-            }}
-        }}"""))
-    trigger_codebuild_role = aws.iam.Role(f"trigger_codebuild_functional_role_{resource_name}", assume_role_policy="""{
-        "Version": "2012-10-17",
-        "Statement": [
-            {
-            "Effect": "Allow",
-            "Principal": {
-                "Service": "events.amazonaws.com"
-            },
-            "Action": "sts:AssumeRole"
-            }
-        ]
-        }
-    """)
+        event_pattern=bucket.apply(event_pattern))
+    trigger_codebuild_role = aws.iam.Role(f"trigger_codebuild_functional_role_{resource_name}",
+        assume_role_policy=trust_policy("events.amazonaws.com"))
     aws.iam.RolePolicy(f"trigger_codebuild_functional_policy_{resource_name}",
         role=trigger_codebuild_role.id,
-        policy=pulumi.Output.all(codebuildprojectarn=codebuildprojectarn).apply(lambda args: f"""{{
-            "Version": "2012-10-17",
-            "Statement": [
-                {{
-                    "Effect": "Allow",
-                    "Action": [
-                        "codebuild:StartBuild"
-                    ],
-                    "Resource": ["{args['codebuildprojectarn']}"]
-                }}
-            ]
-        }}
-    """))
+        policy=policy(lambda arn: [statement("codebuild:StartBuild", arn)],
+            arn=codebuildprojectarn))
+    input_transformer = None
+    if key_prefix:
+        input_transformer = aws.cloudwatch.EventTargetInputTransformerArgs(
+            input_paths={
+                "bucket": "$.detail.requestParameters.bucketName",
+                "key": "$.detail.requestParameters.key",
+            },
+            input_template=json.dumps({
+                "sourceTypeOverride": "NO_SOURCE",
+                "buildspecOverride": "arn:aws:s3:::<bucket>/<key>",
+            }))
     aws.cloudwatch.EventTarget(f"trigger_codebuild_{resource_name}",
         rule=check_s3_rule.name,
         arn=codebuildprojectarn,
-        role_arn=trigger_codebuild_role.arn
+        role_arn=trigger_codebuild_role.arn,
+        input_transformer=input_transformer
     )
 
-def create_codebuild_jobs(label_tags, environment, github_token_secret, github_provider):
+def codebuild_statements(secret_arn):
+    """Permissions of the CodeBuild jobs besides the buckets"""
+    return [
+        statement("secretsmanager:*", secret_arn),
+        statement(["logs:CreateLogGroup", "logs:CreateLogStream", "logs:PutLogEvents"], "*"),
+    ]
+
+def create_codebuild_jobs(label_tags, environment, github_token_secret, webhook_settings):
     """Create the CodeBuild jobs with dependencies"""
     ecr_reference = pulumi.StackReference(f"pipeline-ecr-{environment}")
     codebuild_image = ecr_reference.get_output("codebuild_image")
@@ -171,76 +254,36 @@ def create_codebuild_jobs(label_tags, environment, github_token_secret, github_p
     buckets["codepipeline_source_bucket"] = s3_reference.get_output("codepipeline_source_bucket")
 
     # Create the IAM Role to give the CodeBuild Jobs access to the github_token_secret
-    codebuild_role = aws.iam.Role("codebuldRole", assume_role_policy="""{
-        "Version": "2012-10-17",
-        "Statement": [
-            {
-            "Effect": "Allow",
-            "Principal": {
-                "Service": "codebuild.amazonaws.com"
-            },
-            "Action": "sts:AssumeRole"
-            }
-        ]
-        }
-    """)
-
-    for key, value in buckets.items():
-        aws.iam.RolePolicy(f"codeBuildBucketRolePolicy-{project_name}-{key}-{environment}",
-            role=codebuild_role.name,
-            policy=pulumi.Output.all(bucket=value).apply(lambda args: f"""{{
-                "Version": "2012-10-17",
-                "Statement": [
-                {{
-                    "Effect": "Allow",
-                    "Action": ["s3:*"],
-                    "Resource": [
-                        "arn:aws:s3:::{args['bucket']}",
-                        "arn:aws:s3:::{args['bucket']}/*"
-                    ]
-                }}
-                ]
-            }}
-            """))
-
+    codebuild_role = aws.iam.Role("codebuldRole",
+        assume_role_policy=trust_policy("codebuild.amazonaws.com"))
 
     aws.iam.RolePolicy("codebuldPolicy",
         role=codebuild_role.id,
-        policy=pulumi.Output.all(github_token_secret=github_token_secret.arn).apply(lambda args: f"""{{
-            "Version": "2012-10-17",
-            "Statement": [
-                {{
-                    "Effect": "Allow",
-                    "Action": [
-                        "secretsmanager:*"
-                    ],
-                    "Resource": "{args['github_token_secret']}"
-                }},
-                {{
-                    "Effect": "Allow",
-                    "Action": [
-                        "logs:CreateLogGroup",
-                        "logs:CreateLogStream",
-                        "logs:PutLogEvents"
-                    ],
-                    "Resource": ["*"]
-                }}
-            ]
-        }}
-    """))
+        policy=policy(codebuild_statements, secret_arn=github_token_secret.arn))
+    # Secrets Manager adds a 7 character suffix to the secret name
+    secret_arn_max = len(f"arn:aws:secretsmanager:ap-southeast-4:000000000000:secret:"
+                         f"webhook-github-token-secret3-{environment}-000000")
+    attach_bucket_policies(f"codeBuildBucketPolicy-{project_name}-{environment}",
+        {f"codeBuildBucketRolePolicy-{project_name}-{environment}": codebuild_role},
+        buckets,
+        INLINE_POLICY_LIMIT - max_size(codebuild_statements, secret_arn=secret_arn_max))
 
+    functional_profile = build_profile(environment, "webhook-functional")
     codebuild_project_functional = aws.codebuild.Project("codebuild-functional-testing",
         description=f"codebuild project for {project_name} in {environment}",
-        build_timeout=5,
+        build_timeout=functional_profile["timeout"],
         service_role=codebuild_role.arn,
         artifacts=aws.codebuild.ProjectArtifactsArgs(
             type="NO_ARTIFACTS",
         ),
+        cache=build_cache(functional_profile,
+            buckets['codebuild_functional_bucket'].apply(lambda id: f"{id}/cache")),
         environment=aws.codebuild.ProjectEnvironmentArgs(
-            compute_type="BUILD_GENERAL1_SMALL",
+            compute_type=functional_profile["compute_type"],
             image=codebuild_image,
             type="LINUX_CONTAINER",
-            image_pull_credentials_type="CODEBUILD"
+            image_pull_credentials_type="CODEBUILD",
+            privileged_mode=functional_profile["privileged_mode"],
         ),
         logs_config=aws.codebuild.ProjectLogsConfigArgs(
             cloudwatch_logs=aws.codebuild.ProjectLogsConfigCloudwatchLogsArgs(
@@ -255,9 +298,10 @@ def create_codebuild_jobs(label_tags, environment, github_token_secret, github_p
         tags=label_tags
     )
 
+    main_profile = build_profile(environment, "webhook-main")
     codebuild_project_main = aws.codebuild.Project("codebuild-clone-main",
         description=f"codebuild project for {project_name} in {environment}",
-        build_timeout=5,
+        build_timeout=main_profile["timeout"],
         service_role=codebuild_role.arn,
         artifacts=aws.codebuild.ProjectArtifactsArgs(
             type="S3",
@@ -266,11 +310,14 @@ def create_codebuild_jobs(label_tags, environment, github_token_secret, github_p
             name="pulumi-bootstrap.zip",
             packaging="ZIP"
         ),
+        cache=build_cache(main_profile,
+            buckets['codebuild_main_bucket'].apply(lambda id: f"{id}/cache")),
         environment=aws.codebuild.ProjectEnvironmentArgs(
-            compute_type="BUILD_GENERAL1_SMALL",
+            compute_type=main_profile["compute_type"],
             image=codebuild_image,
             type="LINUX_CONTAINER",
             image_pull_credentials_type="CODEBUILD",
+            privileged_mode=main_profile["privileged_mode"],
         ),
         logs_config=aws.codebuild.ProjectLogsConfigArgs(
             cloudwatch_logs=aws.codebuild.ProjectLogsConfigCloudwatchLogsArgs(
@@ -285,12 +332,35 @@ def create_codebuild_jobs(label_tags, environment, github_token_secret, github_p
         tags=label_tags
     )
 
+    if webhook_trigger(environment) == 'direct':
+        # The Lambda starts the builds itself
+        create_lambda(environment, buckets, label_tags, {
+            **webhook_settings,
+            "direct_projects": {'functional': codebuild_project_functional,
+                                'main': codebuild_project_main},
+        })
+        return
+
     # Create CloudWatch Event Rule to Pick Up S3 Object Upload and Trigger CodeBuild Job
-    create_cloudwatch_events('functional', buckets['codebuild_functional_bucket'], codebuild_project_functional.arn)
+    # Functional builds are written per pull request and commit under prs/
+    create_cloudwatch_events('functional', buckets['codebuild_functional_bucket'],
+                             codebuild_project_functional.arn, key_prefix='prs/')
     create_cloudwatch_events('main', buckets['codebuild_main_bucket'], codebuild_project_main.arn)
 
     # Create the API Gateway, Webhook, Lambda, then register the Webhook on GitHub
-    create_lambda(environment, buckets, label_tags, github_provider)
+    create_lambda(environment, buckets, label_tags, webhook_settings)
+
+def require_secret(secrets, name, environment):
+    """Return an output of the secrets stack, failing the update with a clear
+    message when secrets.json doesn't have it
+    """
+    def check(value):
+        if value is None:
+            raise RuntimeError(f"secrets-{environment} has no {name} output: add {name} "
+                               "to infra/secrets/secrets.json and deploy the secrets stack "
+                               "first, see infra/secrets/README.md")
+        return value
+    return secrets.get_output(name).apply(check)
 
 def pulumi_program():
     """Pulumi Program"""
@@ -305,7 +375,7 @@ def pulumi_program():
 
     # Export GitHub Token to provision the Webhook
     secrets = pulumi.StackReference(f"secrets-{environment}")
-    github_token = secrets.get_output("github_token")
+    github_token = require_secret(secrets, "github_token", environment)
     github_provider = github.Provider(resource_name='github_provider', token=github_token)
 
     # Create Secrets Manager secret with GitHub Token for the CodeBuild jobs
@@ -319,6 +389,14 @@ def pulumi_program():
         secret_id=github_token_secret.id,
         secret_string=github_token)
 
-    create_codebuild_jobs(label_tags, environment, github_token_secret, github_provider)
+    data = get_config(environment)
+    webhook_settings = {
+        "provider": github_provider,
+        # GitHub signs every delivery with this secret, see README.md
+        "webhook_secret": require_secret(secrets, "github_webhook_secret", environment),
+        "infra_projects": data['infra'],
+    }
+    create_codebuild_jobs(label_tags, environment, github_token_secret, webhook_settings)
 
-stack = manage(args(), project_name, pulumi_program)
+if __name__ == "__main__":
+    stack = manage(args(), project_name, pulumi_program)
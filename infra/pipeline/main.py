@@ -25,9 +25,11 @@ def pulumi_program():
         roles[f"codebuild_role_{project}_arn"] = iam_reference.get_output(f"codebuild_role_{project}_arn")
         roles[f"codebuild_role_{project}_id"] = iam_reference.get_output(f"codebuild_role_{project}_id")
     buckets["codepipeline_bucket_id"] = s3_reference.get_output("codepipeline_bucket_id")
+    roles["codebuild_role_detect-changes_arn"] = iam_reference.get_output("codebuild_role_detect-changes_arn")
     # Set the CodePipeline role
     roles['codepipeline_role_arn'] = iam_reference.get_output("codepipeline_role_arn")
     roles['codepipeline_role_id'] = iam_reference.get_output("codepipeline_role_id")
     create_pipeline(infra_projects, buckets, roles, environment, codepipeline_source_bucket)
 
-stack = manage(args(), os.path.basename(os.getcwd()), pulumi_program)
+if __name__ == "__main__":
+    stack = manage(args(), os.path.basename(os.getcwd()), pulumi_program)
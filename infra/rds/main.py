@@ -68,47 +68,52 @@ def pulumi_program():
     pulumi.export("db_user", db_user)
     pulumi.export("db_pass", db_pass)
 
-stack = manage(args(), os.path.basename(os.getcwd()), pulumi_program)
-print(f"db host url: {stack.outputs['host'].value}")
-print(f"db name: {stack.outputs['db_name'].value}")
+def post_deploy(outputs, on_output=print):
+    """Create and seed the table once the database is up"""
+    on_output(f"db host url: {outputs['host'].value}")
+    on_output(f"db name: {outputs['db_name'].value}")
 
-print("configuring db...")
-with connect(
-        host=stack.outputs['host'].value,
-        user=stack.outputs['db_user'].value,
-        password=stack.outputs['db_pass'].value,
-        database=stack.outputs['db_name'].value) as connection:
-    print("db configured!")
+    on_output("configuring db...")
+    with connect(
+            host=outputs['host'].value,
+            user=outputs['db_user'].value,
+            password=outputs['db_pass'].value,
+            database=outputs['db_name'].value) as connection:
+        on_output("db configured!")
 
-    # make sure the table exists
-    print("creating table...")
-    CREATE_TABLE_QUERY = """CREATE TABLE IF NOT EXISTS hello_pulumi(
-        id int(9) NOT NULL PRIMARY KEY,
-        color varchar(14) NOT NULL);
+        # make sure the table exists
+        on_output("creating table...")
+        create_table_query = """CREATE TABLE IF NOT EXISTS hello_pulumi(
+            id int(9) NOT NULL PRIMARY KEY,
+            color varchar(14) NOT NULL);
+            """
+        with connection.cursor() as cursor:
+            cursor.execute(create_table_query)
+            connection.commit()
+
+        # seed the table with some data to start
+        seed_table_query = """INSERT IGNORE INTO hello_pulumi (id, color)
+        VALUES
+            (1, 'Purple'),
+            (2, 'Violet'),
+            (3, 'Plum');
         """
-    with connection.cursor() as cursor:
-        cursor.execute(CREATE_TABLE_QUERY)
-        connection.commit()
+        with connection.cursor() as cursor:
+            cursor.execute(seed_table_query)
+            connection.commit()
 
-    # seed the table with some data to start
-    SEED_TABLE_QUERY = """INSERT IGNORE INTO hello_pulumi (id, color)
-    VALUES
-        (1, 'Purple'),
-        (2, 'Violet'),
-        (3, 'Plum');
-    """
-    with connection.cursor() as cursor:
-        cursor.execute(SEED_TABLE_QUERY)
-        connection.commit()
+        on_output("rows inserted!")
+        on_output("querying to verify data...")
 
-    print("rows inserted!")
-    print("querying to verify data...")
+        # read the data back
+        read_table_query = """SELECT COUNT(*) FROM hello_pulumi;"""
+        with connection.cursor() as cursor:
+            cursor.execute(read_table_query)
+            result = cursor.fetchone()
+            on_output(f"Result: {json.dumps(result)}")
 
-    # read the data back
-    READ_TABLE_QUERY = """SELECT COUNT(*) FROM hello_pulumi;"""
-    with connection.cursor() as cursor:
-        cursor.execute(READ_TABLE_QUERY)
-        result = cursor.fetchone()
-        print(f"Result: {json.dumps(result)}")
+        on_output("database, table and rows successfully configured")
 
-    print("database, table and rows successfully configured")
+if __name__ == "__main__":
+    stack = manage(args(), os.path.basename(os.getcwd()), pulumi_program)
+    post_deploy(stack.outputs)
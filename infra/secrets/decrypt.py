@@ -1,15 +1,35 @@
+import argparse
 import logging
 import os
 import sys
 sys.path.append("../..//shared")
-from encrypt_decrypt_file import decrypt_file
+from encrypt_decrypt_file import decrypt_file, decrypt_files, verify_manifest
 
 DECRYPTED_FILE = 'secrets.json'
 ENCRYPTED_FILE = 'secrets.json.encrypted'
 
+parser = argparse.ArgumentParser(description='Decrypt secrets files encrypted by encrypt.py.')
+parser.add_argument('paths', nargs='*',
+                    help='files, directories or globs to decrypt as one batch (default: secrets.json)')
+parser.add_argument('-m', '--manifest', required=False,
+                    help='only check the encrypted files against this manifest')
+parser.add_argument('-w', '--workers', type=int, required=False, default=8)
+arguments = parser.parse_args()
+
 logging.basicConfig(level=logging.DEBUG,
                     format='%(levelname)s: %(asctime)s: %(message)s')
 #cmk_id, cmk_arn = retrieve_cmk('Pulumi State Encrypt Key')
-if decrypt_file(DECRYPTED_FILE):
-    logging.info("%s decrypted to %s", ENCRYPTED_FILE, DECRYPTED_FILE)
+if arguments.manifest:
+    mismatched = verify_manifest(arguments.manifest)
+    for filename in mismatched:
+        logging.error("%s is missing or does not match %s", filename, arguments.manifest)
+    sys.exit(1 if mismatched else 0)
+if arguments.paths:
+    failed = decrypt_files(arguments.paths, arguments.workers)
+    for filename in failed:
+        logging.error("%s could not be decrypted", filename)
+    sys.exit(1 if failed else 0)
+if not decrypt_file(DECRYPTED_FILE):
+    sys.exit(1)
+logging.info("%s decrypted to %s", ENCRYPTED_FILE, DECRYPTED_FILE)
 os.rename(f"{DECRYPTED_FILE}.decrypted",DECRYPTED_FILE)
@@ -1,13 +1,29 @@
+import argparse
 import logging
 import sys
 sys.path.append("../..//shared")
-from encrypt_decrypt_file import retrieve_cmk, encrypt_file
+from encrypt_decrypt_file import retrieve_cmk, encrypt_file, encrypt_files
 
 ENCRYPTED_FILE = 'secrets.json.encrypted'
 DECRYPTED_FILE = 'secrets.json'
 
+parser = argparse.ArgumentParser(description='Encrypt secrets files with the Pulumi state key.')
+parser.add_argument('paths', nargs='*',
+                    help='files, directories or globs to encrypt as one batch (default: secrets.json)')
+parser.add_argument('-m', '--manifest', required=False, help='where to write the batch manifest')
+parser.add_argument('-w', '--workers', type=int, required=False, default=8)
+arguments = parser.parse_args()
+
 logging.basicConfig(level=logging.DEBUG,
                     format='%(levelname)s: %(asctime)s: %(message)s')
 cmk_id, cmk_arn = retrieve_cmk('Pulumi State Encrypt Key')
-if encrypt_file(DECRYPTED_FILE, cmk_arn):
-    logging.info("%s decrypted to %s", DECRYPTED_FILE, ENCRYPTED_FILE)
+if arguments.paths:
+    encrypted = encrypt_files(arguments.paths, cmk_arn, arguments.manifest, arguments.workers)
+    if encrypted is None:
+        sys.exit(1)
+    for filename in encrypted:
+        logging.info("%s encrypted to %s.encrypted", filename, filename)
+elif encrypt_file(DECRYPTED_FILE, cmk_arn):
+    logging.info("%s encrypted to %s", DECRYPTED_FILE, ENCRYPTED_FILE)
+else:
+    sys.exit(1)
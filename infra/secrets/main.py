@@ -1,38 +1,35 @@
 import sys
 import os
-import json
 import logging
 import pulumi
 
 sys.path.append("../..//shared")
 from bootstrap import manage, args
-from encrypt_decrypt_file import decrypt_file
+from encrypt_decrypt_file import decrypt_to_json
 
 # Decrypting Secrets Infra Deployment
 
-DECRYPTED_FILE = 'secrets.json'
-ENCRYPTED_FILE = 'secrets.json.encrypted'
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+DECRYPTED_FILE = os.path.join(PROJECT_DIR, 'secrets.json')
+ENCRYPTED_FILE = os.path.join(PROJECT_DIR, 'secrets.json.encrypted')
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(levelname)s: %(asctime)s: %(message)s')
-if decrypt_file(DECRYPTED_FILE):
-    logging.info("%s decrypted to %s", ENCRYPTED_FILE, DECRYPTED_FILE)
-os.rename(f"{DECRYPTED_FILE}.decrypted",DECRYPTED_FILE)
 
 # Deploy Secrets to Pulumi State
+# Secrets are decrypted in memory and never written to disk
 
 def pulumi_program():
     """Pulumi Program"""
-    #file = open('secrets.json')
-    try:
-        with open(DECRYPTED_FILE, 'rb') as file:
-            secrets_dict = json.load(file)
-    except IOError as error:
-        logging.error(error)
-        return False
+    secrets_dict = decrypt_to_json(DECRYPTED_FILE)
+    if secrets_dict is None:
+        # Exporting nothing would delete every secret from the stack. decrypt_to_json
+        # has logged why the file couldn't be decrypted.
+        raise RuntimeError(f"Cannot decrypt {ENCRYPTED_FILE}")
+    logging.info("%s decrypted in memory", ENCRYPTED_FILE)
     for key,value in secrets_dict.items():
         pulumi.export(key, pulumi.Output.secret(value))
     return True
 
-stack = manage(args(), os.path.basename(os.getcwd()), pulumi_program)
-os.remove(DECRYPTED_FILE)
+if __name__ == "__main__":
+    stack = manage(args(), os.path.basename(os.getcwd()), pulumi_program)
@@ -5,77 +5,113 @@ import pulumi_aws as aws
 
 sys.path.append("../..//shared")
 from bootstrap import manage, args, get_config
+from cidr import plan_vpc, subnet_tiers, nat_subnets
 
-def create_subnets(data, no_subnets, vpc, vpc_name, public_route):
-    """Create Subnets for a VPC"""
-    for integer in range(1, no_subnets):
-        config = pulumi.Config()
-        environment = config.require('environment')
-        aws_region = config.require('aws_region')
-        subnet_id = f"subnet{integer}"
-        subnet_config = data['vpc']['subnets'][subnet_id]
-        subnet = aws.ec2.Subnet(subnet_id,
-            vpc_id=vpc.id,
-            availability_zone=f"{aws_region}{subnet_config['az']}",
-            cidr_block=subnet_config['cidr'],
-            tags={
-                "Name": f"{subnet_id}-{vpc_name}",
-                "Environment": environment,
-                "Type": subnet_config['type'],
-                "Managed By": "Pulumi",
-        })
-        pulumi.export(f"{subnet_id}_cidr", subnet_config['cidr'])
-        pulumi.export(f"{subnet_id}_type", subnet_config['type'])
+def resource_tags(environment, name, **extra):
+    """Tags shared by every resource of the VPC"""
+    return {"Name": name, "Environment": environment, "Managed By": "Pulumi", **extra}
+
+def create_subnets(plan, vpc, vpc_name, environment, aws_region):
+    """Create the planned Subnets of a VPC and return them by name"""
+    return {subnet_id: aws.ec2.Subnet(subnet_id,
+                vpc_id=vpc.id,
+                availability_zone=f"{aws_region}{subnet_config['az']}",
+                cidr_block=subnet_config['cidr'],
+                tags=resource_tags(environment, f"{subnet_id}-{vpc_name}",
+                                   Type=subnet_config['type']))
+            for subnet_id, subnet_config in plan.items()}
+
+def create_public_tier(plan, subnets, vpc, vpc_name, environment):
+    """Route every public subnet through one route table to an internet gateway"""
+    internet_gateway = aws.ec2.InternetGateway("gw",
+        vpc_id=vpc.id,
+        tags=resource_tags(environment, vpc_name))
+    public_route = aws.ec2.RouteTable("public",
+        vpc_id=vpc.id,
+        routes=[
+            aws.ec2.RouteTableRouteArgs(
+                cidr_block="0.0.0.0/0",
+                gateway_id=internet_gateway.id,
+            )
+        ],
+        tags=resource_tags(environment, f"{vpc_name}-public"))
+    for integer, (subnet_id, subnet_config) in enumerate(plan.items(), start=1):
         if subnet_config['type'] == 'public':
-            association = aws.ec2.RouteTableAssociation(f"public_route{integer}",
-                subnet_id=subnet.id,
+            aws.ec2.RouteTableAssociation(f"public_route{integer}",
+                subnet_id=subnets[subnet_id].id,
                 route_table_id=public_route.id)
-            pulumi.export(f"public_route{integer}", association.id)
+
+def create_private_tier(tiers, nat, subnets, vpc, environment):
+    """Route the private subnets through NAT gateways
+
+    nat maps AZs to the public subnet of their NAT gateway. With a single gateway
+    its route table becomes the main route table of the VPC, so the private subnets
+    need no association of their own. Without NAT they keep the default main table.
+    """
+    if not nat:
+        return
+    # Named after the public subnet they are in, unless there is a single one
+    single = len(set(nat.values())) == 1
+    gateways = {}
+    for public_subnet in dict.fromkeys(nat.values()):
+        suffix = "" if single else f"-{public_subnet}"
+        eip = aws.ec2.Eip(f"nat-eip{suffix}",
+            vpc=True,
+            tags=resource_tags(environment, f"nat{suffix}-{environment}"))
+        gateways[public_subnet] = aws.ec2.NatGateway(f"nat{suffix}",
+            allocation_id=eip.id,
+            subnet_id=subnets[public_subnet].id,
+            tags=resource_tags(environment, f"nat{suffix}-{environment}"))
+    route_tables = {}
+    for public_subnet, gateway in gateways.items():
+        suffix = "" if single else f"-{public_subnet}"
+        route_tables[public_subnet] = aws.ec2.RouteTable(f"private{suffix}",
+            vpc_id=vpc.id,
+            routes=[
+                aws.ec2.RouteTableRouteArgs(
+                    cidr_block="0.0.0.0/0",
+                    nat_gateway_id=gateway.id,
+                )
+            ],
+            tags=resource_tags(environment, f"private{suffix}-{environment}"))
+    if single:
+        aws.ec2.MainRouteTableAssociation("private",
+            vpc_id=vpc.id,
+            route_table_id=next(iter(route_tables.values())).id)
+        return
+    for zone, subnet_ids in tiers['private'].items():
+        for subnet_id in subnet_ids:
+            aws.ec2.RouteTableAssociation(f"private_route-{subnet_id}",
+                subnet_id=subnets[subnet_id].id,
+                route_table_id=route_tables[nat[zone]].id)
 
 def pulumi_program():
     """Pulumi Program"""
     config = pulumi.Config()
     environment = config.require('environment')
+    aws_region = config.require('aws_region')
     data = get_config(environment)
     vpc_cidr = data['vpc']['cidr']
-    if '/16' in vpc_cidr:
-        vpc_name = f"main-{environment}"
-    else:
-        raise ValueError('The VPC must use /16 CIDR.')
-    tags = {
-        "Name": vpc_name,
-        "Environment": environment,
-        "Managed By": "Pulumi",
-    }
+    # Check and allocate every subnet, and place the NAT gateways, before creating anything
+    plan = plan_vpc(data['vpc'])
+    tiers = subnet_tiers(plan)
+    nat = nat_subnets(tiers, data['vpc'].get('nat', 'none'))
+    vpc_name = f"main-{environment}"
     vpc = aws.ec2.Vpc(vpc_name,
                       cidr_block=vpc_cidr,
-                      tags=tags,
+                      tags=resource_tags(environment, vpc_name),
                       enable_dns_hostnames=True,
     )
-    number_of_subnets = len(data['vpc']['subnets'].keys()) + 1
-    internet_gateway = aws.ec2.InternetGateway("gw",
-        vpc_id=vpc.id,
-        tags={
-            "Name": vpc_name,
-            "Environment": environment,
-            "Managed By": "Pulumi",
-        })
-    public_route = aws.ec2.RouteTable("public",
-        vpc_id=vpc.id,
-        routes=[
-            aws.ec2.RouteTableRouteArgs(
-                cidr_block="0.0.0.0/0",
-                gateway_id=internet_gateway.id,
-            )
-        ],
-        tags={
-            "Name": f"{vpc_name}-public",
-            "Environment": environment,
-            "Managed By": "Pulumi",
-        }
-    )
-    create_subnets(data, number_of_subnets, vpc, vpc_name, public_route)
+    subnets = create_subnets(plan, vpc, vpc_name, environment, aws_region)
+    create_public_tier(plan, subnets, vpc, vpc_name, environment)
+    create_private_tier(tiers, nat, subnets, vpc, environment)
     pulumi.export("vpc_id", vpc.id)
+    pulumi.export("subnets", {subnet_id: {"id": subnets[subnet_id].id, **subnet_config}
+                              for subnet_id, subnet_config in plan.items()})
+    for subnet_type, azs in tiers.items():
+        pulumi.export(f"{subnet_type}_subnet_ids",
+                      [subnets[subnet_id].id for names in azs.values() for subnet_id in names])
 
 # Deploy VPC
-stack = manage(args(), os.path.basename(os.getcwd()), pulumi_program)
+if __name__ == "__main__":
+    stack = manage(args(), os.path.basename(os.getcwd()), pulumi_program)
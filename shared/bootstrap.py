@@ -2,11 +2,15 @@
 import argparse
 import json
 import sys
-import os
-import yaml
 import pulumi
 import pulumi_aws as aws
 from pulumi import automation as auto
+from dependencies import project_dependencies, dependency_levels
+from plugins import required_plugins, ensure_plugins
+from refresh import REFRESH_POLICIES, refresh_stack, record_state
+from input_hash import program_input_hash, last_deployed_hash, record_input_hash, with_input_hash
+from iam_policy import INLINE_POLICY_LIMIT, bucket_policies, policy, statement, trust_policy
+from environment_config import DEFAULT_BUILD_PROFILE, has_config, load_config
 
 # Repeatable process for creating/update Pulumi stacks
 # Assumes:
@@ -16,29 +20,51 @@ from pulumi import automation as auto
 #    * pulumi cli is installed
 #    * stack-name corresponds to an environment (i.e. prod, staging, dev)
 
+def build_profile(environment, name):
+    """Return the CodeBuild settings of a project in an environment"""
+    data = get_config(environment) or {}
+    profiles = data.get('build_profiles') or {}
+    profile = dict(DEFAULT_BUILD_PROFILE)
+    profile.update(profiles.get('default') or {})
+    profile.update(profiles.get(name) or {})
+    return profile
+
+def build_cache(profile, location=None):
+    """Return the CodeBuild cache of a profile. S3 caches are kept at location"""
+    if profile["cache"] == "local":
+        return aws.codebuild.ProjectCacheArgs(
+            type="LOCAL",
+            modes=["LOCAL_DOCKER_LAYER_CACHE", "LOCAL_SOURCE_CACHE", "LOCAL_CUSTOM_CACHE"],
+        )
+    if profile["cache"] == "s3" and location is not None:
+        return aws.codebuild.ProjectCacheArgs(
+            type="S3",
+            location=location,
+        )
+    return aws.codebuild.ProjectCacheArgs(type="NO_CACHE")
+
 def create_codebuild_pipeline_project(environment, buckets, roles, project_name, codebuild_image):
     """Create a CodeBuild Pipeline Project"""
     codebuild_role_arn = roles[f"codebuild_role_{project_name}_arn"]
     # Use the existing S3 bucket
     codebuild_bucket = buckets[f"codebuild_{project_name}_bucket_id"]
     #codepipeline_bucket = buckets["codepipeline_bucket_id"]
+    profile = build_profile(environment, project_name)
     aws.codebuild.Project(f"{project_name}-{environment}",
         name=f"{project_name}-{environment}",
         description=f"codebuild project for {project_name} in {environment}",
-        build_timeout=5,
+        build_timeout=profile["timeout"],
         service_role=codebuild_role_arn,
         artifacts=aws.codebuild.ProjectArtifactsArgs(
             type="CODEPIPELINE",
         ),
-        cache=aws.codebuild.ProjectCacheArgs(
-            type="S3",
-            location=codebuild_bucket,
-        ),
+        cache=build_cache(profile, codebuild_bucket),
         environment=aws.codebuild.ProjectEnvironmentArgs(
-            compute_type="BUILD_GENERAL1_SMALL",
+            compute_type=profile["compute_type"],
             image=codebuild_image,
             type="LINUX_CONTAINER",
             image_pull_credentials_type="CODEBUILD",
+            privileged_mode=profile["privileged_mode"],
             environment_variables=[
                 aws.codebuild.ProjectEnvironmentEnvironmentVariableArgs(
                     name="environment",
@@ -48,6 +74,10 @@ def create_codebuild_pipeline_project(environment, buckets, roles, project_name,
                     name="project_name",
                     value=project_name,
                 ),
+                aws.codebuild.ProjectEnvironmentEnvironmentVariableArgs(
+                    name="pipeline_bucket",
+                    value=buckets["codepipeline_bucket_id"],
+                ),
             ],
         ),
         logs_config=aws.codebuild.ProjectLogsConfigArgs(
@@ -71,6 +101,97 @@ def create_codebuild_pipeline_project(environment, buckets, roles, project_name,
         }
     )
 
+def create_detect_changes_project(environment, buckets, roles, codebuild_image):
+    """Create the CodeBuild Project that lists the projects affected by a commit"""
+    profile = build_profile(environment, "detect-changes")
+    aws.codebuild.Project(f"detect-changes-{environment}",
+        name=f"detect-changes-{environment}",
+        description=f"lists the infra projects changed since their last deployment in {environment}",
+        build_timeout=profile["timeout"],
+        service_role=roles["codebuild_role_detect-changes_arn"],
+        artifacts=aws.codebuild.ProjectArtifactsArgs(
+            type="CODEPIPELINE",
+        ),
+        cache=build_cache(profile),
+        environment=aws.codebuild.ProjectEnvironmentArgs(
+            compute_type=profile["compute_type"],
+            image=codebuild_image,
+            type="LINUX_CONTAINER",
+            image_pull_credentials_type="CODEBUILD",
+            environment_variables=[
+                aws.codebuild.ProjectEnvironmentEnvironmentVariableArgs(
+                    name="environment",
+                    value=environment,
+                ),
+                aws.codebuild.ProjectEnvironmentEnvironmentVariableArgs(
+                    name="pipeline_bucket",
+                    value=buckets["codepipeline_bucket_id"],
+                ),
+            ],
+        ),
+        logs_config=aws.codebuild.ProjectLogsConfigArgs(
+            cloudwatch_logs=aws.codebuild.ProjectLogsConfigCloudwatchLogsArgs(
+                group_name="log-group",
+                stream_name="log-stream",
+            ),
+        ),
+        source=aws.codebuild.ProjectSourceArgs(
+            type="CODEPIPELINE",
+            buildspec="buildspec_changes.yml"
+        ),
+        tags={
+            "Name": "detect-changes",
+            "Environment": environment,
+            "Managed By": "Pulumi",
+        }
+    )
+
+def detect_changes_stage(environment):
+    """The stage that writes the projects affected by the source commit to the changes artifact"""
+    return aws.codepipeline.PipelineStageArgs(
+        name="Detect-Changes",
+        actions=[aws.codepipeline.PipelineStageActionArgs(
+            name="Detect-Changes",
+            category="Build",
+            owner="AWS",
+            provider="CodeBuild",
+            input_artifacts=["source_output"],
+            output_artifacts=["changes"],
+            version="1",
+            configuration={
+                "ProjectName": f"detect-changes-{environment}",
+            },
+        )],
+    )
+
+def build_stage(infra_projects, environment):
+    """Plan the Build stage of the CodePipeline
+
+    Every project is an action of a single stage. CodePipeline runs actions with
+    the same run_order in parallel, so a project's run_order is one more than the
+    longest chain of stacks it depends on. Builds skip themselves when the
+    changes artifact says their project isn't affected.
+    """
+    data = get_config(environment) or {}
+    levels = dependency_levels(project_dependencies(infra_projects, data.get('dependencies')))
+    return aws.codepipeline.PipelineStageArgs(
+        name="Build",
+        actions=[aws.codepipeline.PipelineStageActionArgs(
+            name=f"Build-{project}",
+            category="Build",
+            owner="AWS",
+            provider="CodeBuild",
+            input_artifacts=["source_output", "changes"],
+            output_artifacts=[f"build_output-{project}"],
+            version="1",
+            run_order=levels[project] + 1,
+            configuration={
+                "ProjectName": f"{project}-{environment}",
+                "PrimarySource": "source_output",
+            },
+        ) for project in infra_projects],
+    )
+
 def create_pipeline(infra_projects, buckets, roles, environment, codepipeline_source_bucket):
     """Create a CodePipeline from a list of Infrastructure,
     a list of S3 Bucket ID's,
@@ -97,25 +218,8 @@ def create_pipeline(infra_projects, buckets, roles, environment, codepipeline_so
             )],
         )
     ]
-    # Create the Build stages
-    for project in infra_projects:
-        codepipeline_stages.append(
-            aws.codepipeline.PipelineStageArgs(
-                name=f"Build-{project}",
-                actions=[aws.codepipeline.PipelineStageActionArgs(
-                    name=f"Build-{project}",
-                    category="Build",
-                    owner="AWS",
-                    provider="CodeBuild",
-                    input_artifacts=["source_output"],
-                    output_artifacts=[f"build_output-{project}"],
-                    version="1",
-                    configuration={
-                        "ProjectName": f"{project}-{environment}",
-                    },
-                )],
-            )
-        )
+    codepipeline_stages.append(detect_changes_stage(environment))
+    codepipeline_stages.append(build_stage(infra_projects, environment))
 
     # Create the CodePipeline
     codepipeline = aws.codepipeline.Pipeline("codepipeline",
@@ -137,6 +241,7 @@ def create_pipeline(infra_projects, buckets, roles, environment, codepipeline_so
     create_cloudwatch_events('codepipeline_source', codepipeline_source_bucket, codepipeline.arn)
     ecr_reference = pulumi.StackReference(f"pipeline-ecr-{environment}")
     codebuild_image = ecr_reference.get_output("codebuild_image")
+    create_detect_changes_project(environment, buckets, roles, codebuild_image)
     for project_name in infra_projects:
         create_codebuild_pipeline_project(environment, buckets, roles, project_name, codebuild_image)
 
@@ -146,64 +251,49 @@ def create_cloudwatch_events(resource_name, bucket, codepipelineprojectarn):
     """
     check_s3_rule = aws.cloudwatch.EventRule(f"check_s3_objects_in_{resource_name}_bucket",
         description=f"Capture when Lambda uploads buildspec in the {resource_name} bucket",
-        event_pattern=pulumi.Output.all(bucket=bucket).apply(lambda args: f"""{{
-            "source": [
-                "aws.s3"
-            ],
-            "detail-type": [
-                "AWS API Call via CloudTrail"
-            ],
-            "detail": {{
-                "eventSource": [
-                    "s3.amazonaws.com"
-                ],
-                "eventName": [
-                    "PutObject"
-                ],
-                "requestParameters": {{
-                "bucketName": [
-                    "{args['bucket']}"
-                ]
-                }}
-            }}
-        }}"""))
-    trigger_codepipeline_role = aws.iam.Role(f"trigger_codepipeline_role_{resource_name}", assume_role_policy="""{
-        "Version": "2012-10-17",
-        "Statement": [
-            {
-            "Effect": "Allow",
-            "Principal": {
-                "Service": "events.amazonaws.com"
+        event_pattern=bucket.apply(lambda bucket_name: json.dumps({
+            "source": ["aws.s3"],
+            "detail-type": ["AWS API Call via CloudTrail"],
+            "detail": {
+                "eventSource": ["s3.amazonaws.com"],
+                "eventName": ["PutObject"],
+                "requestParameters": {"bucketName": [bucket_name]},
             },
-            "Action": "sts:AssumeRole"
-            }
-        ]
-        }
-    """)
+        })))
+    trigger_codepipeline_role = aws.iam.Role(f"trigger_codepipeline_role_{resource_name}",
+        assume_role_policy=trust_policy("events.amazonaws.com"))
     aws.iam.RolePolicy(f"trigger_codebuild_functional_policy_{resource_name}",
         role=trigger_codepipeline_role.id,
-        policy=pulumi.Output.all(codepipelineprojectarn=codepipelineprojectarn).apply(lambda args: f"""{{
-            "Version": "2012-10-17",
-            "Statement": [
-                {{
-                    "Effect": "Allow",
-                    "Action": [
-                        "codepipeline:StartPipelineExecution"
-                    ],
-                    "Resource": ["{args['codepipelineprojectarn']}"]
-                }}
-            ]
-        }}
-    """))
+        policy=policy(lambda arn: [statement("codepipeline:StartPipelineExecution", arn)],
+            arn=codepipelineprojectarn))
     aws.cloudwatch.EventTarget(f"trigger_codebuild_{resource_name}",
         rule=check_s3_rule.name,
         arn=codepipelineprojectarn,
         role_arn=trigger_codepipeline_role.arn
     )
 
-def args():
-    """Handle ArgParsers Arguments"""
-    parser = argparse.ArgumentParser(description='Manage a Pulumi automation stack.')
+def attach_bucket_policies(name, roles, buckets, inline_room=INLINE_POLICY_LIMIT):
+    """Allow every role in roles to use every bucket in buckets
+
+    roles maps the names of their inline bucket policies to the roles. The buckets
+    go in that inline policy as long as it fits in inline_room, what the other
+    inline policies of the roles leave of INLINE_POLICY_LIMIT. The rest go in managed
+    policies named after name, shared by every role.
+    """
+    inline, managed = bucket_policies(buckets, inline_room)
+    if inline is not None:
+        for policy_name, role in roles.items():
+            aws.iam.RolePolicy(policy_name, role=role.name, policy=inline)
+    for index, document in enumerate(managed, start=1):
+        managed_policy = aws.iam.Policy(f"{name}-{index}", policy=document)
+        for policy_name, role in roles.items():
+            aws.iam.RolePolicyAttachment(f"{policy_name}-{index}",
+                role=role.name,
+                policy_arn=managed_policy.arn)
+
+def arg_parser(description='Manage a Pulumi automation stack.'):
+    """Create the ArgParser shared by every stack entry point"""
+    parser = argparse.ArgumentParser(description=description)
     parser.add_argument('-n', '--project-name', required=False, default='test')
     parser.add_argument('-a', '--aws-region', required=False, default='us-east-1')
     parser.add_argument('-b', '--backend-bucket', required=True)
@@ -211,26 +301,29 @@ def args():
     parser.add_argument('-k', '--kms-alias-name', required=True)
     parser.add_argument('-d', '--destroy', help='destroy the stack',
                         action='store_true')
-    return parser.parse_args()
+    parser.add_argument('-r', '--refresh', required=False, default='always',
+                        choices=REFRESH_POLICIES, help='when to refresh the stack before updating')
+    parser.add_argument('--refresh-types', nargs='*', required=False, default=[],
+                        help='resource types an adaptive refresh still refreshes, '
+                             'e.g. aws:ec2/securityGroup:SecurityGroup')
+    parser.add_argument('--refresh-max-age', type=float, required=False, default=24,
+                        help='hours after which an adaptive refresh refreshes everything')
+    parser.add_argument('--skip-unchanged', action='store_true',
+                        help='skip refresh and update when no input changed since the last update')
+    return parser
 
-def manage(arguments, project_name, pulumi_program):
-    """Pulumi up"""
-    backend_bucket = arguments.backend_bucket
-    aws_region = arguments.aws_region
-    kms_alias_name = arguments.kms_alias_name
-    stack_name = f"{project_name}-{arguments.stack_name}"
-    secrets_provider = f"awskms://alias/{kms_alias_name}"
-    backend_url = f"s3://{backend_bucket}"
-    environment = arguments.stack_name
-    if  arguments.destroy:
-        print(f"Destroying infra: {project_name}")
-    else:
-        print(f"Deploying infra: {project_name}")
+def args():
+    """Handle ArgParsers Arguments"""
+    return arg_parser().parse_args()
 
+def create_stack(arguments, project_name, pulumi_program):
+    """Create or select the stack for a project in the S3 backend"""
+    stack_name = f"{project_name}-{arguments.stack_name}"
+    secrets_provider = f"awskms://alias/{arguments.kms_alias_name}"
     project_settings=auto.ProjectSettings(
         name=project_name,
         runtime="python",
-        backend={"url": backend_url}
+        backend={"url": f"s3://{arguments.backend_bucket}"}
     )
 
     stack_settings=auto.StackSettings(
@@ -240,47 +333,84 @@ def manage(arguments, project_name, pulumi_program):
                                                   secrets_provider=secrets_provider,
                                                   stack_settings={stack_name: stack_settings})
 
-    stack = auto.create_or_select_stack(stack_name=stack_name,
-                                        project_name=project_name,
-                                        program=pulumi_program,
-                                        opts=workspace_opts)
+    return auto.create_or_select_stack(stack_name=stack_name,
+                                       project_name=project_name,
+                                       program=pulumi_program,
+                                       opts=workspace_opts)
 
+def manage(arguments, project_name, pulumi_program, on_output=print, exit_on_destroy=True):
+    """Pulumi up
+
+    on_output receives every line of progress, so concurrent stacks can tag their output.
+    When exit_on_destroy is False the destroy result is returned instead of exiting.
+    """
+    environment = arguments.stack_name
+    # Fail on an invalid environment config before the Pulumi engine starts
+    get_config(environment)
+    cache_key = f"s3://{arguments.backend_bucket}/{project_name}-{environment}"
+    if  arguments.destroy:
+        on_output(f"Destroying infra: {project_name}")
+    else:
+        on_output(f"Deploying infra: {project_name}")
 
-    print("successfully initialized stack")
+    stack = create_stack(arguments, project_name, pulumi_program)
+    on_output("successfully initialized stack")
 
     # for inline programs, we must manage plugins ourselves
-    print("installing plugins...")
-    stack.workspace.install_plugin("aws", "v4.20.0")
-    stack.workspace.install_plugin("github", "v4.4.0")
-    stack.workspace.install_plugin("docker", "v3.1.0")
-    print("plugins installed")
+    on_output("installing plugins...")
+    ensure_plugins(stack.workspace, required_plugins(pulumi_program), on_output)
+    on_output("plugins installed")
 
     # set stack configuration from argparse arguments, local environment config and/or secrets
-    print("setting up config")
-    stack.set_config("aws_region", auto.ConfigValue(value=aws_region))
+    on_output("setting up config")
+    stack.set_config("aws_region", auto.ConfigValue(value=arguments.aws_region))
     stack.set_config("environment", auto.ConfigValue(value=environment))
-    print("config set")
+    on_output("config set")
 
-    print("refreshing stack...")
-    stack.refresh(on_output=print)
-    print("refresh complete")
+    input_hash = None
+    if arguments.skip_unchanged and not arguments.destroy:
+        input_hash = program_input_hash(stack, pulumi_program, get_config(environment), environment)
+        if input_hash == last_deployed_hash(stack, cache_key):
+            on_output("inputs unchanged since the last update, skipping refresh and update")
+            return auto.UpResult(stdout="", stderr="", summary=stack.info(),
+                                 outputs=stack.outputs())
+        pulumi_program = with_input_hash(pulumi_program, input_hash)
+
+    on_output("refreshing stack...")
+    refreshed_at = refresh_stack(stack, arguments, cache_key, on_output)
+    on_output("refresh complete")
 
     if arguments.destroy:
-        stack.destroy(on_output=print)
-        print("stack destroy complete")
-        sys.exit()
+        destroy_res = stack.destroy(on_output=on_output)
+        record_state(stack, cache_key, None)
+        record_input_hash(cache_key, None)
+        on_output("stack destroy complete")
+        if exit_on_destroy:
+            sys.exit()
+        return destroy_res
 
-    print("updating stack...")
-    up_res = stack.up(on_output=print)
-    print(f"update summary: \n{json.dumps(up_res.summary.resource_changes, indent=4)}")
+    on_output("updating stack...")
+    up_res = stack.up(on_output=on_output, program=pulumi_program)
+    record_state(stack, cache_key, refreshed_at)
+    record_input_hash(cache_key, input_hash)
+    on_output(f"update summary: \n{json.dumps(up_res.summary.resource_changes, indent=4)}")
     return up_res
 
+def webhook_trigger(environment):
+    """Return how the webhook starts CodeBuild jobs in an environment
+
+    legacy (the default) writes buildspecs to S3 for CloudTrail and EventBridge to
+    pick up, direct calls StartBuild from the Lambda
+    """
+    data = get_config(environment) or {}
+    return (data.get('webhook') or {}).get('trigger', 'legacy')
+
 def get_config(environment):
-    """Load YAML Config for Processing"""
-    if os.path.exists(f"../../environments/{environment}.yaml"):
-        with open(f"../../environments/{environment}.yaml", mode="r", encoding="utf-8") as stream:
-            try:
-                return yaml.safe_load(stream)
-            except yaml.YAMLError as exc:
-                return exc
-    return None
+    """Load YAML Config for Processing
+
+    Returns None when the environment has no config file. Raises ConfigError when
+    it can't be parsed or is invalid, see environment_config.py
+    """
+    if not has_config(environment):
+        return None
+    return load_config(environment)
@@ -0,0 +1,191 @@
+"""Work out which infra projects a range of commits affects"""
+import argparse
+import functools
+import json
+import os
+import subprocess
+import sys
+
+from dependencies import project_dependencies, reverse_graph
+from environment_config import has_config, load_config
+from introspect import REPO_DIR, program_sources, project_main, reads_other_programs
+
+# A change under infra/<project>/ affects that project and every project that depends
+# on it. Each project is diffed from its own base, so a change to one of its
+# dependencies still affects it after the dependency itself was deployed. A change to
+# the main.py of any infra project also affects the projects derived from the other
+# programs (the pipeline stages come from their StackReferences). A change to one of
+# GLOBAL_PATHS affects every project. Anything else (docs, the pull request
+# buildspec, the webhook tooling, ...) affects none.
+#
+# In CodePipeline every successful build records the commit it deployed under
+# deployed/<project> in the pipeline bucket, and the Detect-Changes stage diffs
+# each project from there. Whenever that can't be done every project is affected.
+GLOBAL_PATHS = ('shared/', 'environments/', 'buildspec.yml', 'buildspec_changes.yml',
+                'requirements.txt')
+MARKER_PREFIX = 'deployed/'
+
+def git(*arguments):
+    """Run git in the repository and return its output"""
+    return subprocess.run(['git', *arguments], cwd=REPO_DIR, check=True,
+                          capture_output=True, text=True).stdout.strip()
+
+def changed_paths(base, head='HEAD'):
+    """Return the paths changed between two commits"""
+    return git('diff', '--name-only', base, head).splitlines()
+
+@functools.lru_cache(maxsize=None)
+def reads_programs(project):
+    """Whether a project's program is derived from the programs of the other projects"""
+    main_path = project_main(project)
+    return os.path.exists(main_path) and reads_other_programs(program_sources(main_path))
+
+def projects_for_paths(paths, projects):
+    """Return the projects directly changed by paths"""
+    affected = set()
+    for path in paths:
+        if path.startswith(GLOBAL_PATHS):
+            return set(projects)
+        parts = path.split('/')
+        if len(parts) > 2 and parts[0] == 'infra':
+            if parts[1] in projects:
+                affected.add(parts[1])
+            if parts[2:] == ['main.py']:
+                affected.update(project for project in projects if reads_programs(project))
+    return affected
+
+def _reachable(nodes, graph):
+    """Return nodes and every node reachable from them through graph"""
+    result = set(nodes)
+    pending = list(nodes)
+    while pending:
+        for node in graph.get(pending.pop(), []):
+            if node not in result:
+                result.add(node)
+                pending.append(node)
+    return result
+
+def with_dependents(affected, graph):
+    """Add every project that depends, directly or not, on an affected project"""
+    return _reachable(affected, reverse_graph(graph))
+
+def affected_projects(projects, bases, head, graph):
+    """Return the projects that changed, or whose dependencies changed, since their
+    base commit, and their dependents
+
+    bases maps projects to the commit they were last deployed from (None if unknown)
+    """
+    diffs = {}
+    affected = set()
+    for project in projects:
+        base = bases.get(project)
+        if base is None:
+            affected.add(project)
+            continue
+        if base not in diffs:
+            diffs[base] = projects_for_paths(changed_paths(base, head), projects)
+        if diffs[base] & _reachable([project], graph):
+            affected.add(project)
+    return with_dependents(affected, graph)
+
+def deployed_commits(bucket, projects):
+    """Read the commit each project was last deployed from out of the pipeline bucket"""
+    import boto3 # pylint: disable=import-outside-toplevel
+    s3_client = boto3.client('s3')
+    commits = {}
+    for project in projects:
+        try:
+            marker = s3_client.get_object(Bucket=bucket, Key=f"{MARKER_PREFIX}{project}")
+            commits[project] = marker['Body'].read().decode('utf-8').strip() or None
+        except s3_client.exceptions.NoSuchKey:
+            commits[project] = None
+    return commits
+
+def record_deployed(bucket, project, commit):
+    """Remember the commit a project was deployed from"""
+    import boto3 # pylint: disable=import-outside-toplevel
+    boto3.client('s3').put_object(Bucket=bucket, Key=f"{MARKER_PREFIX}{project}",
+                                  Body=commit.encode('utf-8'))
+
+def environment_config(environment):
+    """Return the config of an environment, or an empty one if it has none"""
+    return load_config(environment) if environment and has_config(environment) else {}
+
+def read_affected(path):
+    """Return the affected projects written by --output, or None if it can't be read"""
+    try:
+        with open(path, mode='r', encoding='utf-8') as affected_file:
+            return set(json.load(affected_file)['affected'])
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+def detect(arguments, projects):
+    """Return the projects affected according to arguments, or None when every
+    project has to be treated as affected
+    """
+    if arguments.affected_file:
+        affected = read_affected(arguments.affected_file)
+        if affected is None:
+            print(f"Cannot read {arguments.affected_file}, every project is affected",
+                  file=sys.stderr)
+        return affected
+    try:
+        head = git('rev-parse', arguments.head)
+        if arguments.base:
+            bases = {project: arguments.base for project in projects}
+        elif arguments.bucket:
+            bases = deployed_commits(arguments.bucket, projects)
+        else:
+            bases = {}
+        data = environment_config(arguments.stack_name)
+        graph = project_dependencies(projects, data.get('dependencies'))
+        return affected_projects(projects, bases, head, graph)
+    except Exception as error: # pylint: disable=broad-except
+        print(f"Cannot work out the changes ({error}), every project is affected",
+              file=sys.stderr)
+        return None
+
+def args():
+    """Handle ArgParsers Arguments"""
+    parser = argparse.ArgumentParser(description='List the infra projects a change affects.')
+    parser.add_argument('-s', '--stack-name', required=False,
+                        default=os.environ.get('environment'),
+                        help='environment whose infra projects are checked')
+    parser.add_argument('--base', required=False,
+                        help='commit every project is compared with')
+    parser.add_argument('--head', required=False, default='HEAD',
+                        help='commit being deployed (defaults to HEAD)')
+    parser.add_argument('--bucket', required=False,
+                        help='pipeline bucket holding the commit each project was deployed from')
+    parser.add_argument('--affected-file', required=False,
+                        help='read the affected projects written by an earlier --output')
+    parser.add_argument('-o', '--output', required=False,
+                        help='write the affected projects to this JSON file')
+    parser.add_argument('--is-affected', metavar='PROJECT', required=False,
+                        help='exit with 0 if PROJECT is affected and 1 if it is not')
+    parser.add_argument('--record', metavar='PROJECT', required=False,
+                        help='record --head as the commit PROJECT was deployed from in --bucket')
+    return parser.parse_args()
+
+def main():
+    """Print the affected projects, or answer --is-affected or --record"""
+    arguments = args()
+    if arguments.record:
+        record_deployed(arguments.bucket, arguments.record, git('rev-parse', arguments.head))
+        return 0
+    projects = environment_config(arguments.stack_name).get('infra') or []
+    affected = detect(arguments, projects)
+    if arguments.is_affected:
+        return 0 if affected is None or arguments.is_affected in affected else 1
+    if affected is None:
+        affected = set(projects)
+    if arguments.output:
+        with open(arguments.output, mode='w', encoding='utf-8') as output_file:
+            json.dump({'affected': sorted(affected)}, output_file)
+    for project in projects:
+        if project in affected:
+            print(project)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,227 @@
+"""Plan and validate the subnets of a VPC before anything is deployed"""
+import argparse
+import collections
+import ipaddress
+import json
+import sys
+
+# Networks are handled as integer intervals [first, last] of addresses. Sorting them
+# once finds every overlap in a single pass, however many subnets there are.
+#
+# Subnets come from the vpc section of environments/<env>.yaml. Names are free, and
+# a subnet either has a cidr or a prefix length to allocate. Subnets without an az
+# are spread over azs in turn. Allocations and AZs follow the order of the subnets,
+# so adding a subnet at the end never moves the others; reordering or removing
+# subnets can, unless their cidr and az are pinned in the config (cidr.py --pin):
+#
+# vpc:
+#   cidr: 10.2.0.0/16
+#   azs: [a, b, c]
+#   subnets:
+#     subnet1: {cidr: 10.2.0.0/22, type: public, az: a}
+#     workers: {prefix: 20, type: private}
+#   nat: single
+#
+# Public subnets share one route table to the internet gateway. nat sets how private
+# subnets reach the internet:
+#    * none:   they don't
+#    * single: one NAT gateway, in the first public subnet, for every AZ
+#    * per_az: a NAT gateway in the first public subnet of every AZ with private subnets
+SUBNET_TYPES = ('public', 'private')
+NAT_MODES = ('none', 'single', 'per_az')
+# Prefix lengths AWS accepts for IPv4 VPCs and subnets
+AWS_PREFIX_RANGE = (16, 28)
+DEFAULT_AZS = ('a', 'b', 'c')
+
+def network(cidr):
+    """Parse a CIDR, raising ValueError if it isn't a valid network address"""
+    try:
+        return ipaddress.ip_network(str(cidr), strict=True)
+    except ValueError as error:
+        raise ValueError(f"Invalid CIDR {cidr}: {error}") from None
+
+def interval(net):
+    """The first and last address of a network, as integers"""
+    return int(net.network_address), int(net.broadcast_address)
+
+def find_overlaps(intervals):
+    """Return (name, name) pairs of overlapping intervals
+
+    intervals maps names to (first, last). Sorted by first address, an interval
+    overlaps an earlier one exactly when it starts before the furthest end so far.
+    """
+    overlaps = []
+    furthest_name, furthest_end = None, -1
+    for name, (first, last) in sorted(intervals.items(), key=lambda item: item[1]):
+        if first <= furthest_end:
+            overlaps.append((furthest_name, name))
+        if last > furthest_end:
+            furthest_name, furthest_end = name, last
+    return overlaps
+
+def free_ranges(outer, used):
+    """Return the (first, last) ranges of outer not covered by any used interval"""
+    free = []
+    start = outer[0]
+    for first, last in sorted(used):
+        if first > start:
+            free.append((start, first - 1))
+        start = max(start, last + 1)
+    if start <= outer[1]:
+        free.append((start, outer[1]))
+    return free
+
+def allocate(outer, used, sizes):
+    """Allocate aligned blocks of addresses inside outer around the used intervals
+
+    sizes maps names to block sizes (powers of two). Blocks are placed in the order of
+    sizes, each at the lowest aligned free address, so a block only depends on the
+    blocks before it. Returns names mapped to (first, last). Raises ValueError when a
+    block doesn't fit.
+    """
+    free = free_ranges(outer, used)
+    allocated = {}
+    for name, size in sizes.items():
+        for index, (first, last) in enumerate(free):
+            start = -(-first // size) * size
+            if start + size - 1 <= last:
+                allocated[name] = (start, start + size - 1)
+                pieces = [(first, start - 1), (start + size, last)]
+                free[index:index + 1] = [piece for piece in pieces if piece[0] <= piece[1]]
+                break
+        else:
+            raise ValueError(f"No room left in the VPC for subnet {name}")
+    return allocated
+
+def _prefix(value):
+    return int(str(value).lstrip('/'))
+
+def _check_prefix(label, prefix, version):
+    if version == 4 and not AWS_PREFIX_RANGE[0] <= prefix <= AWS_PREFIX_RANGE[1]:
+        return [f"{label} must be between /{AWS_PREFIX_RANGE[0]} and /{AWS_PREFIX_RANGE[1]}"]
+    return []
+
+def _read_block(name, settings, vpc, fixed, sizes):
+    """Record the cidr of a subnet in fixed, or the size of the block to allocate
+    for it in sizes. Returns the problems found
+    """
+    try:
+        if 'cidr' in settings:
+            net = network(settings['cidr'])
+            problems = []
+            if net.version != vpc.version or not net.subnet_of(vpc):
+                problems.append(f"Subnet {name} {net} is outside the VPC {vpc}")
+            fixed[name] = interval(net)
+            return problems + _check_prefix(f"Subnet {name} /{net.prefixlen}", net.prefixlen,
+                                            vpc.version)
+        if 'prefix' in settings:
+            prefix = _prefix(settings['prefix'])
+            if not vpc.prefixlen <= prefix <= vpc.max_prefixlen:
+                return [f"Subnet {name} /{prefix} doesn't fit in the VPC {vpc}"]
+            sizes[name] = 2 ** (vpc.max_prefixlen - prefix)
+            return _check_prefix(f"Subnet {name} /{prefix}", prefix, vpc.version)
+    except ValueError as error:
+        return [f"Subnet {name}: {error}"]
+    return [f"Subnet {name} needs a cidr or a prefix"]
+
+def plan_subnets(vpc_cidr, subnets, azs=None):
+    """Return the subnets of a VPC with every CIDR allocated and checked
+
+    subnets maps names to settings (cidr or prefix, type, az). The result maps the
+    names, in their original order, to {'cidr', 'type', 'az'}. Raises ValueError
+    listing every problem found.
+    """
+    vpc = network(vpc_cidr)
+    problems = _check_prefix(f"VPC {vpc_cidr}", vpc.prefixlen, vpc.version)
+    azs = list(azs or DEFAULT_AZS)
+    planned = collections.OrderedDict()
+    fixed = {}
+    sizes = collections.OrderedDict()
+    unplaced = 0
+    for name, settings in (subnets or {}).items():
+        settings = settings or {}
+        subnet_type = settings.get('type', 'private')
+        if subnet_type not in SUBNET_TYPES:
+            problems.append(f"Subnet {name} has type {subnet_type}, not one of {SUBNET_TYPES}")
+        az = settings.get('az')
+        if az is None:
+            az = azs[unplaced % len(azs)]
+            unplaced += 1
+        planned[name] = {'cidr': None, 'type': subnet_type, 'az': az}
+        problems += _read_block(name, settings, vpc, fixed, sizes)
+        if name in fixed:
+            planned[name]['cidr'] = str(network(settings['cidr']))
+    problems += [f"Subnets {first} and {second} overlap"
+                 for first, second in find_overlaps(fixed)]
+    if not problems:
+        try:
+            for name, (first, _) in allocate(interval(vpc), fixed.values(), sizes).items():
+                planned[name]['cidr'] = str(type(vpc)(
+                    (first, vpc.max_prefixlen - sizes[name].bit_length() + 1)))
+        except ValueError as error:
+            problems.append(str(error))
+    if problems:
+        raise ValueError("Invalid VPC subnets:\n  " + "\n  ".join(problems))
+    return planned
+
+def plan_vpc(vpc_config):
+    """Plan the subnets of the vpc section of an environment config"""
+    return plan_subnets(vpc_config['cidr'], vpc_config.get('subnets'), vpc_config.get('azs'))
+
+def subnet_tiers(plan):
+    """Group the subnets of a plan by type, then by AZ, keeping their order"""
+    tiers = {subnet_type: collections.OrderedDict() for subnet_type in SUBNET_TYPES}
+    for name, subnet in plan.items():
+        tiers[subnet['type']].setdefault(subnet['az'], []).append(name)
+    return tiers
+
+def nat_subnets(tiers, mode='none'):
+    """Map every AZ with private subnets to the public subnet of its NAT gateway
+
+    Raises ValueError for an unknown mode, or when a NAT gateway has no public
+    subnet to go in.
+    """
+    if mode not in NAT_MODES:
+        raise ValueError(f"nat is {mode}, not one of {NAT_MODES}")
+    if mode == 'none' or not tiers['private']:
+        return {}
+    public = tiers['public']
+    if mode == 'single':
+        if not public:
+            raise ValueError("nat: single needs a public subnet")
+        first = next(iter(public.values()))[0]
+        return {az: first for az in tiers['private']}
+    missing = [az for az in tiers['private'] if az not in public]
+    if missing:
+        raise ValueError(f"nat: per_az needs a public subnet in AZs {', '.join(missing)}")
+    return {az: public[az][0] for az in tiers['private']}
+
+def pinned(plan):
+    """The subnets section of a config that keeps every subnet of plan where it is"""
+    return {'subnets': {name: dict(subnet) for name, subnet in plan.items()}}
+
+def main():
+    """Print the subnet plan of an environment, or why it is invalid"""
+    # Loading the config checks the subnets and NAT placement. environment_config
+    # imports this module, so it is only imported when run as a script
+    # pylint: disable=import-outside-toplevel
+    import yaml
+    from environment_config import load_config # pylint: disable=cyclic-import
+    parser = argparse.ArgumentParser(description='Plan and check the subnets of a VPC.')
+    parser.add_argument('-s', '--stack-name', required=False, default='dev')
+    parser.add_argument('--pin', action='store_true',
+                        help='print the subnets section with every cidr and az written out')
+    arguments = parser.parse_args()
+    try:
+        plan = plan_vpc(load_config(arguments.stack_name)['vpc'])
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        return 1
+    if arguments.pin:
+        print(yaml.safe_dump(pinned(plan), default_flow_style=False, sort_keys=False), end='')
+    else:
+        print(json.dumps(plan, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
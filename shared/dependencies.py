@@ -0,0 +1,67 @@
+"""Dependency graphs between the infra stacks of an environment"""
+from introspect import project_main, program_sources, stack_references
+
+# Graphs map every project to the sorted list of projects it depends on.
+# Dependencies come from the StackReferences in each program, plus any declared in
+# the dependencies section of environments/<env>.yaml for what can't be inferred:
+#
+# dependencies:
+#   pipeline:
+#     - pipeline-webhook
+
+def infer_dependencies(projects):
+    """Map every project to the projects its program references"""
+    graph = {}
+    for project in projects:
+        references = stack_references(program_sources(project_main(project)))
+        graph[project] = sorted(ref for ref in references if ref in projects and ref != project)
+    return graph
+
+def project_dependencies(projects, declared=None):
+    """Map every project to its inferred and declared dependencies among projects"""
+    graph = infer_dependencies(projects)
+    for project, dependencies in (declared or {}).items():
+        if project in graph:
+            extra = [dependency for dependency in dependencies or []
+                     if dependency in projects and dependency != project]
+            graph[project] = sorted(set(graph[project]) | set(extra))
+    return graph
+
+def reverse_graph(graph):
+    """Invert a dependency graph so dependents come first, for destroys"""
+    reverse = {node: [] for node in graph}
+    for node, dependencies in graph.items():
+        for dependency in dependencies:
+            reverse[dependency].append(node)
+    return {node: sorted(dependents) for node, dependents in reverse.items()}
+
+def topological_order(graph):
+    """Return the nodes of graph with every node after its dependencies
+    Raises ValueError if the graph has a cycle
+    """
+    order = []
+    state = {}
+    def visit(node, path):
+        if state.get(node) == 'done':
+            return
+        if state.get(node) == 'visiting':
+            raise ValueError(f"Stack dependency cycle: {' -> '.join(path + [node])}")
+        state[node] = 'visiting'
+        for dependency in graph[node]:
+            visit(dependency, path + [node])
+        state[node] = 'done'
+        order.append(node)
+    for node in graph:
+        visit(node, [])
+    return order
+
+def dependency_levels(graph):
+    """Map every node to the length of the longest dependency chain below it
+
+    Nodes on the same level don't depend on each other, so they can run together.
+    Raises ValueError if the graph has a cycle
+    """
+    levels = {}
+    for node in topological_order(graph):
+        levels[node] = 1 + max((levels[dependency] for dependency in graph[node]), default=-1)
+    return levels
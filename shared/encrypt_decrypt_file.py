@@ -13,21 +13,144 @@
 # NOTICE: Modified from the original to meet PyLint tests
 
 import base64
+import glob
+import hashlib
+import io
+import json
 import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from local_cache import read_entry, write_entry
 
 # To perform the optional file encryption/decryption operations, the Python
 # cryptography package must be installed.
 #       pip install cryptography
-from cryptography.fernet import Fernet
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 
-# snippet-start:[kms.python.retrieve-cmk]
-def retrieve_cmk(desc):
+# Connections kept open per client, enough for a concurrent CMK scan or batch
+CLIENT_MAX_POOL_CONNECTIONS = 16
+# Seconds and number of entries decrypted data keys are kept in memory for
+DATA_KEY_CACHE_TTL = 5 * 60
+DATA_KEY_CACHE_SIZE = 64
+
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+_DATA_KEYS = OrderedDict()
+_DATA_KEYS_LOCK = threading.Lock()
+
+
+def get_client(service):
+    """Return the process-wide boto3 client for service
+
+    Clients are thread-safe and expensive to build, so every function in this
+    module shares one pooled client per service.
+    """
+    with _CLIENTS_LOCK:
+        if service not in _CLIENTS:
+            _CLIENTS[service] = boto3.session.Session().client(
+                service,
+                config=Config(max_pool_connections=CLIENT_MAX_POOL_CONNECTIONS,
+                              retries={'mode': 'adaptive'}))
+        return _CLIENTS[service]
+
+
+def _cached_data_key(data_key_encrypted):
+    """Return a cached plaintext data key, or None if missing or expired"""
+    with _DATA_KEYS_LOCK:
+        entry = _DATA_KEYS.get(data_key_encrypted)
+        if entry is None:
+            return None
+        expires, data_key_plaintext = entry
+        if expires < time.monotonic():
+            del _DATA_KEYS[data_key_encrypted]
+            return None
+        _DATA_KEYS.move_to_end(data_key_encrypted)
+        return data_key_plaintext
+
+
+def _cache_data_key(data_key_encrypted, data_key_plaintext):
+    """Remember a plaintext data key, evicting the least recently used one when full"""
+    with _DATA_KEYS_LOCK:
+        _DATA_KEYS[data_key_encrypted] = (time.monotonic() + DATA_KEY_CACHE_TTL,
+                                          data_key_plaintext)
+        _DATA_KEYS.move_to_end(data_key_encrypted)
+        while len(_DATA_KEYS) > DATA_KEY_CACHE_SIZE:
+            _DATA_KEYS.popitem(last=False)
+
+
+def clear_data_key_cache():
+    """Forget every cached plaintext data key"""
+    with _DATA_KEYS_LOCK:
+        _DATA_KEYS.clear()
+
+
+# Alias created for the Pulumi state key by shared-state
+DEFAULT_CMK_ALIAS = 'alias/pulumi-secret-encryption'
+# Seconds a CMK found by scanning every key is remembered for
+CMK_CACHE_TTL = 24 * 60 * 60
+# Number of describe_key calls made at the same time while scanning
+CMK_SCAN_WORKERS = 8
+
+
+def _retrieve_cmk_by_alias(kms_client, desc, alias):
+    """Resolve a CMK through its alias, checking it has the expected description"""
+    try:
+        key_info = kms_client.describe_key(KeyId=alias)
+    except ClientError as error:
+        logging.debug(error)
+        return None, None
+    if key_info['KeyMetadata']['Description'] != desc:
+        logging.debug('%s does not point at a CMK described as %s', alias, desc)
+        return None, None
+    return key_info['KeyMetadata']['KeyId'], key_info['KeyMetadata']['Arn']
+
+
+def _scan_cmks(kms_client, desc):
+    """Describe every CMK, a page at a time and concurrently within a page, until
+    one matches desc
+    """
+    def describe(cmk):
+        return cmk, kms_client.describe_key(KeyId=cmk['KeyArn'])
+
+    # If more than 100 keys exist, retrieve and process them in batches
+    response = kms_client.list_keys()
+    with ThreadPoolExecutor(max_workers=CMK_SCAN_WORKERS) as executor:
+        while True:
+            for cmk, key_info in executor.map(describe, response['Keys']):
+                # Is this the key we're looking for?
+                if key_info['KeyMetadata']['Description'] == desc:
+                    return cmk['KeyId'], cmk['KeyArn']
+
+            # Are there more keys to retrieve?
+            if not response['Truncated']:
+                # No, the CMK was not found
+                logging.debug('A CMK with the specified description was not found')
+                return None, None
+            # Yes, retrieve another batch
+            response = kms_client.list_keys(Marker=response['NextMarker'])
+
+
+def retrieve_cmk(desc, alias=DEFAULT_CMK_ALIAS, ttl=CMK_CACHE_TTL):
     """Retrieve an existing KMS CMK based on its description
 
+    The alias is tried first. Otherwise a CMK found by scanning every key is
+    cached locally for ttl seconds, per account, region and description.
+
     :param desc: Description of CMK specified when the CMK was created
+    :param alias: Alias expected to point at the CMK, or None to skip it
+    :param ttl: Seconds to cache the result of a scan
     :return Tuple(KeyId, KeyArn) where:
         KeyId: CMK ID
         KeyArn: Amazon Resource Name of CMK
@@ -35,45 +158,27 @@ def retrieve_cmk(desc):
     not found
     """
 
-    # Retrieve a list of existing CMKs
-    # If more than 100 keys exist, retrieve and process them in batches
-    kms_client = boto3.client('kms')
+    kms_client = get_client('kms')
+    if alias:
+        cmk_id, cmk_arn = _retrieve_cmk_by_alias(kms_client, desc, alias)
+        if cmk_id:
+            return cmk_id, cmk_arn
+
     try:
-        response = kms_client.list_keys()
+        account = get_client('sts').get_caller_identity()['Account']
+        cache_key = f"{account}/{kms_client.meta.region_name}/{desc}"
+        cached = read_entry('cmk', cache_key, ttl)
+        if cached:
+            return cached['KeyId'], cached['KeyArn']
+
+        cmk_id, cmk_arn = _scan_cmks(kms_client, desc)
     except ClientError as error:
         logging.error(error)
         return None, None
 
-    done = False
-    while not done:
-        for cmk in response['Keys']:
-            # Get info about the key, including its description
-            try:
-                key_info = kms_client.describe_key(KeyId=cmk['KeyArn'])
-            except ClientError as error:
-                logging.error(error)
-                return None, None
-
-            # Is this the key we're looking for?
-            if key_info['KeyMetadata']['Description'] == desc:
-                return cmk['KeyId'], cmk['KeyArn']
-
-        # Are there more keys to retrieve?
-        if not response['Truncated']:
-            # No, the CMK was not found
-            logging.debug('A CMK with the specified description was not found')
-            done = True
-        else:
-            # Yes, retrieve another batch
-            try:
-                response = kms_client.list_keys(Marker=response['NextMarker'])
-            except ClientError as error:
-                logging.error(error)
-                return None, None
-
-    # All existing CMKs were checked and the desired key was not found
-    return None, None
-# snippet-end:[kms.python.retrieve-cmk]
+    if cmk_id:
+        write_entry('cmk', cache_key, {'KeyId': cmk_id, 'KeyArn': cmk_arn})
+    return cmk_id, cmk_arn
 
 
 # snippet-start:[kms.python.create_cmk]
@@ -90,7 +195,7 @@ def create_cmk(desc='Customer Master Key'):
     """
 
     # Create CMK
-    kms_client = boto3.client('kms')
+    kms_client = get_client('kms')
     try:
         response = kms_client.create_key(Description=desc)
     except ClientError as error:
@@ -118,15 +223,19 @@ def create_data_key(cmk_id, key_spec='AES_256'):
     """
 
     # Create data key
-    kms_client = boto3.client('kms')
+    kms_client = get_client('kms')
     try:
         response = kms_client.generate_data_key(KeyId=cmk_id, KeySpec=key_spec)
     except ClientError as error:
         logging.error(error)
         return None, None
 
+    # Remember the plaintext so decrypting with this key doesn't call KMS
+    data_key_plaintext = base64.b64encode(response['Plaintext'])
+    _cache_data_key(response['CiphertextBlob'], data_key_plaintext)
+
     # Return the encrypted and plaintext data key
-    return response['CiphertextBlob'], base64.b64encode(response['Plaintext'])
+    return response['CiphertextBlob'], data_key_plaintext
 # snippet-end:[kms.python.create_data_key]
 
 
@@ -134,13 +243,20 @@ def create_data_key(cmk_id, key_spec='AES_256'):
 def decrypt_data_key(data_key_encrypted):
     """Decrypt an encrypted data key
 
+    Decrypted keys are cached in memory for DATA_KEY_CACHE_TTL seconds, so
+    files sharing a data key cost a single KMS Decrypt call.
+
     :param data_key_encrypted: Encrypted ciphertext data key.
     :return Plaintext base64-encoded binary data key as binary string
     :return None if error
     """
 
+    data_key_plaintext = _cached_data_key(data_key_encrypted)
+    if data_key_plaintext is not None:
+        return data_key_plaintext
+
     # Decrypt the data key
-    kms_client = boto3.client('kms')
+    kms_client = get_client('kms')
     try:
         response = kms_client.decrypt(CiphertextBlob=data_key_encrypted)
     except ClientError as error:
@@ -148,7 +264,9 @@ def decrypt_data_key(data_key_encrypted):
         return None
 
     # Return plaintext base64-encoded binary data key
-    return base64.b64encode((response['Plaintext']))
+    data_key_plaintext = base64.b64encode((response['Plaintext']))
+    _cache_data_key(data_key_encrypted, data_key_plaintext)
+    return data_key_plaintext
 # snippet-end:[kms.python.decrypt_data_key]
 
 
@@ -156,9 +274,140 @@ def decrypt_data_key(data_key_encrypted):
 # encrypted data key. Used by encrypt_file() and decrypt_file().
 NUM_BYTES_FOR_LEN = 4
 
+# Streaming format, written after the encrypted data key:
+#   STREAM_MAGIC | chunk size (4 bytes) | nonce prefix (8 bytes)
+#   then one frame per chunk: final flag (1 byte) | length (4 bytes) | AES-GCM ciphertext
+# Each chunk is authenticated with its index and final flag, so chunks can't be
+# reordered, dropped or truncated. Files written before the streaming format
+# hold a single Fernet token here instead, which always starts with "gAAAAA".
+STREAM_MAGIC = b'\x00PBSTREAM1'
+STREAM_CHUNK_SIZE = 64 * 1024
+# Largest chunk size decrypt_stream() accepts, so a corrupt header can't make it
+# read an arbitrarily large frame into memory
+MAX_STREAM_CHUNK_SIZE = 16 * 1024 * 1024
+NUM_BYTES_FOR_NONCE_PREFIX = 8
+NUM_BYTES_FOR_INDEX = 4
+NUM_BYTES_FOR_TAG = 16
+
+
+def _chunk_aad(header, index, final):
+    """Associated data binding a chunk to its file header, position and finality"""
+    return header + index.to_bytes(NUM_BYTES_FOR_INDEX, byteorder='big') + bytes([final])
+
+
+def encrypt_stream(source, destination, data_key_plaintext, chunk_size=STREAM_CHUNK_SIZE):
+    """Encrypt the source file object into destination in authenticated chunks
+
+    Only one chunk (plus one chunk of look-ahead) is held in memory at a time.
+
+    :param source: Readable binary file object
+    :param destination: Writable binary file object
+    :param data_key_plaintext: Plaintext base64-encoded data key as binary string
+    :param chunk_size: Number of plaintext bytes per chunk
+    """
+    aesgcm = AESGCM(base64.b64decode(data_key_plaintext))
+    nonce_prefix = os.urandom(NUM_BYTES_FOR_NONCE_PREFIX)
+    header = STREAM_MAGIC + chunk_size.to_bytes(NUM_BYTES_FOR_LEN, byteorder='big') + nonce_prefix
+    destination.write(header)
+
+    index = 0
+    chunk = source.read(chunk_size)
+    while True:
+        next_chunk = source.read(chunk_size)
+        final = not next_chunk
+        nonce = nonce_prefix + index.to_bytes(NUM_BYTES_FOR_INDEX, byteorder='big')
+        encrypted_chunk = aesgcm.encrypt(nonce, chunk, _chunk_aad(header, index, final))
+        destination.write(bytes([final]))
+        destination.write(len(encrypted_chunk).to_bytes(NUM_BYTES_FOR_LEN, byteorder='big'))
+        destination.write(encrypted_chunk)
+        if final:
+            return
+        chunk = next_chunk
+        index += 1
+
+
+def decrypt_stream(source, destination, data_key_plaintext):
+    """Decrypt chunks written by encrypt_stream() from source into destination
+
+    source must be positioned just after STREAM_MAGIC.
+
+    :raise ValueError: if the stream is truncated or fails authentication
+    """
+    chunk_size_bytes = source.read(NUM_BYTES_FOR_LEN)
+    nonce_prefix = source.read(NUM_BYTES_FOR_NONCE_PREFIX)
+    header = STREAM_MAGIC + chunk_size_bytes + nonce_prefix
+    chunk_size = int.from_bytes(chunk_size_bytes, byteorder='big')
+    if not 0 < chunk_size <= MAX_STREAM_CHUNK_SIZE:
+        raise ValueError(f'Invalid chunk size {chunk_size}')
+    aesgcm = AESGCM(base64.b64decode(data_key_plaintext))
+
+    index = 0
+    while True:
+        frame_header = source.read(1 + NUM_BYTES_FOR_LEN)
+        if len(frame_header) != 1 + NUM_BYTES_FOR_LEN:
+            raise ValueError('Encrypted stream is truncated')
+        final = frame_header[0]
+        encrypted_len = int.from_bytes(frame_header[1:], byteorder='big')
+        if encrypted_len > chunk_size + NUM_BYTES_FOR_TAG:
+            raise ValueError(f'Chunk {index} is larger than the chunk size')
+        encrypted_chunk = source.read(encrypted_len)
+        nonce = nonce_prefix + index.to_bytes(NUM_BYTES_FOR_INDEX, byteorder='big')
+        try:
+            destination.write(aesgcm.decrypt(nonce, encrypted_chunk,
+                                             _chunk_aad(header, index, final)))
+        except InvalidTag as error:
+            raise ValueError(f'Chunk {index} failed authentication') from error
+        if final:
+            if source.read(1):
+                raise ValueError('Unexpected data after the final chunk')
+            return
+        index += 1
+
+
+def _read_data_key(file):
+    """Read the length-prefixed encrypted data key at the start of an encrypted file"""
+    data_key_encrypted_len = int.from_bytes(file.read(NUM_BYTES_FOR_LEN), byteorder='big')
+    return file.read(data_key_encrypted_len)
+
+
+def _file_digest(path):
+    """Return the SHA-256 hex digest and size of a file, read in chunks"""
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(STREAM_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+            size += len(chunk)
+    return sha256.hexdigest(), size
+
+
+def _encrypt_with_data_key(filename, data_key_encrypted, data_key_plaintext, chunk_size):
+    """Write <filename>.encrypted using an existing data key
+
+    The file is written next to it under a temporary name and only replaces
+    <filename>.encrypted once it is complete.
+
+    :return Tuple(sha256, size) of the encrypted file
+    """
+    descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                             suffix='.encrypted.tmp')
+    try:
+        with open(filename, 'rb') as file, os.fdopen(descriptor, 'wb') as file_encrypted:
+            file_encrypted.write(len(data_key_encrypted).to_bytes(NUM_BYTES_FOR_LEN,
+                                                                  byteorder='big'))
+            file_encrypted.write(data_key_encrypted)
+            encrypt_stream(file, file_encrypted, data_key_plaintext, chunk_size)
+        digest = _file_digest(temp_path)
+        os.replace(temp_path, filename + '.encrypted')
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return digest
+
 
 # snippet-start:[kms.python.encrypt_file]
-def encrypt_file(filename, cmk_id):
+def encrypt_file(filename, cmk_id, chunk_size=STREAM_CHUNK_SIZE):
     """Encrypt a file using an AWS KMS CMK
 
     A data key is generated and associated with the CMK.
@@ -166,21 +415,15 @@ def encrypt_file(filename, cmk_id):
     file to be decrypted at any time in the future and by any program that
     has the credentials to decrypt the data key.
     The encrypted file is saved to <filename>.encrypted
-    Limitation: The contents of filename must fit in memory.
+    The file is encrypted in chunks of chunk_size bytes, so it never has to
+    fit in memory.
 
     :param filename: File to encrypt
     :param cmk_id: AWS KMS CMK ID or ARN
+    :param chunk_size: Number of plaintext bytes per encrypted chunk
     :return: True if file was encrypted. Otherwise, False.
     """
 
-    # Read the entire file into memory
-    try:
-        with open(filename, 'rb') as file:
-            file_contents = file.read()
-    except IOError as error:
-        logging.error(error)
-        return False
-
     # Generate a data key associated with the CMK
     # The data key is used to encrypt the file. Each file can use its own
     # data key or data keys can be shared among files.
@@ -190,17 +433,9 @@ def encrypt_file(filename, cmk_id):
         return False
     logging.info('Created new AWS KMS data key')
 
-    # Encrypt the file
-    plaintext_file = Fernet(data_key_plaintext)
-    file_contents_encrypted = plaintext_file.encrypt(file_contents)
-
-    # Write the encrypted data key and encrypted file contents together
+    # Write the encrypted data key followed by the encrypted chunks
     try:
-        with open(filename + '.encrypted', 'wb') as file_encrypted:
-            file_encrypted.write(len(data_key_encrypted).to_bytes(NUM_BYTES_FOR_LEN,
-                                                                  byteorder='big'))
-            file_encrypted.write(data_key_encrypted)
-            file_encrypted.write(file_contents_encrypted)
+        _encrypt_with_data_key(filename, data_key_encrypted, data_key_plaintext, chunk_size)
     except IOError as error:
         logging.error(error)
         return False
@@ -213,53 +448,300 @@ def encrypt_file(filename, cmk_id):
 # snippet-end:[kms.python.encrypt_file]
 
 
+def _decrypt_into(filename, destination):
+    """Decrypt <filename>.encrypted into the destination file object
+
+    :raise IOError, ValueError or InvalidToken: if the file can't be decrypted
+    """
+    with open(filename + '.encrypted', 'rb') as file:
+        # The first NUM_BYTES_FOR_LEN bytes contain the integer length of the
+        # encrypted data key, followed by the encrypted data key itself.
+        data_key_encrypted = _read_data_key(file)
+
+        # Decrypt the data key before using it
+        data_key_plaintext = decrypt_data_key(data_key_encrypted)
+        if data_key_plaintext is None:
+            raise ValueError('Cannot decrypt the data key')
+
+        if file.read(len(STREAM_MAGIC)) == STREAM_MAGIC:
+            decrypt_stream(file, destination, data_key_plaintext)
+        else:
+            # Original format: the rest of the file is a single Fernet token
+            file.seek(NUM_BYTES_FOR_LEN + len(data_key_encrypted))
+            destination.write(Fernet(data_key_plaintext).decrypt(file.read()))
+
+
 # snippet-start:[kms.python.decrypt_file]
 def decrypt_file(filename):
     """Decrypt a file encrypted by encrypt_file()
 
     The encrypted file is read from <filename>.encrypted
     The decrypted file is written to <filename>.decrypted
+    Both the streaming format and the original single Fernet token format
+    are supported. Only the latter has to fit in memory.
 
     :param filename: File to decrypt
     :return: True if file was decrypted. Otherwise, False.
     """
 
-    # Read the encrypted file into memory
     try:
-        with open(filename + '.encrypted', 'rb') as file:
-            file_contents = file.read()
-    except IOError as error:
+        with open(filename + '.decrypted', 'wb') as file_decrypted:
+            _decrypt_into(filename, file_decrypted)
+    except (IOError, ValueError, InvalidToken) as error:
         logging.error(error)
+        if os.path.exists(filename + '.decrypted'):
+            os.remove(filename + '.decrypted')
         return False
 
-    # The first NUM_BYTES_FOR_LEN bytes contain the integer length of the
-    # encrypted data key.
-    # Add NUM_BYTES_FOR_LEN to get index of end of encrypted data key/start
-    # of encrypted data.
-    data_key_encrypted_len = int.from_bytes(file_contents[:NUM_BYTES_FOR_LEN],
-                                            byteorder='big') \
-                             + NUM_BYTES_FOR_LEN
-    data_key_encrypted = file_contents[NUM_BYTES_FOR_LEN:data_key_encrypted_len]
-
-    # Decrypt the data key before using it
-    data_key_plaintext = decrypt_data_key(data_key_encrypted)
-    if data_key_plaintext is None:
-        logging.error("Cannot decrypt the data key")
-        return False
+    # The same security issue described at the end of encrypt_file() exists
+    # here, too, i.e., the wish to wipe the data_key_plaintext value from
+    # memory.
+    return True
+# snippet-end:[kms.python.decrypt_file]
 
-    # Decrypt the rest of the file
-    encrypted_file = Fernet(data_key_plaintext)
-    file_contents_decrypted = encrypted_file.decrypt(file_contents[data_key_encrypted_len:])
 
-    # Write the decrypted file contents
+# Written next to a batch of encrypted files by encrypt_files()
+MANIFEST_FILE = 'encrypted-manifest.json'
+BATCH_WORKERS = 8
+
+
+def _expand(paths, suffix=''):
+    """Expand files, directories and glob patterns into a sorted list of files
+
+    With a suffix, paths name the files without it: the suffix is added to every
+    pattern that doesn't end with it, so environments/*.json matches
+    environments/*.json<suffix>, and removed from the files found.
+
+    :return Tuple(files, paths that matched no file)
+    """
+    files = set()
+    unmatched = []
+    for path in paths:
+        pattern = os.path.join(path, '*') if os.path.isdir(path) else path
+        if suffix and not pattern.endswith(suffix):
+            pattern += suffix
+        matches = [match for match in glob.glob(pattern)
+                   if os.path.basename(match) != MANIFEST_FILE and not os.path.isdir(match)]
+        if suffix:
+            matches = [match[:-len(suffix)] for match in matches]
+        else:
+            matches = [match for match in matches
+                       if not match.endswith(('.encrypted', '.decrypted'))]
+        if not matches:
+            unmatched.append(path)
+        files.update(matches)
+    return sorted(files), unmatched
+
+
+def _write_manifest(manifest, results, data_key_encrypted):
+    """Write the manifest of a batch from (filename, (sha256, size)) results
+
+    manifest defaults to MANIFEST_FILE in the files' common directory.
+    """
+    if manifest is None:
+        common_dir = os.path.commonpath([os.path.dirname(os.path.abspath(filename))
+                                         for filename, _ in results])
+        manifest = os.path.join(common_dir, MANIFEST_FILE)
+    base_dir = os.path.dirname(os.path.abspath(manifest))
+    entries = {}
+    for filename, (sha256, size) in results:
+        relative = os.path.relpath(os.path.abspath(filename + '.encrypted'), base_dir)
+        entries[relative] = {'sha256': sha256, 'size': size}
+    with open(manifest, 'w', encoding='utf-8') as manifest_file:
+        json.dump({'data_key': base64.b64encode(data_key_encrypted).decode('ascii'),
+                   'files': entries}, manifest_file, indent=2, sort_keys=True)
+
+
+def encrypt_files(paths, cmk_id, manifest=None, workers=BATCH_WORKERS,
+                  chunk_size=STREAM_CHUNK_SIZE):
+    """Encrypt a batch of files with a single data key
+
+    Every file is written to <filename>.encrypted by a pool of threads. A manifest
+    with the SHA-256 and size of each encrypted file is written so their integrity
+    can be checked without decrypting them (see verify_manifest()).
+
+    :param paths: Files, directories or glob patterns to encrypt
+    :param cmk_id: AWS KMS CMK ID or ARN
+    :param manifest: Manifest path. Defaults to MANIFEST_FILE in the files' common directory
+    :return: List of the files that were encrypted, or None if error
+    """
+    files, unmatched = _expand(paths)
+    if unmatched:
+        logging.error('No files to encrypt in %s', ', '.join(unmatched))
+        return None
+
+    # One data key for the whole batch
+    data_key_encrypted, data_key_plaintext = create_data_key(cmk_id)
+    if data_key_encrypted is None:
+        return None
+    logging.info('Created new AWS KMS data key for %d files', len(files))
+
+    def encrypt(filename):
+        return filename, _encrypt_with_data_key(filename, data_key_encrypted,
+                                                data_key_plaintext, chunk_size)
+
     try:
-        with open(filename + '.decrypted', 'wb') as file_decrypted:
-            file_decrypted.write(file_contents_decrypted)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(encrypt, files))
+        _write_manifest(manifest, results, data_key_encrypted)
     except IOError as error:
         logging.error(error)
-        return False
+        return None
+    return files
 
-    # The same security issue described at the end of encrypt_file() exists
-    # here, too, i.e., the wish to wipe the data_key_plaintext value from
-    # memory.
-    return True
+
+def verify_manifest(manifest):
+    """Check the encrypted files listed in a manifest without decrypting them
+
+    :param manifest: Manifest written by encrypt_files()
+    :return: List of the encrypted files that are missing or don't match
+    """
+    with open(manifest, 'r', encoding='utf-8') as manifest_file:
+        entries = json.load(manifest_file)['files']
+    base_dir = os.path.dirname(os.path.abspath(manifest))
+    mismatched = []
+    for relative, expected in sorted(entries.items()):
+        try:
+            sha256, _ = _file_digest(os.path.join(base_dir, relative))
+        except IOError:
+            mismatched.append(relative)
+            continue
+        if sha256 != expected['sha256']:
+            mismatched.append(relative)
+    return mismatched
+
+
+def decrypt_files(paths, workers=BATCH_WORKERS):
+    """Decrypt a batch of files encrypted by encrypt_file() or encrypt_files()
+
+    Each distinct data key is decrypted once up front, then the files are
+    decrypted to <filename>.decrypted by a pool of threads.
+
+    :param paths: Files, directories or glob patterns, with or without .encrypted
+    :return: List of the files that could not be decrypted, and of the paths
+             that matched no encrypted file
+    """
+    files, unmatched = _expand(paths, suffix='.encrypted')
+    for path in unmatched:
+        logging.error('No encrypted files in %s', path)
+    data_keys = set()
+    for filename in files:
+        try:
+            with open(filename + '.encrypted', 'rb') as file:
+                data_keys.add(_read_data_key(file))
+        except IOError as error:
+            logging.error(error)
+    for data_key_encrypted in data_keys:
+        decrypt_data_key(data_key_encrypted)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        decrypted = executor.map(decrypt_file, files)
+    return unmatched + [filename for filename, success in zip(files, decrypted) if not success]
+
+
+def decrypt_to_bytes(filename):
+    """Decrypt <filename>.encrypted in memory, without writing plaintext to disk
+
+    :param filename: File to decrypt
+    :return: The decrypted contents, or None if error
+    """
+    decrypted = io.BytesIO()
+    try:
+        _decrypt_into(filename, decrypted)
+    except (IOError, ValueError, InvalidToken) as error:
+        logging.error(error)
+        return None
+    return decrypted.getvalue()
+
+
+# Tokens skipped while indexing a JSON object: strings and brackets
+_JSON_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[\[\]{}]')
+_JSON_STRING = re.compile(r'"(?:[^"\\]|\\.)*"')
+_JSON_SCALAR = re.compile(r'[^,}\]\s]+')
+_JSON_WHITESPACE = re.compile(r'\s*')
+
+
+def _skip_json_value(text, start):
+    """Return the index just after the JSON value starting at start, without parsing it"""
+    if text.startswith('"', start):
+        return _JSON_STRING.match(text, start).end()
+    if text[start:start + 1] not in ('{', '['):
+        return _JSON_SCALAR.match(text, start).end()
+    depth = 0
+    for token in _JSON_TOKEN.finditer(text, start):
+        if token.group().startswith('"'):
+            continue
+        depth += 1 if token.group() in '{[' else -1
+        if depth == 0:
+            return token.end()
+    raise ValueError('Unterminated JSON value')
+
+
+def _index_json_object(text):
+    """Map every top-level key of a JSON object to the (start, end) span of its value"""
+    spans = {}
+    pos = _JSON_WHITESPACE.match(text).end()
+    if not text.startswith('{', pos):
+        raise ValueError('Expected a JSON object')
+    pos = _JSON_WHITESPACE.match(text, pos + 1).end()
+    if text.startswith('}', pos):
+        return spans
+    while True:
+        if not text.startswith('"', pos):
+            raise ValueError(f'Expected a key at position {pos}')
+        key, pos = json.decoder.scanstring(text, pos + 1)
+        pos = _JSON_WHITESPACE.match(text, pos).end()
+        if not text.startswith(':', pos):
+            raise ValueError(f'Expected ":" at position {pos}')
+        start = _JSON_WHITESPACE.match(text, pos + 1).end()
+        end = _skip_json_value(text, start)
+        spans[key] = (start, end)
+        pos = _JSON_WHITESPACE.match(text, end).end()
+        if text.startswith('}', pos):
+            return spans
+        if not text.startswith(',', pos):
+            raise ValueError(f'Expected "," or "}}" at position {pos}')
+        pos = _JSON_WHITESPACE.match(text, pos + 1).end()
+
+
+class LazySecrets(Mapping):
+    """Read-only mapping over a decrypted JSON object
+
+    Only the top-level keys are indexed up front. Each value is parsed the first
+    time it is read, so large secret maps are only parsed as far as needed.
+    """
+
+    def __init__(self, text):
+        self._text = text
+        self._spans = _index_json_object(text)
+        self._values = {}
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            start, end = self._spans[key]
+            self._values[key] = json.loads(self._text[start:end])
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._spans)
+
+    def __len__(self):
+        return len(self._spans)
+
+
+def decrypt_to_json(filename, lazy=False):
+    """Decrypt <filename>.encrypted in memory and parse it as JSON
+
+    :param filename: File to decrypt
+    :param lazy: Return a LazySecrets mapping that parses values on access
+    :return: The parsed document, or None if error
+    """
+    decrypted = decrypt_to_bytes(filename)
+    if decrypted is None:
+        return None
+    try:
+        text = decrypted.decode('utf-8')
+        return LazySecrets(text) if lazy else json.loads(text)
+    except ValueError as error:
+        logging.error(error)
+        return None
@@ -0,0 +1,215 @@
+"""Load, overlay and validate the environment configs in environments/"""
+import os
+import threading
+import yaml
+from cidr import plan_vpc, subnet_tiers, nat_subnets
+from introspect import REPO_DIR, project_main
+
+# environments/<env>.yaml is parsed once per process and parsed again only when the
+# modification time or size of one of its files changes. An environment can start
+# from another one and only set what differs:
+#
+# extends: dev
+# webhook:
+#   trigger: direct
+# build_profiles:
+#   pipeline-ecr: null
+#
+# Mappings are merged key by key, null removes a key and anything else (lists,
+# values) replaces what the extended environment sets. Every config is validated
+# when it's loaded, so mistakes stop a deploy before Pulumi starts.
+ENVIRONMENTS_DIR = os.path.join(REPO_DIR, "environments")
+WEBHOOK_TRIGGERS = ('legacy', 'direct')
+# CodeBuild settings of every project, overridden by the default and per-project
+# entries of build_profiles in the environment config. cache is one of CACHE_TYPES:
+#    * s3:    the cache paths of the buildspec kept in the project's S3 bucket
+#    * local: Docker layer, source and custom caches kept on the build host
+#    * none:  no cache, the default since the buildspecs list no cache paths
+DEFAULT_BUILD_PROFILE = {
+    "compute_type": "BUILD_GENERAL1_SMALL",
+    "timeout": 5,
+    "cache": "none",
+    "privileged_mode": False,
+}
+CACHE_TYPES = ('s3', 'local', 'none')
+# The libyaml parser when PyYAML was built with it
+LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+_files = {}
+_configs = {}
+_lock = threading.Lock()
+
+class ConfigError(ValueError):
+    """An environment config can't be read or is invalid"""
+
+def config_path(environment):
+    """Path of the config file of an environment, whatever the working directory"""
+    return os.path.join(ENVIRONMENTS_DIR, f"{environment}.yaml")
+
+def _stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return path, stat.st_mtime_ns, stat.st_size
+
+def read_file(path):
+    """Parse a config file, reusing the last parse while the file is unchanged"""
+    stamp = _stamp(path)
+    if stamp is None:
+        raise ConfigError(f"{path} doesn't exist")
+    cached = _files.get(path)
+    if cached and cached[0] == stamp:
+        return stamp, cached[1]
+    with open(path, mode="r", encoding="utf-8") as stream:
+        try:
+            data = yaml.load(stream, Loader=LOADER)
+        except yaml.YAMLError as error:
+            raise ConfigError(f"Cannot parse {path}: {error}") from None
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        raise ConfigError(f"{path} must hold a mapping")
+    _files[path] = (stamp, data)
+    return stamp, data
+
+def overlay(base, override):
+    """Merge override onto base: mappings are merged, null removes a key and
+    anything else replaces
+    """
+    merged = dict(base)
+    for key, value in override.items():
+        if value is None:
+            merged.pop(key, None)
+        elif isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = overlay(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+def _resolve(environment, chain=()):
+    """Return the stamps of every file an environment is built from, and its config"""
+    if environment in chain:
+        raise ConfigError(f"extends cycle: {' -> '.join(chain + (environment,))}")
+    stamp, data = read_file(config_path(environment))
+    if 'extends' not in data:
+        return [stamp], data
+    stamps, base = _resolve(data['extends'], chain + (environment,))
+    own = {key: value for key, value in data.items() if key != 'extends'}
+    return stamps + [stamp], overlay(base, own)
+
+def _mapping(problems, label, value):
+    if value is not None and not isinstance(value, dict):
+        problems.append(f"{label} must be a mapping")
+        return {}
+    return value or {}
+
+def _names(problems, label, value):
+    if value is not None and (not isinstance(value, list)
+                              or not all(isinstance(name, str) for name in value)):
+        problems.append(f"{label} must be a list of names")
+        return []
+    return value or []
+
+def _check_vpc(problems, vpc):
+    if 'cidr' not in vpc:
+        problems.append("vpc needs a cidr")
+        return
+    # Only plan subnets whose settings have the right shape
+    found = len(problems)
+    _names(problems, "vpc.azs", vpc.get('azs'))
+    subnets = _mapping(problems, "vpc.subnets", vpc.get('subnets'))
+    for name, subnet in subnets.items():
+        subnet = _mapping(problems, f"vpc.subnets.{name}", subnet)
+        if not isinstance(subnet.get('az', ''), str):
+            problems.append(f"vpc.subnets.{name}.az must be a name")
+    if len(problems) > found:
+        return
+    try:
+        nat_subnets(subnet_tiers(plan_vpc(vpc)), vpc.get('nat', 'none'))
+    except ValueError as error:
+        problems.append(f"vpc: {error}".replace("\n", "\n  "))
+
+def _check_build_profiles(problems, profiles):
+    for name, profile in profiles.items():
+        profile = _mapping(problems, f"build_profiles.{name}", profile)
+        for key, value in profile.items():
+            default = DEFAULT_BUILD_PROFILE.get(key)
+            if default is None:
+                problems.append(f"build_profiles.{name} has an unknown setting {key}")
+            elif type(value) is not type(default): # pylint: disable=unidiomatic-typecheck
+                problems.append(f"build_profiles.{name}.{key} must be of type "
+                                f"{type(default).__name__}")
+        if profile.get('cache', 'none') not in CACHE_TYPES:
+            problems.append(f"build_profiles.{name}.cache must be one of "
+                            f"{', '.join(CACHE_TYPES)}, not {profile['cache']}")
+
+def _check_infra(problems, data):
+    infra = _names(problems, "infra", data.get('infra'))
+    if 'infra' not in data:
+        problems.append("infra must list the infra projects")
+    for project in infra:
+        if not os.path.exists(project_main(project)):
+            problems.append(f"infra project {project} has no infra/{project}/main.py")
+    if len(set(infra)) != len(infra):
+        problems.append("infra lists a project more than once")
+    return infra
+
+def _check_applications(problems, data):
+    clusters = _mapping(problems, "k8s_clusters", data.get('k8s_clusters'))
+    for name, cluster in clusters.items():
+        _mapping(problems, f"k8s_clusters.{name}", cluster)
+    applications = _mapping(problems, "applications", data.get('applications'))
+    for name, application in applications.items():
+        application = _mapping(problems, f"applications.{name}", application)
+        for key in application:
+            if key != 'clusters':
+                problems.append(f"applications.{name} has an unknown setting {key}")
+        for cluster in _names(problems, f"applications.{name}.clusters",
+                              application.get('clusters')):
+            if cluster not in clusters:
+                problems.append(f"applications.{name} uses unknown cluster {cluster}")
+
+def _check_dependencies(problems, dependencies, infra):
+    for project, projects in dependencies.items():
+        for dependency in [project] + _names(problems, f"dependencies.{project}", projects):
+            if dependency not in infra:
+                problems.append(f"dependencies: {dependency} is not an infra project")
+
+def validate(data):
+    """Return every problem found in an environment config"""
+    problems = []
+    infra = _check_infra(problems, data)
+    if 'vpc' in data:
+        _check_vpc(problems, _mapping(problems, "vpc", data['vpc']))
+    _check_applications(problems, data)
+    webhook = _mapping(problems, "webhook", data.get('webhook'))
+    if webhook.get('trigger', 'legacy') not in WEBHOOK_TRIGGERS:
+        problems.append(f"webhook.trigger must be one of {', '.join(WEBHOOK_TRIGGERS)}, "
+                        f"not {webhook['trigger']}")
+    _check_dependencies(problems, _mapping(problems, "dependencies", data.get('dependencies')),
+                        infra)
+    _check_build_profiles(problems, _mapping(problems, "build_profiles",
+                                             data.get('build_profiles')))
+    return problems
+
+def load_config(environment):
+    """Return the validated config of an environment
+
+    The config is shared by every caller and must not be modified. Raises
+    ConfigError if it is missing, can't be parsed or is invalid.
+    """
+    with _lock:
+        cached = _configs.get(environment)
+        if cached and all(_stamp(stamp[0]) == stamp for stamp in cached[0]):
+            return cached[1]
+        stamps, data = _resolve(environment)
+        problems = validate(data)
+        if problems:
+            raise ConfigError(f"Invalid config for {environment}:\n  " + "\n  ".join(problems))
+        _configs[environment] = (stamps, data)
+        return data
+
+def has_config(environment):
+    """Whether an environment has a config file"""
+    return os.path.exists(config_path(environment))
@@ -0,0 +1,156 @@
+"""Build canonical IAM policy documents from shared statements"""
+import collections
+import functools
+import json
+
+import pulumi
+
+# IAM counts policy size without whitespace. Inline policies share one limit per
+# role; every managed policy has its own.
+INLINE_POLICY_LIMIT = 10240
+MANAGED_POLICY_LIMIT = 6144
+# Longest possible S3 bucket name and KMS key ARN (longest region, key ID), used to
+# size policies before the names are known
+BUCKET_NAME_MAX = 63
+KMS_KEY_ARN_MAX = len("arn:aws:kms:ap-southeast-4:000000000000:key/") + 36
+POLICY_VERSION = "2012-10-17"
+
+# Statements are interned: building the same statement twice returns the same object,
+# so documents made of them are cached as well. actions and resources are sorted
+# tuples, principal and condition canonical JSON, which makes the documents
+# independent of the order and formatting they were written in.
+Statement = collections.namedtuple(
+    "Statement", ["effect", "actions", "resources", "principal", "condition"])
+
+def minify(value):
+    """Serialize a policy document without whitespace, keys sorted"""
+    return json.dumps(value, separators=(",", ":"), sort_keys=True)
+
+def _names(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return (value,)
+    return tuple(sorted(set(value)))
+
+def _canonical(value):
+    return None if value is None else minify(value)
+
+@functools.lru_cache(maxsize=None)
+def _statement(effect, actions, resources, principal, condition):
+    return Statement(effect, actions, resources, principal, condition)
+
+def statement(actions, resources=None, effect="Allow", principal=None, condition=None):
+    """Return a policy statement, shared by every structurally identical statement
+
+    actions and resources are a name or a list of names. Trust policies leave
+    resources out, resource policies set principal.
+    """
+    return _statement(effect, _names(actions), _names(resources),
+                      _canonical(principal), _canonical(condition))
+
+def merge(statements):
+    """Drop duplicate statements and merge the ones that only differ in resources"""
+    merged = collections.OrderedDict()
+    for item in statements:
+        key = (item.effect, item.actions, item.principal, item.condition)
+        if key not in merged:
+            merged[key] = item.resources
+        elif item.resources is not None:
+            merged[key] = tuple(sorted(set(merged[key] or ()) | set(item.resources)))
+    return tuple(_statement(effect, actions, resources, principal, condition)
+                 for (effect, actions, principal, condition), resources in merged.items())
+
+def _serialize(item):
+    serialized = {"Effect": item.effect, "Action": list(item.actions)}
+    if item.resources is not None:
+        serialized["Resource"] = list(item.resources)
+    if item.principal is not None:
+        serialized["Principal"] = json.loads(item.principal)
+    if item.condition is not None:
+        serialized["Condition"] = json.loads(item.condition)
+    return serialized
+
+@functools.lru_cache(maxsize=None)
+def _document(statements):
+    return minify({"Version": POLICY_VERSION,
+                   "Statement": [_serialize(item) for item in statements]})
+
+def document(*statements):
+    """Serialize statements into a canonical, minified policy document
+
+    Each distinct set of statements is only serialized once.
+    """
+    return _document(merge(statements))
+
+@functools.lru_cache(maxsize=None)
+def trust_policy(service):
+    """The assume role policy letting an AWS service assume a role"""
+    return document(statement("sts:AssumeRole", principal={"Service": service}))
+
+def policy(build, **inputs):
+    """Build a policy document from Pulumi inputs
+
+    build is called with the resolved inputs and returns a list of statements.
+    Returns the document, as an Output when there are inputs.
+    """
+    if not inputs:
+        return document(*build())
+    return pulumi.Output.all(**inputs).apply(lambda values: document(*build(**values)))
+
+def max_size(build, **lengths):
+    """The size of the document policy(build, **inputs) makes for inputs of at most
+    lengths characters, known before the inputs are
+    """
+    return len(document(*build(**{name: "0" * length for name, length in lengths.items()})))
+
+def bucket_arns(bucket):
+    """The ARNs of a bucket and of every object in it"""
+    return [f"arn:aws:s3:::{bucket}", f"arn:aws:s3:::{bucket}/*"]
+
+def bucket_statement(buckets, actions=("s3:*",)):
+    """A statement allowing actions on buckets and their objects"""
+    return statement(actions, [arn for bucket in buckets for arn in bucket_arns(bucket)])
+
+def bucket_groups(keys, limit, actions=("s3:*",), first_limit=None):
+    """Split keys into as few groups as possible whose bucket policy stays under limit
+
+    The first group stays under first_limit instead, when it is given, and is empty
+    when not even one bucket fits in it. Groups are sized for the longest possible
+    bucket names, so the split is known before any bucket exists. Raises ValueError
+    if one bucket doesn't fit in limit.
+    """
+    def size(count):
+        # Built without interning, so the caches only hold real documents
+        longest = [arn for index in range(count)
+                   for arn in bucket_arns(f"{index:0{BUCKET_NAME_MAX}d}")]
+        return len(minify({"Version": POLICY_VERSION, "Statement": [_serialize(
+            Statement("Allow", _names(actions), _names(longest), None, None))]}))
+    if size(1) > limit:
+        raise ValueError(f"A bucket policy doesn't fit in {limit} characters")
+    groups = [[]]
+    group_limit = limit if first_limit is None else first_limit
+    for key in keys:
+        if size(len(groups[-1]) + 1) > group_limit:
+            groups.append([])
+            group_limit = limit
+        groups[-1].append(key)
+    return groups
+
+def bucket_policies(buckets, inline_room=INLINE_POLICY_LIMIT, actions=("s3:*",)):
+    """Return the inline and managed policy documents, as Outputs, allowing actions on
+    every bucket in buckets
+
+    buckets maps keys to bucket names (plain or Outputs). Every name is resolved by a
+    single Output.all and the documents share it. The inline document fits in
+    inline_room, what the other inline policies of a role leave of INLINE_POLICY_LIMIT,
+    and is None when not even one bucket fits. The buckets that don't fit go in as few
+    documents as possible sized for managed policies, usually none.
+    """
+    names = pulumi.Output.all(**buckets)
+    def build(group):
+        return names.apply(lambda resolved: document(
+            bucket_statement([resolved[key] for key in group], actions)))
+    inline, *managed = bucket_groups(list(buckets), MANAGED_POLICY_LIMIT, actions,
+                                     first_limit=inline_room)
+    return (build(inline) if inline else None), [build(group) for group in managed]
@@ -0,0 +1,88 @@
+"""Hash everything a stack program depends on, to skip updates that would change nothing"""
+import glob
+import hashlib
+import json
+import os
+
+import pulumi
+from introspect import (SHARED_DIR, REPO_DIR, INFRA_DIR, program_sources, config_sections,
+                        stack_references, reads_other_programs)
+from local_cache import read_entry, write_entry, delete_entry
+
+# Inputs hashed:
+#    * every file in the project directory (main.py, Dockerfiles, lambda code, encrypted secrets)
+#    * every module in shared/ and requirements.txt
+#    * the main.py of every infra project, for programs derived from them (the pipeline
+#      stages come from the StackReferences of the other projects)
+#    * the sections of environments/<env>.yaml the program reads
+#    * the stack config
+#    * the outputs of the stacks the program references
+INPUT_HASH_OUTPUT = "bootstrap_input_hash"
+CACHE_NAMESPACE = "inputs"
+IGNORED_DIRS = ("__pycache__", "venv", ".venv")
+
+def _hash_files(digest, directory):
+    for path in sorted(glob.glob(os.path.join(directory, "**", "*"), recursive=True)):
+        relative = os.path.relpath(path, directory)
+        if os.path.isdir(path) or any(part in IGNORED_DIRS for part in relative.split(os.sep)):
+            continue
+        digest.update(relative.encode("utf-8"))
+        with open(path, "rb") as source:
+            digest.update(hashlib.sha256(source.read()).digest())
+
+def _hash_value(digest, label, value):
+    digest.update(label.encode("utf-8"))
+    digest.update(json.dumps(value, sort_keys=True, default=str).encode("utf-8"))
+
+def program_input_hash(stack, pulumi_program, environment_config, environment):
+    """Return a hex digest of every input of a stack program"""
+    main_path = pulumi_program.__code__.co_filename
+    sources = program_sources(main_path)
+    digest = hashlib.sha256()
+    _hash_files(digest, os.path.dirname(main_path))
+    _hash_files(digest, SHARED_DIR)
+    with open(os.path.join(REPO_DIR, "requirements.txt"), "rb") as requirements:
+        digest.update(hashlib.sha256(requirements.read()).digest())
+    if reads_other_programs(sources):
+        for path in sorted(glob.glob(os.path.join(INFRA_DIR, "*", "main.py"))):
+            digest.update(os.path.relpath(path, INFRA_DIR).encode("utf-8"))
+            with open(path, "rb") as source:
+                digest.update(hashlib.sha256(source.read()).digest())
+    sections = config_sections(sources)
+    config = environment_config or {}
+    if sections is None:
+        _hash_value(digest, "environment", config)
+    else:
+        _hash_value(digest, "environment", {section: config.get(section) for section in sections})
+    stack_config = {key: value.value for key, value in stack.get_all_config().items()}
+    _hash_value(digest, "config", stack_config)
+    for reference in sorted(stack_references(sources)):
+        outputs = stack.workspace.stack_outputs(f"{reference}-{environment}")
+        _hash_value(digest, reference, {key: value.value for key, value in outputs.items()})
+    return digest.hexdigest()
+
+def last_deployed_hash(stack, cache_key):
+    """Return the input hash of the last successful update
+
+    The stack outputs win, since another machine may have updated the stack since.
+    The local cache covers stacks whose program doesn't export the hash.
+    """
+    output = stack.outputs().get(INPUT_HASH_OUTPUT)
+    if output:
+        return output.value
+    return read_entry(CACHE_NAMESPACE, cache_key)
+
+def record_input_hash(cache_key, input_hash):
+    """Remember the input hash of a successful update (None forgets it)"""
+    if input_hash is None:
+        delete_entry(CACHE_NAMESPACE, cache_key)
+    else:
+        write_entry(CACHE_NAMESPACE, cache_key, input_hash)
+
+def with_input_hash(pulumi_program, input_hash):
+    """Wrap a program so the stack exports the hash of the inputs it was deployed from"""
+    def program():
+        result = pulumi_program()
+        pulumi.export(INPUT_HASH_OUTPUT, input_hash)
+        return result
+    return program
@@ -0,0 +1,120 @@
+"""Static inspection of the Pulumi programs under infra/"""
+import ast
+import os
+import re
+
+SHARED_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(SHARED_DIR)
+INFRA_DIR = os.path.join(REPO_DIR, "infra")
+
+PROVIDER_PREFIX = "pulumi_"
+
+# Matches pulumi.StackReference(f"<project>-{environment}")
+STACK_REFERENCE = re.compile(r"""StackReference\(\s*f?["']([\w.-]+?)-\{environment\}["']""")
+
+# Calls that read the programs of other projects (to order stacks or pipeline stages)
+PROJECT_INTROSPECTION = re.compile(r"\b(?:project_dependencies|infer_dependencies)\(")
+
+# Matches data['<section>'] or data.get('<section>') where data is the environment
+# config returned by get_config
+CONFIG_SECTION = re.compile(r"""\bdata(?:\[\s*|\.get\(\s*)["'](\w+)["']""")
+
+def project_main(project):
+    """Path of the main.py program for an infra project"""
+    return os.path.join(INFRA_DIR, project, "main.py")
+
+def _read(path):
+    with open(path, mode="r", encoding="utf-8") as source:
+        return source.read()
+
+def _provider_aliases(tree):
+    """Map the names a module binds to pulumi provider packages to the provider name"""
+    aliases = {}
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                if alias.name.startswith(PROVIDER_PREFIX):
+                    aliases[alias.asname or alias.name] = alias.name[len(PROVIDER_PREFIX):]
+        elif isinstance(node, ast.ImportFrom) and (node.module or '').startswith(PROVIDER_PREFIX):
+            provider = node.module.split('.')[0][len(PROVIDER_PREFIX):]
+            for alias in node.names:
+                aliases[alias.asname or alias.name] = provider
+    return aliases
+
+def _used_providers(node, aliases):
+    """Return the providers whose aliases are referenced inside node"""
+    return {aliases[child.id] for child in ast.walk(node)
+            if isinstance(child, ast.Name) and child.id in aliases}
+
+def _shared_functions(module_name, names, seen):
+    """Yield (source, providers) for every function in a shared module reachable from names"""
+    path = os.path.join(SHARED_DIR, f"{module_name}.py")
+    if not os.path.exists(path):
+        return
+    source = _read(path)
+    tree = ast.parse(source)
+    aliases = _provider_aliases(tree)
+    functions = {node.name: node for node in tree.body
+                 if isinstance(node, ast.FunctionDef)}
+    pending = [name for name in names if name in functions]
+    while pending:
+        name = pending.pop()
+        if (module_name, name) in seen:
+            continue
+        seen.add((module_name, name))
+        node = functions[name]
+        yield ast.get_source_segment(source, node), _used_providers(node, aliases)
+        for child in ast.walk(node):
+            if isinstance(child, ast.Name) and child.id in functions:
+                pending.append(child.id)
+
+def _program(main_path):
+    """Return (sources, providers) for a program and the shared functions it uses"""
+    source = _read(main_path)
+    tree = ast.parse(source)
+    sources = [source]
+    providers = _used_providers(tree, _provider_aliases(tree))
+    seen = set()
+    for node in tree.body:
+        if isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            names = [alias.name for alias in node.names]
+            for function_source, function_providers in _shared_functions(node.module, names, seen):
+                sources.append(function_source)
+                providers.update(function_providers)
+    return sources, providers
+
+def program_sources(main_path):
+    """Return the source of a program followed by the source of every shared
+    function it imports, directly or through other shared functions
+    """
+    return _program(main_path)[0]
+
+def program_providers(main_path):
+    """Return the pulumi providers (aws, github, ...) a program creates resources with"""
+    return _program(main_path)[1]
+
+def stack_references(sources):
+    """Return the projects referenced through pulumi.StackReference in sources"""
+    references = set()
+    for source in sources:
+        references.update(STACK_REFERENCE.findall(source))
+    return references
+
+def reads_other_programs(sources):
+    """Whether sources derive anything from the programs of other infra projects"""
+    return any(PROJECT_INTROSPECTION.search(source) for source in sources)
+
+def config_sections(sources):
+    """Return the environment config sections read in sources
+
+    Returns None when get_config is called but the sections can't be determined,
+    and an empty set when the config isn't read at all.
+    """
+    sections = set()
+    reads_config = False
+    for source in sources:
+        reads_config = reads_config or "get_config(" in source
+        sections.update(CONFIG_SECTION.findall(source))
+    if reads_config and not sections:
+        return None
+    return sections
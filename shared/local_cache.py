@@ -0,0 +1,45 @@
+"""A small JSON file cache shared by the bootstrap tooling"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+# Point PULUMI_BOOTSTRAP_CACHE at a directory CodeBuild caches to keep entries between builds
+CACHE_DIR = os.environ.get("PULUMI_BOOTSTRAP_CACHE",
+                           os.path.join(os.path.expanduser("~"), ".cache", "pulumi-bootstrap"))
+
+def _entry_path(namespace, key):
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, namespace, f"{digest}.json")
+
+def read_entry(namespace, key, max_age=None):
+    """Return the value cached for key, or None if it is missing, unreadable or
+    older than max_age seconds
+    """
+    try:
+        with open(_entry_path(namespace, key), mode="r", encoding="utf-8") as entry_file:
+            entry = json.load(entry_file)
+    except (IOError, ValueError):
+        return None
+    if entry.get("key") != key:
+        return None
+    if max_age is not None and time.time() - entry.get("written", 0) > max_age:
+        return None
+    return entry.get("value")
+
+def write_entry(namespace, key, value):
+    """Cache value for key, replacing the file atomically"""
+    path = _entry_path(namespace, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(descriptor, mode="w", encoding="utf-8") as entry_file:
+        json.dump({"key": key, "written": time.time(), "value": value}, entry_file)
+    os.replace(temp_path, path)
+
+def delete_entry(namespace, key):
+    """Forget the value cached for key"""
+    try:
+        os.remove(_entry_path(namespace, key))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,124 @@
+"""Deploy every infra stack of an environment from a single command"""
+import functools
+import importlib.util
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from pulumi import automation as auto
+from bootstrap import manage, arg_parser, get_config
+from dependencies import project_dependencies, reverse_graph, topological_order
+from environment_config import ConfigError, load_config
+from introspect import project_main
+from plugins import ensure_plugins, project_plugins, remember_installed
+
+# Run independent stacks concurrently, respecting the StackReferences between them.
+# The Pulumi runtime keeps process-wide state, so every stack runs in its own process,
+# started fresh (spawn) and working from its project directory.
+# Assumes:
+#    * every project under infra/ exposes pulumi_program in its main.py
+#    * main.py only calls manage() when it is run as a script
+#    * work to do after a successful update lives in an optional
+#      post_deploy(outputs, on_output) in main.py, which the script calls as well
+#    * a stack that references another uses pulumi.StackReference(f"<project>-{environment}"),
+#      or declares it in the dependencies section of the environment config
+
+def run_graph(graph, run, executor):
+    """Call run(node) on executor for every node once all of its dependencies succeeded
+
+    Nodes whose dependencies failed are skipped. run must be picklable when executor
+    runs it in other processes.
+    Returns a tuple of (results, failed, skipped)
+    """
+    topological_order(graph)
+    results, failed, skipped = {}, {}, []
+    pending = dict(graph)
+    running = {}
+    with executor:
+        while pending or running:
+            for node, dependencies in list(pending.items()):
+                if any(dependency in failed or dependency in skipped for dependency in dependencies):
+                    skipped.append(node)
+                    del pending[node]
+                elif all(dependency in results for dependency in dependencies):
+                    running[executor.submit(run, node)] = node
+                    del pending[node]
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                try:
+                    results[node] = future.result()
+                except Exception as error: # pylint: disable=broad-except
+                    failed[node] = error
+    return results, failed, skipped
+
+def load_program(project):
+    """Import infra/<project>/main.py and return the module"""
+    module_name = f"infra_{project.replace('-', '_')}"
+    spec = importlib.util.spec_from_file_location(module_name, project_main(project))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def run_project(arguments, plugins, project):
+    """Deploy (or destroy) one project, in the worker process running it
+
+    plugins were installed before the workers started. Returns the resource changes
+    of the update, or None for a destroy
+    """
+    remember_installed(plugins)
+    def on_output(line):
+        print(f"[{project}] {line}", flush=True)
+    os.chdir(os.path.dirname(project_main(project)))
+    module = load_program(project)
+    result = manage(arguments, project, module.pulumi_program,
+                    on_output=on_output, exit_on_destroy=False)
+    if arguments.destroy:
+        return None
+    if hasattr(module, "post_deploy"):
+        module.post_deploy(result.outputs, on_output)
+    return result.summary.resource_changes
+
+def deploy(arguments, projects, workers):
+    """Deploy (or destroy) projects concurrently in dependency order"""
+    data = get_config(arguments.stack_name) or {}
+    graph = project_dependencies(projects, data.get('dependencies'))
+    if arguments.destroy:
+        graph = reverse_graph(graph)
+    for project in topological_order(graph):
+        print(f"{project} waits for: {', '.join(graph[project]) or 'nothing'}")
+    # List and install the plugins once here rather than in every worker
+    plugins = project_plugins(projects)
+    ensure_plugins(auto.LocalWorkspace(), plugins)
+    executor = ProcessPoolExecutor(max_workers=workers,
+                                   mp_context=multiprocessing.get_context("spawn"))
+    return run_graph(graph, functools.partial(run_project, arguments, plugins), executor)
+
+def args():
+    """Handle ArgParsers Arguments"""
+    parser = arg_parser(description='Deploy every infra stack of an environment.')
+    parser.add_argument('-w', '--workers', type=int, required=False, default=4,
+                        help='maximum number of stacks to run at the same time')
+    parser.add_argument('-p', '--projects', nargs='+', required=False,
+                        help='only run these projects (defaults to infra in the environment)')
+    return parser.parse_args()
+
+def main():
+    """Run the orchestrator from the command line"""
+    arguments = args()
+    # Check the whole config before any stack starts
+    try:
+        data = load_config(arguments.stack_name)
+    except ConfigError as error:
+        print(error, file=sys.stderr)
+        return 2
+    projects = arguments.projects or data['infra']
+    _, failed, skipped = deploy(arguments, projects, arguments.workers)
+    for project, error in failed.items():
+        print(f"{project} failed: {error}")
+    for project in skipped:
+        print(f"{project} skipped because a dependency failed")
+    return 1 if failed or skipped else 0
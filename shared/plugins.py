@@ -0,0 +1,66 @@
+"""Install the resource plugins a Pulumi program needs, once per process"""
+import os
+import threading
+
+from introspect import program_providers, project_main
+
+# Versions installed for inline programs. Keep in line with requirements.txt
+PLUGIN_VERSIONS = {
+    "aws": "v4.20.0",
+    "github": "v4.4.0",
+    "docker": "v3.1.0",
+}
+
+# Plugins known to be in the local plugin cache, shared by every stack in the process
+_INSTALLED = set()
+_LOCK = threading.Lock()
+_STATE = {"listed": False}
+
+def required_plugins(pulumi_program):
+    """Return {name: version} for the plugins a program needs
+
+    Programs that can't be inspected (not defined in a file) get every plugin.
+    """
+    main_path = pulumi_program.__code__.co_filename
+    if not os.path.exists(main_path):
+        return dict(PLUGIN_VERSIONS)
+    providers = program_providers(main_path)
+    return {name: version for name, version in PLUGIN_VERSIONS.items() if name in providers}
+
+def project_plugins(projects):
+    """Return {name: version} for the plugins the programs of infra projects need"""
+    providers = set()
+    for project in projects:
+        providers.update(program_providers(project_main(project)))
+    return {name: version for name, version in PLUGIN_VERSIONS.items() if name in providers}
+
+def remember_installed(plugins):
+    """Record plugins another process installed, so this one doesn't list the cache again"""
+    with _LOCK:
+        _INSTALLED.update((name, _normalize(version)) for name, version in plugins.items())
+        _STATE["listed"] = True
+
+def _normalize(version):
+    return version.lstrip('v')
+
+def ensure_plugins(workspace, plugins, on_output=print):
+    """Install plugins missing from the local plugin cache
+
+    The cache is listed once per process and every install is remembered. The
+    orchestrator installs the plugins of every project before it starts the worker
+    processes and passes them on with remember_installed, so workers don't list
+    the cache at all.
+    """
+    with _LOCK:
+        if not _STATE["listed"]:
+            for plugin in workspace.list_plugins():
+                if plugin.kind == "resource":
+                    _INSTALLED.add((plugin.name, _normalize(plugin.version or "")))
+            _STATE["listed"] = True
+        for name, version in sorted(plugins.items()):
+            if (name, _normalize(version)) in _INSTALLED:
+                on_output(f"plugin {name} {version} already installed")
+                continue
+            on_output(f"installing plugin {name} {version}")
+            workspace.install_plugin(name, version)
+            _INSTALLED.add((name, _normalize(version)))
@@ -0,0 +1,72 @@
+"""Decide how much of a stack to refresh before an update"""
+import hashlib
+import json
+import time
+
+from local_cache import read_entry, write_entry, delete_entry
+
+# always:   refresh every resource before every update (the original behaviour)
+# never:    trust the state file
+# adaptive: only refresh everything when the state changed since our last update,
+#           otherwise refresh the resource types known to drift (if any)
+REFRESH_POLICIES = ('always', 'never', 'adaptive')
+CACHE_NAMESPACE = "refresh"
+
+def state_fingerprint(stack):
+    """Hash the last update, resource count and outputs of a stack without touching the cloud"""
+    summary = stack.info()
+    deployment = stack.export_stack().deployment or {}
+    resources = deployment.get("resources") or []
+    outputs = {}
+    for resource in resources:
+        if resource.get("type") == "pulumi:pulumi:Stack":
+            outputs = resource.get("outputs") or {}
+    fingerprint = {
+        "version": getattr(summary, "version", None),
+        "end_time": str(getattr(summary, "end_time", None)),
+        "resources": len(resources),
+        "outputs": hashlib.sha256(json.dumps(outputs, sort_keys=True, default=str)
+                                  .encode("utf-8")).hexdigest(),
+    }
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode("utf-8")).hexdigest()
+
+def drift_prone_urns(stack, resource_types):
+    """Return the URNs of the resources in a stack whose type is in resource_types"""
+    deployment = stack.export_stack().deployment or {}
+    return [resource["urn"] for resource in deployment.get("resources") or []
+            if resource.get("type") in resource_types]
+
+def refresh_stack(stack, arguments, cache_key, on_output=print):
+    """Refresh a stack according to arguments.refresh
+
+    Returns the time of the last full refresh, or None when the state should not be
+    trusted by a later adaptive run.
+    """
+    policy = arguments.refresh
+    if policy == 'never':
+        on_output("refresh skipped (policy: never)")
+        return None
+    if policy == 'adaptive':
+        record = read_entry(CACHE_NAMESPACE, cache_key)
+        if record and time.time() - record["refreshed_at"] > arguments.refresh_max_age * 3600:
+            record = None
+        if record and record["fingerprint"] == state_fingerprint(stack):
+            if arguments.refresh_types:
+                targets = drift_prone_urns(stack, arguments.refresh_types)
+                if targets:
+                    on_output(f"state unchanged, refreshing {len(targets)} drift-prone resources")
+                    stack.refresh(target=targets, on_output=on_output)
+                    return record["refreshed_at"]
+            on_output("state unchanged since the last update, refresh skipped")
+            return record["refreshed_at"]
+        on_output("state changed or unknown, refreshing every resource")
+    stack.refresh(on_output=on_output)
+    return time.time()
+
+def record_state(stack, cache_key, refreshed_at):
+    """Remember the fingerprint of a stack after an update so adaptive runs can trust it"""
+    if refreshed_at is None:
+        delete_entry(CACHE_NAMESPACE, cache_key)
+        return
+    write_entry(CACHE_NAMESPACE, cache_key,
+                {"fingerprint": state_fingerprint(stack), "refreshed_at": refreshed_at})
@@ -0,0 +1,7 @@
+"""Put the shared modules and the webhook Lambda on the import path of the tests"""
+import os
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "shared"))
+sys.path.insert(0, os.path.join(REPO_DIR, "infra", "pipeline-webhook", "lambda"))
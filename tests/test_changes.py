@@ -0,0 +1,54 @@
+"""Tests for the change detection of shared/changes.py"""
+import pytest
+
+import changes
+
+PROJECTS = ["vpc", "rds", "pipeline"]
+# rds depends on vpc
+GRAPH = {"vpc": [], "rds": ["vpc"], "pipeline": []}
+
+@pytest.fixture(name="diffs")
+def fixture_diffs(monkeypatch):
+    """Paths changed since each base commit, up to head"""
+    diffs = {}
+    monkeypatch.setattr(changes, "changed_paths", lambda base, head: diffs[base])
+    return diffs
+
+def test_changed_project_and_its_dependents_are_affected(diffs):
+    """A change affects the project and every project depending on it"""
+    diffs["c1"] = ["infra/vpc/Pulumi.yaml"]
+    bases = dict.fromkeys(PROJECTS, "c1")
+    assert changes.affected_projects(PROJECTS, bases, "c2", GRAPH) == {"vpc", "rds"}
+
+def test_dependent_stays_affected_after_its_dependency_was_deployed(diffs):
+    """Each project is diffed from the commit it last deployed"""
+    # vpc changed in c2 and was deployed, then rds failed: only rds is still behind
+    diffs["c1"] = ["infra/vpc/main.py"]
+    diffs["c2"] = []
+    bases = {"vpc": "c2", "rds": "c1", "pipeline": "c2"}
+    assert changes.affected_projects(PROJECTS, bases, "c2", GRAPH) == {"rds"}
+
+def test_projects_without_a_base_are_affected(diffs):
+    """Projects that never recorded a commit are built"""
+    diffs["c1"] = []
+    bases = {"vpc": "c1", "rds": "c1", "pipeline": None}
+    assert changes.affected_projects(PROJECTS, bases, "c2", GRAPH) == {"pipeline"}
+
+@pytest.mark.parametrize("path", [
+    "shared/bootstrap.py", "environments/dev.yaml", "buildspec.yml",
+    "buildspec_changes.yml", "requirements.txt",
+])
+def test_global_paths_affect_every_project(path):
+    """Shared files affect every project"""
+    assert changes.projects_for_paths([path], PROJECTS) == set(PROJECTS)
+
+def test_other_paths_affect_no_project():
+    """Files no project reads affect nothing"""
+    assert not changes.projects_for_paths(["README.md", "buildspec_pr.yml",
+                                           "infra/unknown/README.md"], PROJECTS)
+
+@pytest.mark.parametrize("path", ["infra/vpc/main.py", "infra/unknown/main.py"])
+def test_programs_affect_the_projects_derived_from_them(path):
+    """Any infra program changes the pipeline stages"""
+    assert "pipeline" in changes.projects_for_paths([path], PROJECTS)
+    assert "rds" not in changes.projects_for_paths([path], PROJECTS)
@@ -0,0 +1,77 @@
+"""Tests for the subnet planner of shared/cidr.py"""
+import pytest
+
+import cidr
+
+def test_subnets_with_a_cidr_are_kept():
+    """Subnets with a cidr keep it, their type and their az"""
+    plan = cidr.plan_subnets("10.0.0.0/16", {"a": {"cidr": "10.0.4.0/22", "type": "public",
+                                                   "az": "b"}})
+    assert plan == {"a": {"cidr": "10.0.4.0/22", "type": "public", "az": "b"}}
+
+def test_prefixes_are_allocated_around_fixed_subnets_in_config_order():
+    """Prefixes get the lowest free block, in config order"""
+    plan = cidr.plan_subnets("10.0.0.0/16", {
+        "fixed": {"cidr": "10.0.0.0/24"},
+        "small": {"prefix": 24},
+        "large": {"prefix": 20},
+    })
+    assert [subnet["cidr"] for subnet in plan.values()] == [
+        "10.0.0.0/24", "10.0.1.0/24", "10.0.16.0/20"]
+
+def test_adding_a_subnet_moves_no_other_subnet():
+    """Appending a subnet leaves the existing allocations alone"""
+    subnets = {"a": {"prefix": 24}, "b": {"prefix": 24}}
+    before = cidr.plan_subnets("10.0.0.0/16", subnets)
+    after = cidr.plan_subnets("10.0.0.0/16", dict(subnets, c={"prefix": 20}))
+    assert {name: after[name] for name in before} == before
+    assert after["c"]["cidr"] == "10.0.16.0/20"
+
+def test_azs_are_handed_out_in_turn_to_subnets_without_one():
+    """Subnets without an az take the azs in turn"""
+    plan = cidr.plan_subnets("10.0.0.0/16", {
+        "a": {"prefix": 24}, "b": {"prefix": 24, "az": "c"}, "c": {"prefix": 24},
+        "d": {"prefix": 24},
+    }, azs=["a", "b"])
+    assert [subnet["az"] for subnet in plan.values()] == ["a", "c", "b", "a"]
+
+def test_pinned_plans_plan_to_themselves():
+    """A pinned plan allocates to the same plan"""
+    subnets = {"a": {"prefix": 24}, "b": {"prefix": 20, "type": "public"}}
+    plan = cidr.plan_subnets("10.0.0.0/16", subnets)
+    assert cidr.plan_subnets("10.0.0.0/16", cidr.pinned(plan)["subnets"]) == plan
+
+@pytest.mark.parametrize("subnets, problem", [
+    ({"a": {"cidr": "10.1.0.0/24"}}, "outside the VPC"),
+    ({"a": {"cidr": "10.0.0.0/23"}, "b": {"cidr": "10.0.1.0/24"}}, "Subnets a and b overlap"),
+    ({"a": {"prefix": 29}}, "must be between /16 and /28"),
+    ({"a": {"prefix": 8}}, "doesn't fit in the VPC"),
+    ({"a": {"type": "private"}}, "needs a cidr or a prefix"),
+    ({"a": {"cidr": "10.0.0.1/24"}}, "Invalid CIDR"),
+    ({"a": {"prefix": 24, "type": "dmz"}}, "has type dmz"),
+    ({"a": {"prefix": 17}, "b": {"prefix": 17}, "c": {"prefix": 24}}, "No room left"),
+])
+def test_problems_are_reported(subnets, problem):
+    """Each kind of bad subnet is reported"""
+    with pytest.raises(ValueError, match=problem):
+        cidr.plan_subnets("10.0.0.0/16", subnets)
+
+def test_every_problem_is_reported_at_once():
+    """All problems are reported in one error"""
+    with pytest.raises(ValueError) as error:
+        cidr.plan_subnets("10.0.0.0/16", {"a": {"cidr": "10.1.0.0/24"}, "b": {}})
+    assert "outside the VPC" in str(error.value)
+    assert "needs a cidr or a prefix" in str(error.value)
+
+def test_nat_subnets_place_one_gateway_per_az():
+    """NAT gateways go in the first public subnet of each AZ, or of the VPC"""
+    plan = cidr.plan_subnets("10.0.0.0/16", {
+        "public-a": {"prefix": 24, "type": "public", "az": "a"},
+        "public-b": {"prefix": 24, "type": "public", "az": "b"},
+        "private-a": {"prefix": 24, "az": "a"},
+        "private-b": {"prefix": 24, "az": "b"},
+    })
+    tiers = cidr.subnet_tiers(plan)
+    assert cidr.nat_subnets(tiers, "per_az") == {"a": "public-a", "b": "public-b"}
+    assert cidr.nat_subnets(tiers, "single") == {"a": "public-a", "b": "public-a"}
+    assert cidr.nat_subnets(tiers, "none") == {}
@@ -0,0 +1,76 @@
+"""Tests for the file encryption helpers of shared/encrypt_decrypt_file.py"""
+# The tests reach into module internals such as the client cache
+# pylint: disable=protected-access
+import base64
+import io
+import os
+
+import pytest
+
+encrypt_decrypt_file = pytest.importorskip("encrypt_decrypt_file", exc_type=ImportError)
+
+@pytest.fixture(name="secrets_dir")
+def fixture_secrets_dir(tmp_path):
+    """A directory of plaintext, encrypted and manifest files"""
+    for name in ("a.json", "a.json.encrypted", "b.json", "c.json.encrypted",
+                 encrypt_decrypt_file.MANIFEST_FILE):
+        (tmp_path / name).write_bytes(b"")
+    return tmp_path
+
+def test_expand_maps_globs_to_encrypted_files(secrets_dir):
+    """Globs expand to the files with an encrypted copy"""
+    files, unmatched = encrypt_decrypt_file._expand([str(secrets_dir / "*.json")], ".encrypted")
+    assert files == [str(secrets_dir / "a.json"), str(secrets_dir / "c.json")]
+    assert not unmatched
+
+def test_expand_reports_paths_without_encrypted_files(secrets_dir):
+    """Paths without an encrypted file are returned as unmatched"""
+    files, unmatched = encrypt_decrypt_file._expand(
+        [str(secrets_dir / "a.json.encrypted"), str(secrets_dir / "b.json")], ".encrypted")
+    assert files == [str(secrets_dir / "a.json")]
+    assert unmatched == [str(secrets_dir / "b.json")]
+
+def test_expand_skips_encrypted_files_and_the_manifest(secrets_dir):
+    """Directories expand to their plaintext files only"""
+    files, unmatched = encrypt_decrypt_file._expand([str(secrets_dir), "missing.json"])
+    assert files == [str(secrets_dir / "a.json"), str(secrets_dir / "b.json")]
+    assert unmatched == ["missing.json"]
+
+def test_decrypt_files_fails_when_nothing_matches(tmp_path):
+    """decrypt_files returns the patterns matching no encrypted file"""
+    pattern = os.path.join(str(tmp_path), "*.json")
+    assert encrypt_decrypt_file.decrypt_files([pattern]) == [pattern]
+
+def encrypted_stream(plaintext, key, chunk_size=16):
+    """Encrypt plaintext with encrypt_stream, returning the bytes after STREAM_MAGIC"""
+    destination = io.BytesIO()
+    encrypt_decrypt_file.encrypt_stream(io.BytesIO(plaintext), destination, key, chunk_size)
+    return destination.getvalue()[len(encrypt_decrypt_file.STREAM_MAGIC):]
+
+@pytest.fixture(name="key")
+def fixture_key():
+    """A random data key, base64-encoded as KMS returns it"""
+    return base64.b64encode(os.urandom(32))
+
+def test_streams_round_trip(key):
+    """Chunked streams decrypt back to the plaintext"""
+    plaintext = os.urandom(100)
+    destination = io.BytesIO()
+    encrypt_decrypt_file.decrypt_stream(io.BytesIO(encrypted_stream(plaintext, key)),
+                                        destination, key)
+    assert destination.getvalue() == plaintext
+
+def test_oversized_frames_are_rejected_before_they_are_read(key):
+    """A frame length larger than the chunk size stops decryption"""
+    stream = bytearray(encrypted_stream(b"secret", key))
+    # chunk size (4) | nonce prefix (8) | final flag (1) | frame length (4)
+    stream[13:17] = (2 ** 31).to_bytes(4, byteorder="big")
+    with pytest.raises(ValueError, match="larger than the chunk size"):
+        encrypt_decrypt_file.decrypt_stream(io.BytesIO(bytes(stream)), io.BytesIO(), key)
+
+def test_oversized_chunk_sizes_are_rejected(key):
+    """A chunk size over MAX_STREAM_CHUNK_SIZE stops decryption"""
+    stream = bytearray(encrypted_stream(b"secret", key))
+    stream[0:4] = (2 ** 31).to_bytes(4, byteorder="big")
+    with pytest.raises(ValueError, match="Invalid chunk size"):
+        encrypt_decrypt_file.decrypt_stream(io.BytesIO(bytes(stream)), io.BytesIO(), key)
@@ -0,0 +1,50 @@
+"""Tests for the environment config loader in shared/environment_config.py"""
+import pytest
+
+import environment_config
+
+def test_overlay_merges_mappings_key_by_key():
+    """Mappings are merged key by key"""
+    base = {"webhook": {"trigger": "legacy", "window": 600}, "infra": ["vpc"]}
+    merged = environment_config.overlay(base, {"webhook": {"trigger": "direct"}})
+    assert merged == {"webhook": {"trigger": "direct", "window": 600}, "infra": ["vpc"]}
+
+def test_overlay_replaces_lists_and_values():
+    """Lists and scalars replace the base value"""
+    merged = environment_config.overlay({"infra": ["vpc", "rds"], "nat": "none"},
+                                        {"infra": ["vpc"], "nat": "single"})
+    assert merged == {"infra": ["vpc"], "nat": "single"}
+
+def test_overlay_removes_keys_set_to_null():
+    """Keys set to null are removed"""
+    base = {"build_profiles": {"default": {"timeout": 5}, "pipeline-ecr": {"timeout": 60}}}
+    merged = environment_config.overlay(base, {"build_profiles": {"pipeline-ecr": None}})
+    assert merged == {"build_profiles": {"default": {"timeout": 5}}}
+
+def test_overlay_leaves_the_base_untouched():
+    """overlay doesn't change the base config"""
+    base = {"vpc": {"subnets": {"a": {"prefix": 24}}}}
+    environment_config.overlay(base, {"vpc": {"subnets": {"b": {"prefix": 24}}}})
+    assert base == {"vpc": {"subnets": {"a": {"prefix": 24}}}}
+
+def test_extends_cycles_are_reported(tmp_path, monkeypatch):
+    """extends cycles are reported with the chain"""
+    monkeypatch.setattr(environment_config, "ENVIRONMENTS_DIR", str(tmp_path))
+    (tmp_path / "one.yaml").write_text("extends: two\n")
+    (tmp_path / "two.yaml").write_text("extends: one\n")
+    with pytest.raises(environment_config.ConfigError, match="one -> two -> one"):
+        environment_config.load_config("one")
+
+@pytest.mark.parametrize("vpc, problem", [
+    ({"cidr": "10.0.0.0/16", "subnets": ["subnet1"]}, "vpc.subnets must be a mapping"),
+    ({"cidr": "10.0.0.0/16", "subnets": {"s1": "oops"}}, "vpc.subnets.s1 must be a mapping"),
+    ({"cidr": "10.0.0.0/16", "subnets": {"s1": {"prefix": 24, "az": ["a"]}}},
+     "vpc.subnets.s1.az must be a name"),
+    ({"cidr": "10.0.0.0/16", "azs": "abc"}, "vpc.azs must be a list of names"),
+    ({"cidr": "10.0.0.0/16", "subnets": {"s1": {"prefix": "big"}}}, "vpc: Invalid VPC subnets"),
+    ({"subnets": {}}, "vpc needs a cidr"),
+])
+def test_malformed_vpc_sections_are_reported(vpc, problem):
+    """Malformed vpc sections are reported, not raised"""
+    problems = environment_config.validate({"infra": [], "vpc": vpc})
+    assert any(problem in found for found in problems), problems
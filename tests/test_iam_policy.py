@@ -0,0 +1,51 @@
+"""Tests for the policy documents of shared/iam_policy.py"""
+import json
+
+import pytest
+
+iam_policy = pytest.importorskip("iam_policy", exc_type=ImportError)
+
+KEYS = [f"bucket{index}" for index in range(200)]
+
+def test_statements_are_shared_and_order_independent():
+    """Equal statements are the same object, whatever the action order"""
+    assert iam_policy.statement(["s3:Get", "s3:Put"], "*") is iam_policy.statement(
+        ("s3:Put", "s3:Get"), ["*"])
+
+def test_documents_merge_statements_differing_in_resources():
+    """Statements with the same actions merge their resources"""
+    policy = json.loads(iam_policy.document(iam_policy.bucket_statement(["one"]),
+                                            iam_policy.bucket_statement(["two"])))
+    assert len(policy["Statement"]) == 1
+    assert len(policy["Statement"][0]["Resource"]) == 4
+
+def test_bucket_groups_fill_the_first_group_up_to_its_own_limit():
+    """The first group is filled up to first_limit"""
+    groups = iam_policy.bucket_groups(KEYS, iam_policy.MANAGED_POLICY_LIMIT, first_limit=2000)
+    assert sum(groups, []) == KEYS
+    assert 0 < len(groups[0]) < len(groups[1])
+
+def test_bucket_groups_leave_the_first_group_empty_without_room():
+    """The first group is empty when not even one bucket fits"""
+    groups = iam_policy.bucket_groups(KEYS[:3], iam_policy.MANAGED_POLICY_LIMIT, first_limit=10)
+    assert groups == [[], KEYS[:3]]
+
+def test_bucket_groups_fit_their_limits_with_the_longest_names():
+    """Groups fit their limit even with the longest bucket names"""
+    limit = iam_policy.MANAGED_POLICY_LIMIT
+    for group in iam_policy.bucket_groups(KEYS, limit):
+        names = [name.ljust(iam_policy.BUCKET_NAME_MAX, "x") for name in group]
+        assert len(iam_policy.document(iam_policy.bucket_statement(names))) <= limit
+
+def test_bucket_groups_reject_limits_too_small_for_one_bucket():
+    """A limit that can't hold one bucket is an error"""
+    with pytest.raises(ValueError):
+        iam_policy.bucket_groups(KEYS, 100)
+
+def test_max_size_sizes_for_the_longest_inputs():
+    """max_size is the size of the document built from the longest inputs"""
+    def build(bucket):
+        """Statements for one bucket"""
+        return [iam_policy.bucket_statement([bucket])]
+    size = iam_policy.max_size(build, bucket=iam_policy.BUCKET_NAME_MAX)
+    assert size == len(iam_policy.document(*build("b" * iam_policy.BUCKET_NAME_MAX)))
@@ -0,0 +1,29 @@
+"""Tests for the dependency-ordered runner of shared/orchestrator.py"""
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+orchestrator = pytest.importorskip("orchestrator", exc_type=ImportError)
+
+def test_run_graph_runs_dependencies_first():
+    """Nodes run after the nodes they depend on"""
+    order = []
+    graph = {"vpc": [], "rds": ["vpc"], "app": ["rds", "vpc"]}
+    results, failed, skipped = orchestrator.run_graph(
+        graph, lambda node: order.append(node) or node, ThreadPoolExecutor(max_workers=2))
+    assert order == ["vpc", "rds", "app"]
+    assert results == {"vpc": "vpc", "rds": "rds", "app": "app"}
+    assert not failed and not skipped
+
+def test_run_graph_skips_dependents_of_failures():
+    """Nodes depending on a failed node are skipped, the rest still run"""
+    def run(node):
+        """Fail for vpc"""
+        if node == "vpc":
+            raise RuntimeError("boom")
+        return node
+    graph = {"vpc": [], "s3": [], "rds": ["vpc"], "app": ["rds"]}
+    results, failed, skipped = orchestrator.run_graph(graph, run, ThreadPoolExecutor(max_workers=2))
+    assert results == {"s3": "s3"}
+    assert list(failed) == ["vpc"]
+    assert sorted(skipped) == ["app", "rds"]
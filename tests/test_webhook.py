@@ -0,0 +1,262 @@
+"""Tests for the webhook Lambda in infra/pipeline-webhook/lambda/webhook.py"""
+# The tests reach into module internals such as the client cache
+# pylint: disable=protected-access
+import datetime
+import hashlib
+import hmac
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+import yaml
+
+import webhook
+
+@pytest.fixture(autouse=True)
+def fixture_clients(monkeypatch):
+    """Give every test its own client cache and a known webhook secret"""
+    monkeypatch.setattr(webhook, "_clients", {})
+    monkeypatch.delenv("webhook_secret_id", raising=False)
+    monkeypatch.setenv("webhook_secret", "s3cret")
+
+def test_to_yaml_round_trips_through_a_yaml_parser():
+    """Buildspecs read back to the data they were written from"""
+    data = {
+        "version": 0.2,
+        "env": {"variables": {"PR": "12", "FLAG": "yes", "EMPTY": "", "NULL": None}},
+        "phases": {"build": {"commands": ["cd infra/vpc", "echo 'a: b' # c", "on", "- x"]}},
+        "artifacts": {"files": []},
+    }
+    assert yaml.safe_load(webhook.to_yaml(data)) == data
+
+def test_to_yaml_writes_plain_strings_unquoted():
+    """Only strings YAML would misread are quoted"""
+    assert webhook.to_yaml({"commands": ["python main.py", "pip"]}) == (
+        'commands:\n    - "python main.py"\n    - pip')
+
+def sign(payload, secret=b"s3cret"):
+    """Sign payload the way GitHub does"""
+    return "sha256=" + hmac.new(secret, payload, hashlib.sha256).hexdigest()
+
+def test_verify_signature_accepts_the_signed_payload():
+    """A payload signed with the secret is accepted"""
+    assert webhook.verify_signature(b'{"action": "opened"}', sign(b'{"action": "opened"}'))
+
+@pytest.mark.parametrize("signature", [
+    None, "", "sha1=abc", sign(b"other payload"), sign(b"{}", secret=b"wrong"),
+])
+def test_verify_signature_rejects_bad_signatures(signature):
+    """Missing, malformed and mismatched signatures are rejected"""
+    assert not webhook.verify_signature(b"{}", signature)
+
+def test_verify_signature_rejects_everything_without_a_secret(monkeypatch):
+    """Nothing is accepted while the secret is unset"""
+    monkeypatch.setenv("webhook_secret", "")
+    assert not webhook.verify_signature(b"{}", sign(b"{}", secret=b""))
+
+def test_memory_store_claims_a_key_once_until_released():
+    """A claimed key can't be claimed again until it is released"""
+    store = webhook.MemoryDedupStore()
+    assert store.claim("delivery-1", 60)
+    assert not store.claim("delivery-1", 60)
+    store.release("delivery-1")
+    assert store.claim("delivery-1", 60)
+
+def test_memory_store_claims_expire():
+    """Expired claims can be claimed again"""
+    store = webhook.MemoryDedupStore()
+    assert store.claim("delivery-1", -1)
+    assert store.claim("delivery-1", 60)
+
+def test_file_store_keeps_claims_between_instances(tmp_path):
+    """Claims are kept in the file between invocations"""
+    path = str(tmp_path / "claims.json")
+    assert webhook.FileDedupStore(path).claim("delivery-1", 60)
+    assert not webhook.FileDedupStore(path).claim("delivery-1", 60)
+    webhook.FileDedupStore(path).release("delivery-1")
+    assert webhook.FileDedupStore(path).claim("delivery-1", 60)
+
+class FakeS3:
+    """The part of the S3 client S3DedupStore uses, backed by a dict"""
+
+    class exceptions: # pylint: disable=invalid-name,too-few-public-methods
+        """Mirrors client.exceptions"""
+        class ClientError(Exception):
+            """Raised for missing objects"""
+
+    def __init__(self):
+        self.objects = {}
+
+    def head_object(self, Bucket, Key): # pylint: disable=invalid-name
+        """Return the LastModified and Metadata of an object, raising ClientError if it is missing"""
+        if (Bucket, Key) not in self.objects:
+            raise self.exceptions.ClientError(Key)
+        modified, _, metadata = self.objects[(Bucket, Key)]
+        return {"LastModified": modified, "Metadata": metadata}
+
+    def put_object(self, Bucket, Key, Body, Metadata=None): # pylint: disable=invalid-name
+        """Store an object, modified now"""
+        self.objects[(Bucket, Key)] = (datetime.datetime.now(datetime.timezone.utc), Body,
+                                       Metadata or {})
+
+    def delete_object(self, Bucket, Key): # pylint: disable=invalid-name
+        """Delete an object if it exists"""
+        self.objects.pop((Bucket, Key), None)
+
+def test_s3_store_claims_through_marker_objects():
+    """Claims are marker objects under dedup/"""
+    s3 = webhook._clients["s3"] = FakeS3()
+    store = webhook.S3DedupStore("bucket")
+    assert store.claim("main:abc", 60)
+    assert not webhook.S3DedupStore("bucket").claim("main:abc", 60)
+    assert [key.startswith("dedup/") for _, key in s3.objects] == [True]
+    store.release("main:abc")
+    assert not s3.objects
+    assert store.claim("main:abc", 60)
+
+def test_s3_store_ignores_expired_markers():
+    """Markers older than the window don't block a claim"""
+    webhook._clients["s3"] = FakeS3()
+    store = webhook.S3DedupStore("bucket")
+    assert store.claim("main:abc", 60)
+    assert store.claim("main:abc", -1)
+
+def test_dedup_store_is_picked_from_the_environment(monkeypatch, tmp_path):
+    """dedup_store follows the dedup_store variable and is cached"""
+    monkeypatch.setenv("dedup_store", f"file:{tmp_path / 'claims.json'}")
+    assert isinstance(webhook.dedup_store(), webhook.FileDedupStore)
+    assert webhook.dedup_store() is webhook.dedup_store()
+
+@pytest.fixture(name="s3")
+def fixture_s3(monkeypatch):
+    """A FakeS3 client, with legacy triggers and an in-memory dedup store"""
+    monkeypatch.setattr(webhook, "trigger_mode", "legacy")
+    monkeypatch.setenv("s3_bucket_functional", "functional")
+    webhook._clients["dedup"] = webhook.MemoryDedupStore()
+    s3 = webhook._clients["s3"] = FakeS3()
+    return s3
+
+def pull_request(sha, updated_at, number=7):
+    """A summarized pull request, as queued by accept"""
+    return {"action": "synchronize", "number": number, "head": "kjenney:feature", "sha": sha,
+            "base": "kjenney:main", "updated_at": updated_at, "merged_at": None,
+            "merge_commit_sha": None}
+
+def head(s3, number=7):
+    """The sha recorded in heads/<number>"""
+    return s3.objects[("functional", f"heads/{number}")][1].decode()
+
+def test_head_markers_only_move_forward(s3):
+    """A delivery handled after a newer one neither moves the marker back nor builds"""
+    webhook.build_functional(pull_request("new", "2021-05-01T12:00:10Z"))
+    webhook.build_functional(pull_request("old", "2021-05-01T12:00:00Z"))
+    assert head(s3) == "new"
+    assert ("functional", "prs/7/old/buildspec.yml") not in s3.objects
+    assert ("functional", "prs/7/new/buildspec.yml") in s3.objects
+
+def test_head_markers_are_written_only_by_claimed_builds(s3):
+    """A duplicate of an older build doesn't rewrite the marker"""
+    webhook.build_functional(pull_request("old", "2021-05-01T12:00:00Z"))
+    del s3.objects[("functional", "heads/7")]
+    webhook.build_functional(pull_request("old", "2021-05-01T12:00:00Z"))
+    assert ("functional", "heads/7") not in s3.objects
+
+def delivery(body, event="pull_request"):
+    """An API Gateway event carrying body as a signed GitHub delivery"""
+    payload = json.dumps(body)
+    return {"headers": {"X-Hub-Signature-256": sign(payload.encode()), "X-GitHub-Event": event,
+                        "X-GitHub-Delivery": "delivery-1"},
+            "body": payload}
+
+def merge(merged_at):
+    """A closed pull_request delivery body, merged at merged_at"""
+    return {"action": "closed", "number": 7,
+            "pull_request": {"updated_at": merged_at, "merged_at": merged_at,
+                             "merge_commit_sha": "abc", "head": {"label": "kjenney:f", "sha": "1"},
+                             "base": {"label": "kjenney:main"}}}
+
+def test_merges_are_checked_for_freshness_on_receipt(monkeypatch):
+    """Only merges delivered within MERGE_WINDOW are queued, however long they then wait"""
+    queue = webhook.LocalQueue()
+    monkeypatch.setitem(webhook._clients, "queue", queue.send)
+    now = datetime.datetime.utcnow()
+    stale = (now - datetime.timedelta(seconds=webhook.MERGE_WINDOW + 5)).strftime(
+        "%Y-%m-%dT%H:%M:%SZ")
+    assert webhook.accept(delivery(merge(stale))) == (202, "stale merge")
+    assert webhook.accept(delivery(merge(now.strftime("%Y-%m-%dT%H:%M:%SZ")))) == (202, "queued")
+    assert len(queue.messages) == 1
+
+@pytest.mark.parametrize("text", [
+    '{"action": "opened", "number": 3, "pull_request": {"head": {"sha": "s", "label": "l"},'
+    ' "body": "x", "base": {"label": "b"}}, "repository": {"big": [1, 2]}}',
+    '{"repository": {"big": [1, 2]}, "pull_request": {"base": {"label": "b"}, "body": "x",'
+    ' "head": {"label": "l", "sha": "s"}}, "number": 3, "action": "opened"}',
+])
+def test_scan_json_reads_the_fields_in_any_key_order(text):
+    """The fields are found wherever they sit, and the rest is dropped"""
+    values, _ = webhook.scan_json(text, webhook.PULL_REQUEST_FIELDS)
+    assert values == {"action": "opened", "number": 3,
+                      "pull_request": {"head": {"sha": "s", "label": "l"},
+                                       "base": {"label": "b"}}}
+
+def test_accept_rejects_oversized_deliveries(monkeypatch):
+    """Deliveries over MAX_BODY_BYTES get a 413 before they are verified"""
+    monkeypatch.setattr(webhook, "MAX_BODY_BYTES", 64)
+    assert webhook.accept(delivery({"action": "opened", "padding": "x" * 64})) == (
+        413, "too large")
+
+def test_accept_rejects_bad_signatures():
+    """Deliveries whose signature doesn't match get a 401"""
+    event = delivery({"action": "opened"})
+    event["headers"]["X-Hub-Signature-256"] = sign(b"{}")
+    assert webhook.accept(event) == (401, "bad signature")
+
+@pytest.mark.parametrize("body, event, result", [
+    ({"zen": "Keep it logically awesome."}, "ping", "ignored event"),
+    (dict(merge(None), action="labeled"), "pull_request", "ignored action"),
+    (merge(None), "pull_request", "ignored action"),
+])
+def test_accept_acknowledges_deliveries_that_need_no_build(monkeypatch, body, event, result):
+    """Other events and actions, and closed but unmerged pull requests, are answered and dropped"""
+    queue = webhook.LocalQueue()
+    monkeypatch.setitem(webhook._clients, "queue", queue.send)
+    assert webhook.accept(delivery(body, event)) == (202, result)
+    assert not queue.messages
+
+def test_accept_queues_the_summary_of_a_push(monkeypatch):
+    """A push is queued with only the fields the worker needs"""
+    queue = webhook.LocalQueue()
+    monkeypatch.setitem(webhook._clients, "queue", queue.send)
+    body = dict(merge(None), action="synchronize")
+    body["pull_request"]["body"] = "x" * 1000
+    assert webhook.accept(delivery(body)) == (202, "queued")
+    assert [json.loads(message) for message in queue.messages] == [{
+        "delivery": "delivery-1",
+        "pull_request": {"action": "synchronize", "number": 7, "head": "kjenney:f", "sha": "1",
+                         "base": "kjenney:main", "updated_at": None, "merged_at": None,
+                         "merge_commit_sha": "abc"}}]
+
+def test_drained_messages_are_built_and_failures_reported(s3):
+    """The worker builds each queued message and reports only the ones that failed"""
+    queue = webhook.LocalQueue()
+    queue.send({"delivery": "d1", "pull_request": pull_request("s1", "2021-05-01T12:00:00Z")})
+    queue.send({"delivery": "d2", "pull_request": {"merged_at": None}})
+    queue.send({"delivery": "d3", "pull_request": pull_request("s3", "2021-05-01T12:00:10Z", 8)})
+    context = SimpleNamespace(log_stream_name="test")
+    assert queue.drain(context, batch_size=2) == ["1"]
+    assert not queue.messages
+    assert ("functional", "prs/7/s1/buildspec.yml") in s3.objects
+    assert ("functional", "prs/8/s3/buildspec.yml") in s3.objects
+    # d1 stays claimed, while the failed d2 was released so its redelivery is processed again
+    assert webhook.process({"delivery": "d1", "pull_request": {}}) == "duplicate delivery"
+    with pytest.raises(KeyError):
+        webhook.process({"delivery": "d2", "pull_request": {"merged_at": None}})
+
+@pytest.mark.parametrize("branch", ["feature", "fix/quo\"te's", "ünïcode"])
+def test_functional_template_renders_like_to_yaml(branch):
+    """The cached template gives the same bytes as serializing the buildspec"""
+    expected = webhook.to_yaml(webhook.buildspec_functional(
+        webhook.environment, os.environ.get("s3_bucket_functional"), 12, branch, "0" * 40))
+    rendered = webhook.FUNCTIONAL_TEMPLATE.render(pr_number=12, branch=branch, sha="0" * 40)
+    assert rendered == expected.encode("utf-8")